@@ -10,16 +10,146 @@
 #          into MicroPython for running on a microcontroller + ePaper display.
 #
 # ------------------------------------------------------------------------------ #
-import tkinter as tk
-import threading
-import time
+import argparse
+import asyncio
+import bisect
+import datetime
+import functools
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import json
 import math
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import re
 import socket
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Set constant variables
 SCREEN_WIDTH = 128
 SCREEN_HEIGHT = 296
 PORT = 9000
+PACKET_SIZE = 1024  # size of a legacy alert packet, auth code included
+MAX_CONNECTIONS = 256  # connections handled at once by serve_async before senders are held back
+READ_TIMEOUT = 5  # seconds a sender has to deliver its packet
+IDLE_TIMEOUT = 60  # seconds a persistent connection may sit between frames
+
+# Framed wire protocol. A frame is a fixed header followed by length bytes of UTF-8 alert
+# text, with no padding. Many frames can be sent over one connection, and each is answered
+# with an ack frame carrying its message id. Connections that don't start with FRAME_MAGIC
+# are treated as a single legacy PACKET_SIZE packet.
+FRAME_MAGIC = b'\xeaP'
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sB4sII')  # magic, version, auth code, message id, payload length
+# Version 2 frames are authenticated with HMAC-SHA256 over the header (up to the MAC) and
+# payload, truncated to MAC_SIZE bytes. The timestamp and nonce protect against replays.
+PROTOCOL_VERSION_HMAC = 2
+FRAME_HEADER_HMAC = struct.Struct('!2sBIIQ8s16s')  # magic, version, message id, payload length,
+                                                   # timestamp (ms since epoch), nonce, MAC
+MAC_SIZE = 16
+FRAME_PREFIX_SIZE = 3  # magic and version, common to every frame version
+ACK_FRAME = struct.Struct('!2sBIB')  # magic, version, message id, status
+MAX_FRAME_PAYLOAD = 64 * 1024
+ACK_OK = 0
+ACK_AUTH_FAILED = 1
+ACK_BAD_DATA = 2
+ACK_REPLAYED = 3
+ACK_RATE_LIMITED = 4
+
+# Authentication
+AUTH_CODE = b"1111"  # auth code for legacy packets and version 1 frames
+ALLOWED_HOSTS = ['127.0.0.1', '192.168.1.1']  # Add intended hosts here, addresses or CIDR networks
+REPLAY_WINDOW = 60  # seconds a version 2 frame's timestamp may differ from our clock
+REPLAY_CACHE_SIZE = 100000  # nonces remembered within the replay window
+RATE_LIMIT = 200  # packets per second allowed from each source address
+RATE_BURST = 400  # packets a source may send at once before rate limiting starts
+RATE_LIMIT_SOURCES = 10000  # source addresses tracked by the rate limiter
+REPLAY_SLOT = struct.Struct('!8sd')  # nonce, time it can be forgotten: one slot of SharedReplayCache
+REPLAY_PROBES = 8  # slots searched for a nonce in SharedReplayCache
+
+# Ingest workers, see IngestWorkerPool
+INGEST_WORKERS = 1  # receiver processes sharing the port, 1 receives in the display process
+WORKER_METRICS_INTERVAL = 2  # seconds between metrics snapshots sent up by each worker
+
+# Alert message formats, see MessageParser. Structured text messages start with
+# STRUCTURED_PREFIX and binary messages with BINARY_MESSAGE_MAGIC, anything else is free text.
+STRUCTURED_PREFIX = '@'
+BINARY_MESSAGE = struct.Struct('!BBBBIB')  # magic, version, alert type code, severity, ttl seconds
+                                           # (0 for the default), number of areas
+BINARY_MESSAGE_MAGIC = 0xA5  # never starts UTF-8 text, so text and binary messages can share a connection
+BINARY_MESSAGE_VERSION = 1
+# Alert types the display has an icon for. In binary messages type code n is ALERT_TYPES[n - 1],
+# and 0 leaves the type to the classifier.
+ALERT_TYPES = ("Typhoon", "Flood", "Heatwave", "Disease", "Drought")
+
+# Classifier vocabularies. Keywords match whole words regardless of case, plus a plural
+# "s"/"es", so "flood" also covers "Floods" but "high" does not match "highway".
+ALERT_KEYWORDS = {
+    "flood": "Flood",
+    "flooding": "Flood",
+    "torrential rain": "Flood",
+    "typhoon": "Typhoon",
+    "disease": "Disease",
+    "virus": "Disease",
+    "drought": "Drought"}
+# When a message names several hazards the one listed first here wins, so
+# "typhoon and flooding" is a Typhoon alert
+ALERT_PRECEDENCE = ["Typhoon", "Flood", "Disease", "Drought"]
+# When a message contains several severity words the highest level wins
+SEVERITY_KEYWORDS = {
+    "low": 1,
+    "moderate": 2,
+    "high": 3,
+    "severe": 4,
+    "critical": 5,
+    "disease": 3,
+    "virus": 4,
+    "minor": 1,
+    "significant": 3,
+    "major": 4,
+    "negligble": 1,
+    "negligible": 1,
+    "dangerous": 5}
+# Rule file that replaces the vocabularies above when present. It is watched while running,
+# so keywords can be added without restarting the receiver.
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alert_rules.json')
+RULES_POLL_INTERVAL = 2  # seconds between checks of the rule file for changes
+ALERT_QUEUE_SIZE = 64  # alerts waiting for the display before the least important are dropped
+COALESCE_DELAY = 0.2  # seconds the render worker waits for the rest of a burst before drawing
+RENDER_POLL_INTERVAL = 0.05  # seconds between render ticks on displays drawn from their own loop (Tk)
+METRICS_PORT = 9100  # local port serving /metrics as JSON, 0 turns it off
+METRICS_SNAPSHOT_INTERVAL = 10  # seconds between metrics snapshot file writes
+LOG_RATE = 20  # structured log records per second allowed for each event name
+LOG_BURST = 50  # records an event name may log at once before rate limiting starts
+PANEL_TIMEOUT = 60  # seconds a panel may take over one update before it is marked failed
+PANEL_CHECK_INTERVAL = 5  # seconds between checks for panels that overran an update or are due a retry
+PANEL_FAILURE_LIMIT = 3  # failures in a row before a panel is skipped for a while
+PANEL_RETRY_DELAY = 30  # seconds a failing panel is skipped before it is tried again
+REGION_TAG = re.compile(r'#([\w-]+)')  # region tags in a message, e.g. "#hanoi", used to target display groups
+ALERT_CACHE_SIZE = 1024  # distinct messages whose parsed alert and frame are remembered
+ALERT_TTL = 6 * 60 * 60  # seconds an alert stays active after it is received
+ROTATION_INTERVAL = 30  # seconds each of several active alerts is shown before the next one
+MAX_ACTIVE_ALERTS = 32  # active alerts kept for rotation before the least important are dropped
+# Journal of accepted alerts, replayed at start up so an active alert survives a restart
+JOURNAL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alert_journal.bin')
+JOURNAL_RECORD = struct.Struct('!II')  # payload length, CRC-32 of the payload, then the JSON payload
+JOURNAL_FSYNC_INTERVAL = 0.05  # seconds between fsyncs, alerts accepted in between are synced together
+JOURNAL_COMPACT_SIZE = 1024 * 1024  # bytes the journal may grow to before it is compacted
+DEFAULT_SEVERITY = 1  # if we dont know the severity its just going to be given 1 for now to prevent panic
+MAX_SEVERITY = 5  # "critical", the most severe level. Messages stating a higher one are refused.
 
 # ------------------------------------------------------------------------------ #
 #
@@ -36,79 +166,1323 @@ class AlertSystem:
     def __init__(self):
         self.receiver = None  # will be attached after initialising
         self.display = None
+        self.classifier = AlertClassifier()
+        self.parser = MessageParser()
+        self.alert_queue = None  # created by start_render_worker
+        self.fanout = None  # created by add_display_group
+        self.alert_cache = AlertCache()
+        self.shown_key = None  # message key of the alert on self.display
+        self.journal = None
+        self.forwarder = None  # set in an ingest worker, see attach_forwarder
+        self.alert_ttl = ALERT_TTL
+        self.scheduler = AlertScheduler()
+        metrics.gauges['scheduler'] = self.scheduler.stats
+        metrics.gauges['alert_cache'] = self.alert_cache.stats
 
     def attach_receiver(self, receiver):
         self.receiver = receiver
 
     def attach_display(self, display):
+        # Single display. For many panels use add_display_group instead.
         self.display = display
 
+    def attach_journal(self, journal):
+        # Every alert dispatched from now on is recorded in the journal
+        self.journal = journal
+
+    def attach_forwarder(self, forwarder):
+        # Ingest worker: processed alerts are sent to the display process instead of being
+        # journalled and scheduled here
+        self.forwarder = forwarder
+
+    def restore(self, journal):
+        # Schedule the alerts still active in the journal, which draws the most important.
+        # Returns the number of alerts restored.
+        alerts = journal.active_alerts()
+        if alerts:
+            self.schedule(alerts)
+        log.event('alerts_restored', count=len(alerts))
+        return len(alerts)
+
+    def add_display_group(self, name, displays, regions=()):
+        # Register a group of panels. Alerts tagged with regions (e.g. "#hanoi") only go to
+        # groups covering one of those regions, and a group with no regions gets every alert.
+        # Once a group is registered alerts are sent to the groups and not to self.display.
+        if self.fanout is None:
+            self.fanout = DisplayFanout(frame_cache=self.alert_cache)
+            metrics.gauges['scheduler'] = self.fanout.scheduler_stats
+        self.fanout.add_group(DisplayGroup(name, displays, regions))
+
+    def classify_alert(self, alert_string):
+        # Work out the alert type and severity in one pass. If no hazard is recognised the
+        # lowercased message is used as the type, which the display shows as a general alert.
+        alert_type, severity = self.classifier.classify(alert_string)
+        if alert_type is None:
+            alert_type = alert_string.lower()
+        return alert_type, severity
+
     def get_alert_type(self, alert_string):
-        alert_string = alert_string.lower()
-        keyword_alert_dict = { #potentially extend to add more warnings but for now this is all we have
-            "flood":"Flood",
-            "flooding":"Flood",
-            "torrential rain":"Flood",
-             "typhoon":"Typhoon",
-             "disease":"Disease",
-             "virus":"Disease",
-             "drought":"Drought"}
-        alert_string = alert_string.lower()
-        alert_warning = ""
-        for keyword,alert in keyword_alert_dict.items():
-            if keyword in alert_string:
-                alert_warning = alert
-                print(alert_warning)
-
-        if not alert_warning:
-            return alert_string
-        else:
-            alert_warning = alert_warning.rstrip(' ,')
-            return alert_warning
+        return self.classify_alert(alert_string)[0]
 
 # #get_alert_type("We have detected that there is a typhoons and flooding hitting the provinces")  - testing more than one hazard
 
     def get_severity_level(self, alert_string):
-        severity_level_dict = { #potentially extend to add more warnings but for now this is all we have
-            "low":1,
-            "moderate":2,
-            "high":3,
-             "severe":4,
-             "critical":5,
-             "disease":3,
-             "virus":4,
-             "minor":1,
-              "significant":3,
-              "major":4,
-            "negligble":1,
-            "dangerous":5}
-        alert_string = alert_string.lower()
-        for keyword,alert in severity_level_dict.items():
-            if keyword in alert_string:
-                alert_warning = alert
-                break
-            else:
-                alert_warning=1 #if we dont know the severity its just going to be given 1 for now to prevent panic
-        return alert_warning
+        return self.classifier.classify(alert_string)[1]
 
     def process_data(self, data):
-        if data == '':
-            print("No valid data detected")
+        # Turn a message (text, or bytes for a binary message) into an alert and dispatch it.
+        # Returns False if the message was malformed and dropped.
+        started = time.perf_counter()
+
+        # Repeats of a message already seen skip parsing and classification
+        key = message_key(data)
+        classifier = self.classifier
+        cached = self.alert_cache.get(key, classifier)
+        if cached is not None:
+            self.count_alert(cached, classifier)
+            self.dispatch_alert(self.stamp_alert(cached))
+            return True
+
+        try:
+            message = self.parser.parse(data)
+            alert_type = message.get("alert_type")
+            if alert_type is not None:
+                alert_type = classifier.type_names.get(alert_type.lower())
+                if alert_type is None:
+                    raise MalformedMessage('unknown_type', message["alert_type"])
+        except MalformedMessage as e:
+            metrics.count('parse_failures')
+            metrics.count('parse_errors.' + e.reason)
+            log.event('malformed_message', reason=e.reason, detail=e.detail)
+            return False
+        parsed = time.perf_counter()
+        severity = message.get("severity")
+        if alert_type is None or severity is None:
+            # Whatever the message doesn't state is worked out from its headline
+            found_type, found_severity = classifier.classify(message["headline"])
+            if alert_type is None:
+                alert_type = found_type or message["headline"].lower()  # same fallback as classify_alert
+            if severity is None:
+                severity = found_severity
+        classified = time.perf_counter()
+        metrics.observe('parse', parsed - started)
+        metrics.observe('classify', classified - parsed)
+
+        new_alert = {"alert_type":alert_type,"severity":severity,"info":message["info"],
+                     "regions":message["regions"],"message_key":key}
+        for field in ("lang", "ttl", "expires_at"):
+            if field in message:
+                new_alert[field] = message[field]
+        self.alert_cache.put(key, classifier, new_alert)
+        self.count_alert(new_alert, classifier)
+        self.dispatch_alert(self.stamp_alert(new_alert))
+        return True
+
+    def stamp_alert(self, alert):
+        # Copy of a parsed alert with the time it was received and when it expires. Messages
+        # can give their own expiry time or time to live, otherwise alert_ttl is used.
+        received_at = time.time()
+        expires_at = alert.get("expires_at") or received_at + alert.get("ttl", self.alert_ttl)
+        return dict(alert, received_at=received_at, expires_at=expires_at)
+
+    def count_alert(self, alert, classifier):
+        metrics.count('alerts')
+        alert_type = alert["alert_type"]
+        metrics.count('alerts_by_type.' + (alert_type if alert_type in classifier.alert_types else 'General'))
+        metrics.count(f'alerts_by_severity.{alert["severity"]}')
+
+    def dispatch_alert(self, alert):
+        # Hand a processed alert to the render worker if it is running, otherwise schedule it now
+        if self.forwarder is not None:
+            self.forwarder.send('alert', alert)
+            return
+        if self.journal is not None:
+            self.journal.append(alert)
+        if self.alert_queue is not None:
+            self.alert_queue.put(alert)
+        else:
+            self.schedule([alert])
+
+    def schedule(self, alerts=()):
+        # Add alerts to the scheduler, run any timers that are due and redraw if what
+        # should be on show has changed. Display groups are scheduled by the fanout, each
+        # set of panels wanting the same regions on its own.
+        if self.fanout is not None:
+            self.fanout.schedule(alerts, time.time())
+            return
+        redraw, alert = self.scheduler.update(alerts, time.time())
+        if redraw:
+            self.render_alert(alert)
+
+    def next_deadline(self):
+        # When the render worker next has to run the scheduler's timers, None for never
+        if self.fanout is not None:
+            return self.fanout.next_deadline()
+        return self.scheduler.next_deadline()
+
+    def render_alert(self, alert):
+        # Draw an alert, or the no alerts screen for None, on self.display
+        started = time.perf_counter()
+        key = NO_ALERTS_KEY if alert is None else alert.get("message_key")
+        if key is not None and key == self.shown_key:
+            metrics.count('redraws_skipped')  # the display already shows exactly this
+            return
+        if alert is None:
+            self.display.no_alerts()
+        else:
+            self.display.draw_content(alert)
+        self.shown_key = key
+        metrics.observe('draw', time.perf_counter() - started)
+        if alert is not None and "received_at" in alert:
+            metrics.observe('received_to_drawn', time.time() - alert["received_at"])
+
+    def start_render_worker(self, maxsize=ALERT_QUEUE_SIZE, coalesce_delay=COALESCE_DELAY):
+        # Decouple network intake from drawing. Alerts are queued by process_data and a
+        # single worker feeds each burst to the scheduler and runs its timers. Displays that
+        # may only be drawn from their own thread (Tk isn't thread safe) run the worker as a
+        # tick on their event loop through call_every, anything else gets a worker thread.
+        self.alert_queue = AlertQueue(maxsize)
+        self.coalesce_delay = coalesce_delay
+        metrics.gauges['alert_queue'] = self.alert_queue.stats
+        if self.fanout is None and hasattr(self.display, 'call_every'):
+            self.display.call_every(RENDER_POLL_INTERVAL, self.render_tick)
+        else:
+            threading.Thread(target=self.render_loop, daemon=True).start()
+
+    def render_loop(self):
+        while True:
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            if self.fanout is not None:
+                # Wake up now and then for panels stuck in an update or due a retry
+                timeout = PANEL_CHECK_INTERVAL if timeout is None else min(timeout, PANEL_CHECK_INTERVAL)
+            self.render_burst(self.alert_queue.take_all(self.coalesce_delay, timeout))
+            if self.fanout is not None:
+                self.fanout.check_panels()
+
+    def render_tick(self):
+        # One step of the render worker that never blocks, run on the display's own loop
+        alerts = self.alert_queue.take_ready(self.coalesce_delay)
+        deadline = self.next_deadline()
+        if alerts or (deadline is not None and deadline <= time.time()):
+            self.render_burst(alerts)
+
+    def render_burst(self, alerts):
+        try:
+            self.schedule(alerts)
+        except Exception as e:  # keep the worker alive for the next alert
+            metrics.count('draw_failures')
+            log.event('draw_failed', alerts=alerts, error=repr(e))
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   AlertQueue
+#
+# Purpose: Bounded priority queue between the receiver and the display.
+#          Alerts are ordered by severity and then by how recently they
+#          arrived. When the queue is full the least important alert is
+#          dropped, and take_all() hands over a whole burst at once so the
+#          scheduler redraws at most once for it, since on ePaper every
+#          superseded refresh wastes seconds of panel time.
+#
+# ------------------------------------------------------------------------------ #
+class AlertQueue:
+    def __init__(self, maxsize=ALERT_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.heap = []  # entries are (-severity, -time received, -arrival number, alert)
+        self.arrivals = 0
+        self.burst_started = 0  # time.monotonic() when the queue last went from empty to not
+        self.condition = threading.Condition()
+
+        # Counters
+        self.enqueued = 0
+        self.dropped = 0  # discarded because the queue was full
+        self.taken = 0
+        self.bursts = 0  # calls to take_all that returned alerts
+
+    def put(self, alert):
+        with self.condition:
+            self.arrivals += 1
+            # Ties go by the time an alert was received rather than when it got here, which
+            # can differ when alerts come from several ingest workers
+            entry = (-alert.get("severity", DEFAULT_SEVERITY), -alert.get("received_at", 0), -self.arrivals, alert)
+            if len(self.heap) >= self.maxsize:
+                self.dropped += 1
+                least_important = max(self.heap)
+                if entry > least_important:
+                    return  # the new alert is the least important, drop it
+                self.heap.remove(least_important)
+                heapq.heapify(self.heap)
+            if not self.heap:
+                self.burst_started = time.monotonic()
+            heapq.heappush(self.heap, entry)
+            self.enqueued += 1
+            self.condition.notify()
+
+    def take_all(self, coalesce_delay=0, timeout=None):
+        # Block until an alert is available, or for up to timeout seconds. Waits up to
+        # coalesce_delay for the rest of a burst to arrive, then returns every queued alert,
+        # most severe (most recently received on ties) first. Returns an empty list if the timeout passed.
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.heap, timeout):
+                return []
+            if coalesce_delay:
+                deadline = time.monotonic() + coalesce_delay
+                while (remaining := deadline - time.monotonic()) > 0:
+                    self.condition.wait(remaining)
+            return self.drain()
+
+    def take_ready(self, coalesce_delay=0):
+        # take_all without blocking, for a render worker polled from an event loop. Returns
+        # every queued alert once the first of the burst has waited coalesce_delay, otherwise [].
+        with self.condition:
+            if not self.heap or time.monotonic() - self.burst_started < coalesce_delay:
+                return []
+            return self.drain()
+
+    def drain(self):
+        # Called holding self.condition
+        alerts = [entry[-1] for entry in sorted(self.heap)]
+        self.heap.clear()
+        self.taken += len(alerts)
+        self.bursts += 1
+        return alerts
+
+    def __len__(self):
+        return len(self.heap)
+
+    def stats(self):
+        with self.condition:
+            return {"depth": len(self.heap), "enqueued": self.enqueued, "dropped": self.dropped,
+                    "taken": self.taken, "bursts": self.bursts}
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   AlertScheduler
+#
+# Purpose: Decides which active alert is on show. Alerts stay active until
+#          their expires_at, several active alerts take turns every
+#          ROTATION_INTERVAL, and an alert more severe than the one on show
+#          replaces it at once. Expiries and the next rotation are kept in
+#          one heap of timers, so however many alerts are active the render
+#          worker only needs to wake for the earliest one. update() reports
+#          a redraw only when the alert on show actually changes.
+#
+# ------------------------------------------------------------------------------ #
+class AlertScheduler:
+    def __init__(self, rotation_interval=ROTATION_INTERVAL, max_active=MAX_ACTIVE_ALERTS):
+        self.rotation_interval = rotation_interval
+        self.max_active = max_active
+        self.active = {}  # key: alert, keyed by message key so a repeated message refreshes its expiry
+        self.rotation = deque()  # keys of the active alerts in the order they take turns
+        self.timers = []  # heap of (expiry time, sequence number, key)
+        self.current = None  # key of the alert on show, None for no alerts
+        self.rotate_at = math.inf
+        self.sequence = 0
+
+        # Counters
+        self.preemptions = 0
+        self.rotations = 0
+        self.expired = 0
+        self.dropped = 0  # least important alerts removed when there were too many
+
+    def update(self, alerts, now):
+        # Take in new alerts (most important first is cheapest) and run the timers due by now.
+        # Returns (redraw, alert to show or None for no alerts).
+        redraw = False
+        for alert in alerts:
+            self.sequence += 1
+            key = alert.get("message_key") or self.sequence
+            if key not in self.active:
+                self.rotation.append(key)
+                if len(self.rotation) == 2:
+                    self.rotate_at = now + self.rotation_interval  # a second alert starts the rotation
+            self.active[key] = alert
+            heapq.heappush(self.timers, (alert.get("expires_at", math.inf), self.sequence, key))
+            if self.current is None or (key != self.current and
+                                        alert["severity"] > self.active[self.current]["severity"]):
+                if self.current is not None:
+                    self.preemptions += 1
+                self.current = key
+                self.rotate_at = now + self.rotation_interval
+                redraw = True
+
+        while len(self.active) > self.max_active:
+            least_important = min((key for key in self.active if key != self.current),
+                                  key=lambda key: (self.active[key]["severity"], self.active[key]["received_at"]))
+            self.remove(least_important)
+            self.dropped += 1
+
+        while self.timers and self.timers[0][0] <= now:
+            expires_at, _, key = heapq.heappop(self.timers)
+            alert = self.active.get(key)
+            if alert is None or alert.get("expires_at", math.inf) != expires_at:
+                continue  # the alert was refreshed or already removed
+            self.remove(key)
+            self.expired += 1
+            if key == self.current:
+                self.current = None
+                redraw = True
+        if len(self.timers) > 4 * len(self.active) + 16:
+            # Refreshed alerts leave their old timers behind, rebuild the heap without them
+            self.timers = [timer for timer in self.timers
+                           if timer[2] in self.active and self.active[timer[2]].get("expires_at", math.inf) == timer[0]]
+            heapq.heapify(self.timers)
+
+        if self.current is None and self.active:
+            self.current = self.next_in_rotation()
+            self.rotate_at = now + self.rotation_interval
+            redraw = True
+        elif self.rotate_at <= now:
+            self.rotate_at = now + self.rotation_interval
+            if len(self.active) > 1:
+                self.current = self.next_in_rotation()
+                self.rotations += 1
+                redraw = True
+        return redraw, self.active.get(self.current)
+
+    def next_in_rotation(self):
+        # The key after the current one, moving it to the back of the line
+        while True:
+            key = self.rotation.popleft()
+            self.rotation.append(key)
+            if key != self.current or len(self.rotation) == 1:
+                return key
+
+    def remove(self, key):
+        del self.active[key]
+        self.rotation.remove(key)
+
+    def next_deadline(self):
+        # Time of the next expiry or rotation, None if there is nothing to wait for
+        deadline = self.timers[0][0] if self.timers else math.inf
+        if len(self.active) > 1:
+            deadline = min(deadline, self.rotate_at)
+        return None if deadline == math.inf else deadline
+
+    def stats(self):
+        return {"active": len(self.active), "timers": len(self.timers), "preemptions": self.preemptions,
+                "rotations": self.rotations, "expired": self.expired, "dropped": self.dropped}
+
+
+
+def message_key(data):
+    # Key for a message that ignores differences in whitespace, such as the padding
+    # of legacy packets. Binary messages are keyed on their exact bytes.
+    if not isinstance(data, str):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+    return hashlib.blake2b(' '.join(data.split()).encode(), digest_size=16).hexdigest()
+
+
+NO_ALERTS_KEY = 'no_alerts'  # message key standing for the no alerts screen
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   AlertCache
+#
+# Purpose: Bounded LRU cache of recently seen messages, keyed by
+#          message_key. Each entry holds the parsed alert and, once it has
+#          been rendered, its frame, so re-broadcasts of the same bulletin
+#          skip parsing, classification and rasterising. Entries made with
+#          an older classifier are treated as misses after a rule reload.
+#
+# ------------------------------------------------------------------------------ #
+class AlertCache:
+    def __init__(self, maxsize=ALERT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key: [classifier, alert, frame]
+        self.lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.frame_hits = 0
+        self.frame_misses = 0
+
+    def get(self, key, classifier):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] is not classifier:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, classifier, alert):
+        with self.lock:
+            self.entries[key] = [classifier, alert, None]
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_frame(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] is None:
+                self.frame_misses += 1
+                return None
+            self.frame_hits += 1
+            return entry[2]
+
+    def put_frame(self, key, frame):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] = frame
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "frame_hits": self.frame_hits, "frame_misses": self.frame_misses}
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   AlertJournal
+#
+# Purpose: Append-only journal of accepted alerts, so a restart can put the
+#          active alert straight back on the display. Records are written
+#          as they arrive and a background thread fsyncs them in batches
+#          every JOURNAL_FSYNC_INTERVAL, so a power cut loses at most that
+#          much. Only alerts that could still become the one on show are
+#          kept in memory, and when the file passes JOURNAL_COMPACT_SIZE it
+#          is rewritten with just those, so it stays a few records long.
+#
+# ------------------------------------------------------------------------------ #
+class AlertJournal:
+    FIELDS = ("alert_type", "severity", "info", "regions", "lang", "received_at", "expires_at", "message_key")
+
+    def __init__(self, path=JOURNAL_FILE, fsync_interval=JOURNAL_FSYNC_INTERVAL, compact_size=JOURNAL_COMPACT_SIZE):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_size = compact_size
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        # Per set of regions, the alerts that are not outranked by an alert which lasts
+        # at least as long, most important first
+        self.candidates = {}
+        for record in read_journal(path):
+            self.add_candidate(record)
+        self.file = None
+        self.unsynced = 0  # records written since the last fsync
+
+        # Counters
+        self.appended = 0
+        self.fsyncs = 0
+        self.compactions = 0
+
+        self.compact()  # also drops a record torn by a crash while it was written
+
+    def add_candidate(self, record):
+        # An alert only needs keeping while nothing more important outlasts it
+        priority = (record["severity"], record["received_at"])
+        candidates = self.candidates.setdefault(tuple(record.get("regions") or ()), [])
+        for other in candidates:
+            if (other["severity"], other["received_at"]) >= priority and other["expires_at"] >= record["expires_at"]:
+                return
+        candidates[:] = [other for other in candidates
+                         if not ((other["severity"], other["received_at"]) <= priority
+                                 and other["expires_at"] <= record["expires_at"])]
+        candidates.append(record)
+        candidates.sort(key=lambda other: (other["severity"], other["received_at"]), reverse=True)
+
+    def active_alerts(self, now=None):
+        # The most important unexpired alert for each set of regions, most important first
+        now = time.time() if now is None else now
+        with self.lock:
+            alerts = [next((record for record in candidates if record["expires_at"] > now), None)
+                      for candidates in self.candidates.values()]
+        alerts = [alert for alert in alerts if alert is not None]
+        alerts.sort(key=lambda alert: (alert["severity"], alert["received_at"]), reverse=True)
+        return alerts
+
+    def append(self, alert):
+        record = {field: alert.get(field) for field in self.FIELDS}
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode()
+        with self.lock:
+            self.file.write(JOURNAL_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.add_candidate(record)
+            self.unsynced += 1
+            self.appended += 1
+
+    def sync(self):
+        with self.lock:
+            if not self.unsynced:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.fsyncs += 1
+            compact = self.file.tell() > self.compact_size
+        if compact:
+            self.compact()
+
+    def compact(self):
+        # Rewrite the journal with only the unexpired candidates, replacing it in one step
+        now = time.time()
+        temporary_path = self.path + '.tmp'
+        with self.lock:
+            for regions, candidates in list(self.candidates.items()):
+                candidates[:] = [record for record in candidates if record["expires_at"] > now]
+                if not candidates:
+                    del self.candidates[regions]
+            with open(temporary_path, 'wb') as journal_file:
+                for candidates in self.candidates.values():
+                    for record in candidates:
+                        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode()
+                        journal_file.write(JOURNAL_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            if self.file is not None:
+                self.file.close()
+            os.replace(temporary_path, self.path)
+            self.file = open(self.path, 'ab')
+            self.unsynced = 0
+            self.compactions += 1
+
+    def run(self):
+        while not self.stop_event.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except OSError as e:
+                log.event('journal_sync_failed', path=self.path, error=str(e))
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.sync()
+
+    def stats(self):
+        with self.lock:
+            return {"appended": self.appended, "fsyncs": self.fsyncs, "compactions": self.compactions,
+                    "bytes": self.file.tell(), "candidates": sum(map(len, self.candidates.values()))}
+
+
+def read_journal(path):
+    # Yield the records in a journal file, oldest first, reading it through a memory map.
+    # Reading stops at the first incomplete or corrupt record, which can only be the
+    # last one written before a crash.
+    try:
+        journal_file = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with journal_file:
+        if os.fstat(journal_file.fileno()).st_size == 0:
+            return  # an empty file can't be mapped
+        with mmap.mmap(journal_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            offset = 0
+            end = len(view)
+            while offset + JOURNAL_RECORD.size <= end:
+                length, checksum = JOURNAL_RECORD.unpack_from(view, offset)
+                start = offset + JOURNAL_RECORD.size
+                payload = view[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    log.event('journal_truncated', path=path, offset=offset)
+                    return
+                yield json.loads(payload)
+                offset = start + length
+
+
+class MalformedMessage(ValueError):
+    # Raised by MessageParser. reason is a short name used for the parse_errors counters.
+    def __init__(self, reason, detail=''):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+        self.detail = detail
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   MessageParser
+#
+# Purpose: Parses alert messages in the three formats senders can use, each
+#          in one pass over the message:
+#
+#          Free text   "<headline>. <action>. <anything else>"
+#                      Sentences end at a full stop followed by a space or
+#                      the end of the message, so "2.5 m" and "approx." do
+#                      not split them. With one sentence it is both the
+#                      headline and the action.
+#          Structured  "@type=Flood;severity=4;area=hanoi,hue;expires=3600;lang=vi|<action>"
+#                      Every field is optional. expires is seconds to live
+#                      (0, as in binary messages, for the default) or an
+#                      ISO 8601 time, and headline= can give text to
+#                      classify when type or severity is left out.
+#          Binary      BINARY_MESSAGE header, then each area and the
+#                      language tag as a length byte and UTF-8, then the
+#                      action text. Built by encode_binary_message.
+#
+#          "#region" tags are picked out of text in either text format.
+#          parse() returns a dict with headline, info and regions, plus
+#          alert_type, severity, lang, ttl or expires_at when the message
+#          gives them, and raises MalformedMessage for anything unusable.
+#
+# ------------------------------------------------------------------------------ #
+class MessageParser:
+    SENTENCE_END = re.compile(r'\.(?=\s|$)')
+    ABBREVIATIONS = frozenset(("approx", "e.g", "i.e", "est", "no", "st", "mt", "rd", "ave", "dr", "mr", "mrs",
+                               "ms", "vs"))
+    FIELDS = frozenset(("type", "severity", "area", "expires", "lang", "headline"))
+
+    def parse(self, data):
+        if not isinstance(data, str):
+            return self.parse_binary(data)
+        data = data.strip()  # legacy packets are padded with spaces
+        if not data:
+            raise MalformedMessage('empty')
+        if data[0] == STRUCTURED_PREFIX:
+            return self.parse_structured(data)
+        message = {}
+        message["regions"], data = self.take_regions(data)
+        end = self.sentence_end_at(data, 0)
+        if end < 0:
+            message["headline"] = message["info"] = data.strip()
+        else:
+            message["headline"] = data[:end].strip()
+            next_end = self.sentence_end_at(data, end + 1)
+            # A message of one sentence is both the headline and the action, with or without its full stop
+            message["info"] = data[end + 1:next_end if next_end >= 0 else len(data)].strip() or message["headline"]
+        if not message["headline"]:
+            raise MalformedMessage('no_headline', data[:40])
+        return message
+
+    def sentence_end_at(self, text, start):
+        # Index of the full stop ending the sentence that starts at start, or -1
+        for match in self.SENTENCE_END.finditer(text, start):
+            end = match.start()
+            word_start = max(text.rfind(' ', start, end), text.rfind('\n', start, end)) + 1
+            if text[word_start:end].lower() not in self.ABBREVIATIONS:
+                return end
+        return -1
+
+    @staticmethod
+    def take_regions(text):
+        # (sorted region tags, text without them)
+        if '#' not in text:
+            return [], text
+        return sorted({region.lower() for region in REGION_TAG.findall(text)}), REGION_TAG.sub('', text)
+
+    def parse_structured(self, data):
+        header, separator, text = data[1:].partition('|')
+        if not separator:
+            raise MalformedMessage('no_text', "structured message has no '|' before its text")
+        message = {}
+        regions, text = self.take_regions(text)
+        for field in header.split(';'):
+            name, equals, value = field.partition('=')
+            name = name.strip().lower()
+            value = value.strip()
+            if not name and not equals:
+                continue  # allows a trailing ';'
+            if name not in self.FIELDS or not equals or not value:
+                raise MalformedMessage('bad_field', field)
+            if name == 'type':
+                message["alert_type"] = value
+            elif name == 'severity':
+                if not value.isdigit() or not 1 <= int(value) <= MAX_SEVERITY:
+                    raise MalformedMessage('bad_severity', value)
+                message["severity"] = int(value)
+            elif name == 'area':
+                regions.extend(area.strip().lower() for area in value.split(',') if area.strip())
+            elif name == 'expires':
+                if value.isdigit():
+                    if int(value):  # 0 leaves the default, the same as a binary message's ttl
+                        message["ttl"] = int(value)
+                else:
+                    try:
+                        expires = datetime.datetime.fromisoformat(value)
+                    except ValueError:
+                        raise MalformedMessage('bad_expiry', value) from None
+                    if expires.tzinfo is None:
+                        expires = expires.replace(tzinfo=datetime.timezone.utc)
+                    message["expires_at"] = expires.timestamp()
+            elif name == 'lang':
+                message["lang"] = value
+            else:
+                message["headline"] = value
+        message["info"] = text.strip()
+        message["regions"] = sorted(set(regions))
+        message.setdefault("headline", message["info"])
+        if not message["headline"] and "alert_type" not in message:
+            raise MalformedMessage('no_headline', data[:40])
+        return message
+
+    def parse_binary(self, data):
+        view = memoryview(data)
+        if len(view) < BINARY_MESSAGE.size:
+            raise MalformedMessage('truncated', f"{len(view)} bytes")
+        magic, version, type_code, severity, ttl, area_count = BINARY_MESSAGE.unpack_from(view)
+        if magic != BINARY_MESSAGE_MAGIC or version != BINARY_MESSAGE_VERSION:
+            raise MalformedMessage('bad_version', f"magic {magic:#x} version {version}")
+        if type_code > len(ALERT_TYPES):
+            raise MalformedMessage('unknown_type', f"type code {type_code}")
+        if not 1 <= severity <= MAX_SEVERITY:
+            raise MalformedMessage('bad_severity', str(severity))
+        try:
+            # The areas and then the language tag, each a length byte and UTF-8 text
+            strings = []
+            offset = BINARY_MESSAGE.size
+            for _ in range(area_count + 1):
+                if offset >= len(view):
+                    raise MalformedMessage('truncated', f"{len(view)} bytes")
+                end = offset + 1 + view[offset]
+                if end > len(view):
+                    raise MalformedMessage('truncated', f"{len(view)} bytes")
+                strings.append(str(view[offset + 1:end], 'utf-8'))
+                offset = end
+            info = str(view[offset:], 'utf-8').strip()
+        except UnicodeDecodeError:
+            raise MalformedMessage('invalid_utf8') from None
+        lang = strings.pop()
+        message = {"headline": info, "info": info, "regions": sorted({area.lower() for area in strings if area}),
+                   "severity": severity}
+        if type_code:
+            message["alert_type"] = ALERT_TYPES[type_code - 1]
+        if ttl:
+            message["ttl"] = ttl
+        if lang:
+            message["lang"] = lang
+        return message
+
+
+def encode_binary_message(info, alert_type=None, severity=DEFAULT_SEVERITY, areas=(), ttl=0, lang=''):
+    # Build a binary message for MessageParser. alert_type must be one of ALERT_TYPES or None
+    # to have it classified from info.
+    type_code = ALERT_TYPES.index(alert_type) + 1 if alert_type else 0
+    strings = [string.encode() for string in (*areas, lang)]
+    return b''.join((BINARY_MESSAGE.pack(BINARY_MESSAGE_MAGIC, BINARY_MESSAGE_VERSION, type_code, severity, ttl,
+                                         len(areas)),
+                     *(bytes((len(string),)) + string for string in strings),
+                     info.encode()))
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   AlertClassifier
+#
+# Purpose: Works out the alert type and severity level of an alert message.
+#          All keywords are compiled once into a single regular expression,
+#          so a message is classified in one scan of the text however many
+#          keywords there are. Used by AlertSystem, and classify_many can be
+#          used to reclassify archived messages in bulk.
+#
+# ------------------------------------------------------------------------------ #
+class AlertClassifier:
+    def __init__(self, alert_keywords=ALERT_KEYWORDS, severity_keywords=SEVERITY_KEYWORDS,
+                 precedence=ALERT_PRECEDENCE):
+        # Each keyword gets its own capture group, and group n's (alert type, severity)
+        # is entry n-1 in the table, so a match is looked up without copying or lowercasing text
+        keywords = sorted(set(alert_keywords) | set(severity_keywords), key=len, reverse=True)
+        self.table = [(alert_keywords.get(keyword), severity_keywords.get(keyword)) for keyword in keywords]
+        # Longest keywords go first so "flooding" is preferred over "flood". Hazard keywords
+        # match the start of a word, taking in "flooded" and "floodwaters", while severity
+        # words must be whole words (or plurals) so "high" doesn't match "highway".
+        alternation = '|'.join('(' + re.escape(keyword) + (r')\w*' if keyword in alert_keywords else r')(?:e?s)?\b')
+                               for keyword in keywords)
+        self.pattern = re.compile(r'\b(?:' + alternation + ')', re.IGNORECASE)
+        # Alert types missing from the precedence list rank after those in it
+        self.rank = {alert_type: rank for rank, alert_type in enumerate(precedence)}
+        self.unranked = len(precedence)
+        # Types alerts can have: those found by the keywords and those the display knows.
+        # type_names looks them up case insensitively for messages that state their type.
+        self.alert_types = set(alert_keywords.values()) | set(ALERT_TYPES)
+        self.type_names = {alert_type.lower(): alert_type for alert_type in self.alert_types}
+
+    def classify(self, alert_string):
+        # Returns (alert type or None, severity level)
+        table = self.table
+        rank = self.rank
+        alert_type = None
+        alert_rank = self.unranked + 1
+        severity = 0
+        for match in self.pattern.finditer(alert_string):
+            keyword_type, keyword_severity = table[match.lastindex - 1]
+            if keyword_type is not None:
+                keyword_rank = rank.get(keyword_type, self.unranked)
+                if keyword_rank < alert_rank:
+                    alert_type, alert_rank = keyword_type, keyword_rank
+            if keyword_severity is not None and keyword_severity > severity:
+                severity = keyword_severity
+        return alert_type, severity or DEFAULT_SEVERITY
+
+    def classify_many(self, alert_strings):
+        # Classify a batch of messages. Archived feeds repeat the same bulletins a lot,
+        # so each distinct message is only scanned once.
+        results = {}
+        classify = self.classify
+        classified = []
+        for alert_string in alert_strings:
+            result = results.get(alert_string)
+            if result is None:
+                result = results[alert_string] = classify(alert_string)
+            classified.append(result)
+        return classified
+
+
+def load_classifier(path):
+    # Build an AlertClassifier from a JSON rule file with "alert_keywords",
+    # "severity_keywords" and optionally "precedence". Raises ValueError if the file
+    # is not a valid rule table, so a bad edit never replaces working rules.
+    with open(path, encoding='utf-8') as rules_file:
+        try:
+            rules = json.load(rules_file)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path} is not valid JSON: {e}") from None
+
+    alert_keywords = rules.get('alert_keywords', {})
+    severity_keywords = rules.get('severity_keywords', {})
+    precedence = rules.get('precedence', [])
+    if not isinstance(alert_keywords, dict) or not all(
+            isinstance(keyword, str) and keyword and isinstance(alert_type, str)
+            for keyword, alert_type in alert_keywords.items()):
+        raise ValueError(f"{path}: alert_keywords must map keywords to alert types")
+    if not isinstance(severity_keywords, dict) or not all(
+            isinstance(keyword, str) and keyword and type(level) is int and 1 <= level <= MAX_SEVERITY
+            for keyword, level in severity_keywords.items()):
+        raise ValueError(f"{path}: severity_keywords must map keywords to levels 1 to {MAX_SEVERITY}")
+    if not isinstance(precedence, list) or not all(isinstance(alert_type, str) for alert_type in precedence):
+        raise ValueError(f"{path}: precedence must be a list of alert types")
+    if not alert_keywords and not severity_keywords:
+        raise ValueError(f"{path} does not contain any keywords")
+
+    try:
+        return AlertClassifier(alert_keywords, severity_keywords, precedence)
+    except re.error as e:
+        raise ValueError(f"{path}: keywords could not be compiled: {e}") from None
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   RuleFileWatcher
+#
+# Purpose: Reloads the classifier rules when the rule file changes. A new
+#          AlertClassifier is built in the background and then swapped in
+#          with a single assignment, so alerts being classified at the time
+#          carry on with the old rules and the hot path never takes a lock.
+#
+# ------------------------------------------------------------------------------ #
+class RuleFileWatcher:
+    def __init__(self, alert_system, path=RULES_FILE, interval=RULES_POLL_INTERVAL):
+        self.alert_system = alert_system
+        self.path = path
+        self.interval = interval
+        self.last_seen = None
+        self.stop_event = threading.Event()
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self):
+        # Load the rule file now. Returns True if the rules were swapped in.
+        self.last_seen = self.file_signature()
+        try:
+            classifier = load_classifier(self.path)
+        except (OSError, ValueError) as e:
+            log.event('rules_rejected', path=self.path, error=str(e))
+            return False
+        self.alert_system.classifier = classifier
+        log.event('rules_loaded', path=self.path)
+        return True
+
+    def watch(self):
+        while not self.stop_event.wait(self.interval):
+            signature = self.file_signature()
+            if signature is not None and signature != self.last_seen:
+                self.reload()
+
+    def start(self):
+        self.reload()
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   Histogram
+#
+# Purpose: Timing histogram with fixed, doubling buckets from 1us to about
+#          17s. Recording a value is a bisect and an increment, so it can be
+#          used on the hot path. Percentiles are estimated from the buckets.
+#
+# ------------------------------------------------------------------------------ #
+class Histogram:
+    bounds = [0.000001 * 2 ** i for i in range(25)]  # upper bound of each bucket in seconds
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket holds anything slower
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the given fraction of values
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(self.bounds[bucket], self.max) if bucket < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "mean_us": round(self.total / self.count * 1e6, 2) if self.count else None,
+                "p50_us": round(self.percentile(0.5) * 1e6, 2) if self.count else None,
+                "p99_us": round(self.percentile(0.99) * 1e6, 2) if self.count else None,
+                "max_us": round(self.max * 1e6, 2)}
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   PipelineMetrics
+#
+# Purpose: Counters and per-stage timing histograms for the alert pipeline:
+#          accept, auth, parse, classify, draw and received_to_drawn, plus
+#          gauges read when a snapshot is taken (the alert queue registers
+#          its stats as one). Shared through the module level metrics
+#          object and read through MetricsServer or MetricsSnapshotWriter.
+#
+# ------------------------------------------------------------------------------ #
+class PipelineMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}  # name: function returning the current value
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {"time": time.time(), "uptime_s": round(time.time() - self.started, 1),
+                        "counters": dict(sorted(self.counters.items())),
+                        "stages": {stage: histogram.snapshot() for stage, histogram in sorted(self.histograms.items())}}
+        snapshot["gauges"] = {name: gauge() for name, gauge in self.gauges.items()}
+        return snapshot
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
             return
-        if not '.' in data: #checking if there if the alert message doesnt stick to normal structure with a period
-            alert_severity = self.get_severity_level(data)
-            type_of_alert = self.get_alert_type(data)
-            new_alert = {"alert_type":type_of_alert,"severity":alert_severity,"info":data}
-            self.display.draw_content(new_alert)
+        body = json.dumps(self.server.metrics.snapshot(), default=str).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes aren't worth a log line each
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   MetricsServer
+#
+# Purpose: Serves a JSON snapshot of the pipeline metrics at /metrics on a
+#          local port, for pulling from monitoring or by hand with curl.
+#
+# ------------------------------------------------------------------------------ #
+class MetricsServer:
+    def __init__(self, pipeline_metrics, host='127.0.0.1', port=METRICS_PORT):
+        self.httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = pipeline_metrics
+        self.port = self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        log.event('metrics_serving', port=self.port)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   MetricsSnapshotWriter
+#
+# Purpose: Periodically writes a metrics snapshot to a JSON file, replacing
+#          it in one step so readers never see a half written file.
+#
+# ------------------------------------------------------------------------------ #
+class MetricsSnapshotWriter:
+    def __init__(self, pipeline_metrics, path, interval=METRICS_SNAPSHOT_INTERVAL):
+        self.metrics = pipeline_metrics
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def write(self):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as snapshot_file:
+            json.dump(self.metrics.snapshot(), snapshot_file, default=str)
+        os.replace(temporary_path, self.path)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                log.event('metrics_snapshot_failed', path=self.path, error=str(e))
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   StructuredLogger
+#
+# Purpose: Replaces the print calls on the hot path. Each event is a JSON
+#          line with a name and fields. Events are queued and written by a
+#          background thread so stdout I/O never holds up the pipeline, and
+#          each event name is rate limited by a token bucket, with the
+#          number of records dropped reported on the next one let through.
+#
+# ------------------------------------------------------------------------------ #
+class StructuredLogger:
+    def __init__(self, stream=None, rate=LOG_RATE, burst=LOG_BURST):
+        self.stream = stream  # None writes to whatever sys.stdout is at the time
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # event name: [tokens, last refill time, records suppressed]
+        self.lock = threading.Lock()
+        self.records = queue.SimpleQueue()
+        self.writer = None
+        self.forwarder = None  # set in an ingest worker, records are written by the display process
+
+    def event(self, name, **fields):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                bucket = self.buckets[name] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            fields['suppressed'] = suppressed
+        if self.forwarder is not None:
+            self.forwarder.send('log', (time.time(), name, fields))
         else:
-            first_period_index = data.find('.')
-            second_period_index = data.find('.',first_period_index+1)
-            action_needed = data[first_period_index+1:second_period_index] # gets the info/action needed for alert
-            alert = data[:first_period_index] #gets the alert message itself
-            alert_severity = self.get_severity_level(alert)
-            type_of_alert = self.get_alert_type(alert)
-            new_alert = {"alert_type":type_of_alert,"severity":alert_severity,"info":action_needed}
-            self.display.draw_content(new_alert)
+            self.write((time.time(), name, fields))
+
+    def write(self, record):
+        # Queue a (time, event name, fields) record for the writer thread
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_records, daemon=True)
+                self.writer.start()
+        self.records.put(record)
+
+    def write_records(self):
+        while True:
+            timestamp, name, fields = self.records.get()
+            stream = self.stream or sys.stdout
+            stream.write(json.dumps({"time": round(timestamp, 6), "event": name, **fields}, default=str) + '\n')
+            if self.records.empty():
+                stream.flush()
+
+
+# Shared by every class in this file
+metrics = PipelineMetrics()
+log = StructuredLogger()
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   HostAllowlist
+#
+# Purpose: Set of allowed sender addresses and CIDR networks, compiled so a
+#          lookup costs one set lookup per distinct prefix length rather
+#          than a scan of the list. Used as `address in allowlist`.
+#
+# ------------------------------------------------------------------------------ #
+class HostAllowlist:
+    def __init__(self, entries):
+        self.addresses = set()  # exact addresses as strings, matched without parsing
+        self.networks = {}  # (ip version, prefix length): set of network addresses as ints
+        for entry in entries:
+            network = ipaddress.ip_network(entry, strict=False)
+            if network.prefixlen == network.max_prefixlen:
+                self.addresses.add(str(network.network_address))
+            else:
+                self.networks.setdefault((network.version, network.prefixlen), set()).add(
+                    int(network.network_address))
+        self.masks = {(version, prefix_length): ((1 << bits) - 1) ^ ((1 << (bits - prefix_length)) - 1)
+                      for version, prefix_length in self.networks
+                      for bits in [32 if version == 4 else 128]}
+
+    def __contains__(self, address):
+        if address in self.addresses:
+            return True
+        if not self.networks:
+            return False
+        try:
+            parsed = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        if parsed.version == 6 and parsed.ipv4_mapped is not None:
+            parsed = parsed.ipv4_mapped
+            if str(parsed) in self.addresses:
+                return True
+        value = int(parsed)
+        for key, network_values in self.networks.items():
+            if key[0] == parsed.version and value & self.masks[key] in network_values:
+                return True
+        return False
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   ReplayCache
+#
+# Purpose: Remembers the nonces of authenticated frames for the length of
+#          the replay window, so a captured frame can't be sent again. Old
+#          entries are dropped from the front as they expire. If the cache
+#          fills with live nonces new frames are refused rather than
+#          forgetting nonces that could still be replayed.
+#
+# ------------------------------------------------------------------------------ #
+class ReplayCache:
+    def __init__(self, maxsize=REPLAY_CACHE_SIZE, window=REPLAY_WINDOW):
+        self.maxsize = maxsize
+        self.window = window
+        self.nonces = OrderedDict()  # nonce: time it can be forgotten, in arrival order
+        self.lock = threading.Lock()
+
+    def add(self, nonce, timestamp):
+        # Returns False if the nonce was already seen (or the cache is full)
+        now = time.time()
+        with self.lock:
+            while self.nonces:
+                oldest, expires = next(iter(self.nonces.items()))
+                if expires > now:
+                    break
+                del self.nonces[oldest]
+            if nonce in self.nonces or len(self.nonces) >= self.maxsize:
+                return False
+            self.nonces[nonce] = max(timestamp, now) + self.window
+            return True
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   SharedReplayCache
+#
+# Purpose: ReplayCache shared by the ingest worker processes, so a frame
+#          replayed on a connection that lands on another worker is still
+#          refused. Nonces live in a fixed table of REPLAY_SLOT entries in
+#          shared memory, each nonce in one of REPLAY_PROBES slots from its
+#          hash, and expired slots are reused. Like ReplayCache, a nonce
+#          with no free slot is refused rather than forgetting live ones.
+#          Create it before starting the workers and pass it to them.
+#
+# ------------------------------------------------------------------------------ #
+class SharedReplayCache:
+    def __init__(self, maxsize=REPLAY_CACHE_SIZE, window=REPLAY_WINDOW, context=multiprocessing):
+        self.slots = 2 * maxsize  # half empty, so probing rarely runs out of slots
+        self.window = window
+        self.table = context.RawArray('B', self.slots * REPLAY_SLOT.size)
+        self.lock = context.Lock()
+
+    def add(self, nonce, timestamp):
+        # Returns False if the nonce was already seen (or its slots are full)
+        now = time.time()
+        first = int.from_bytes(nonce[:8], 'big') % self.slots
+        free = None
+        with self.lock:
+            for probe in range(REPLAY_PROBES):
+                offset = (first + probe) % self.slots * REPLAY_SLOT.size
+                seen, expires = REPLAY_SLOT.unpack_from(self.table, offset)
+                if expires <= now:
+                    if free is None:
+                        free = offset
+                elif seen == nonce:
+                    return False
+            if free is None:
+                return False
+            REPLAY_SLOT.pack_into(self.table, free, nonce, max(timestamp, now) + self.window)
+            return True
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   RateLimiter
+#
+# Purpose: Token bucket per source address. Each packet costs one token and
+#          tokens refill at rate per second up to burst. Only the most
+#          recently seen sources are tracked, so a flood of spoofed sources
+#          can't grow it without limit.
+#
+# ------------------------------------------------------------------------------ #
+class RateLimiter:
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, max_sources=RATE_LIMIT_SOURCES):
+        self.rate = rate
+        self.burst = burst
+        self.max_sources = max_sources
+        self.buckets = OrderedDict()  # source: [tokens, last refill time]
+        self.lock = threading.Lock()
+
+    def allow(self, source):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(source)
+            if bucket is None:
+                bucket = self.buckets[source] = [self.burst, now]
+                if len(self.buckets) > self.max_sources:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(source)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
 
 
 # ------------------------------------------------------------------------------ #
@@ -129,38 +1503,61 @@ class AlertSystem:
 #
 # ------------------------------------------------------------------------------ #
 class AlertReceiver:
-    def __init__(self, host='0.0.0.0', port=PORT):
+    def __init__(self, host='0.0.0.0', port=PORT, allowed_hosts=ALLOWED_HOSTS, auth_code=AUTH_CODE,
+                 hmac_key=None, rate=RATE_LIMIT, burst=RATE_BURST, reuse_port=False):
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port  # share the port with other receivers (SO_REUSEPORT), see IngestWorkerPool
         self.alert_handler = None
+        self.serving = threading.Event()  # set once serve_async is accepting connections
+
+        # Authentication. With an hmac_key only version 2 (HMAC) frames are accepted,
+        # without one legacy packets and version 1 frames are checked against auth_code.
+        self.allowlist = HostAllowlist(allowed_hosts)
+        self.auth_code = auth_code
+        self.hmac_key = hmac_key
+        self.replay_cache = ReplayCache()
+        self.rate_limiter = RateLimiter(rate, burst)
 
     def set_alert_handler(self, alert_handler):
         self.alert_handler = alert_handler
 
     def send_received_data(self, data):
-        # Send verified data to the alert system for further processing
-        self.alert_handler.process_data(data)
+        # Send verified data to the alert system for further processing. Returns False if the
+        # handler rejected it as malformed.
+        return self.alert_handler.process_data(data)
 
     def verify_host(self, address):
-        # Verify host
-        intended_hosts = ['127.0.0.1', '192.168.1.1']  # Add intended hosts here
-        if address not in intended_hosts:
-            return False
-        else:
-            return True
+        # Verify host against the allowed hosts and networks
+        return address in self.allowlist
 
     def verify_data(self, data):
-        # Verify authentication code
-        auth_code = data[:4]
-        if auth_code != b"1111":
+        # Verify authentication code. Legacy auth codes are refused once HMAC frames are
+        # required, and the comparison takes the same time wherever the codes differ.
+        if self.hmac_key is not None:
             return False
-        else:
-            return True
+        return hmac.compare_digest(data[:4], self.auth_code)
+
+    def verify_mac(self, header, payload):
+        # Verify a version 2 frame: its MAC matches, then its timestamp is within the replay
+        # window and its nonce hasn't been seen before. The MAC goes first so a forgery is
+        # always an auth failure, never counted as a replay. Returns an ack status.
+        if self.hmac_key is None:
+            return ACK_AUTH_FAILED
+        timestamp, nonce, mac = FRAME_HEADER_HMAC.unpack(header)[4:]
+        expected = hmac.digest(self.hmac_key, header[:-MAC_SIZE] + payload, 'sha256')[:MAC_SIZE]
+        if not hmac.compare_digest(mac, expected):
+            return ACK_AUTH_FAILED
+        if abs(time.time() - timestamp / 1000) > REPLAY_WINDOW:
+            return ACK_REPLAYED
+        if not self.replay_cache.add(nonce, timestamp / 1000):
+            return ACK_REPLAYED
+        return ACK_OK
 
     def verify_connection(self, data, address):
         # Implement the logic to verify that the connection comes from an intended host
         # and contains the correct authentication keys
-        if self.verify_data(data) and self.verify_connection(address):
+        if self.verify_data(data) and self.verify_host(address[0]):
             return True
         else:
             return False
@@ -170,19 +1567,564 @@ class AlertReceiver:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.bind((self.host, self.port))
             s.listen()
-            print(f"Listening on {self.host}:{self.port}...")
+            log.event('listening', host=self.host, port=self.port)
 
             while True:
                 conn, addr = s.accept()
                 with conn:
-                    print(f"Connected by {addr}")
+                    metrics.count('connections')
+                    log.event('connected', addr=addr)
+                    if not self.admit(addr):
+                        continue
                     data = conn.recv(1024)
                     if self.verify_connection(data, addr):
                         self.send_received_data(data[4:].decode())  # Remove auth code before sending
                     else:
-                        print(f"Connection from {addr} not verified or authentication failed.")
+                        metrics.count('auth_failures')
+                        log.event('auth_failed', addr=addr)
                 time.sleep(1)
 
+    def run_async(self):
+        # Blocking entry point for serve_async, so it can be the target of a thread like listen
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self, max_connections=MAX_CONNECTIONS, read_timeout=READ_TIMEOUT):
+        # Concurrent alternative to listen. Every sender gets its own coroutine and read
+        # timeout, so one slow client no longer stalls the others. Once max_connections are
+        # in flight, further connections wait for a slot without being read, which holds
+        # the senders back through TCP flow control instead of buffering their data here.
+        self.read_timeout = read_timeout
+        self.connection_slots = asyncio.Semaphore(max_connections)
+        # process_data draws to the display, so verified data is still handed over one
+        # packet at a time, just off the event loop
+        self.handler_executor = ThreadPoolExecutor(max_workers=1)
+
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                            reuse_port=self.reuse_port or None)
+        self.port = server.sockets[0].getsockname()[1]  # the port picked by the OS if port was 0
+        self.serving.set()
+        log.event('listening', host=self.host, port=self.port, mode='async')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.handler_executor.shutdown(wait=False)
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        metrics.count('connections')
+        accepted = time.perf_counter()
+        async with self.connection_slots:
+            metrics.observe('accept', time.perf_counter() - accepted)  # time spent waiting for a slot
+            try:
+                log.event('connected', addr=addr)
+                if not self.admit(addr):
+                    return
+                try:
+                    magic = await asyncio.wait_for(reader.readexactly(len(FRAME_MAGIC)), self.read_timeout)
+                except asyncio.TimeoutError:
+                    metrics.count('timeouts')
+                    log.event('timed_out', addr=addr)
+                    return
+                except asyncio.IncompleteReadError as e:
+                    magic = e.partial  # sender closed early, treat what arrived as a legacy packet
+
+                if magic == FRAME_MAGIC:
+                    await self.handle_framed_session(reader, writer, addr)
+                else:
+                    await self.handle_legacy_packet(reader, addr, magic)
+            except ConnectionError as e:
+                log.event('connection_dropped', addr=addr, error=str(e))
+            finally:
+                writer.close()
+
+    def admit(self, addr):
+        # Cheap checks made before any data is read: the sender must be an allowed host
+        # and within its rate limit, otherwise the connection is closed straight away
+        if not self.verify_host(addr[0]):
+            metrics.count('auth_failures')
+            log.event('host_rejected', addr=addr)
+            return False
+        if not self.rate_limiter.allow(addr[0]):
+            metrics.count('rate_limited')
+            log.event('rate_limited', addr=addr)
+            return False
+        return True
+
+    async def handle_legacy_packet(self, reader, addr, head):
+        # One space padded packet per connection, as sent by create_test_packet
+        try:
+            data = head + await asyncio.wait_for(self.read_packet(reader, PACKET_SIZE - len(head)),
+                                                 self.read_timeout)
+        except asyncio.TimeoutError:
+            metrics.count('timeouts')
+            log.event('timed_out', addr=addr)
+            return
+        await self.process_packet(data, addr)
+
+    async def handle_framed_session(self, reader, writer, addr):
+        # Persistent connection carrying any number of frames. Frames are handled in order
+        # and every one is acknowledged by message id, so a sender can pipeline a burst
+        # and match up the acks as they come back.
+        consumed = FRAME_MAGIC  # the magic of the first frame was read by handle_connection
+        while True:
+            try:
+                prefix = consumed + await asyncio.wait_for(reader.readexactly(FRAME_PREFIX_SIZE - len(consumed)),
+                                                           IDLE_TIMEOUT)
+                consumed = b''
+                magic, version = prefix[:2], prefix[2]
+                header_format = FRAME_HEADER_HMAC if version == PROTOCOL_VERSION_HMAC else FRAME_HEADER
+                if magic == FRAME_MAGIC and version in (PROTOCOL_VERSION, PROTOCOL_VERSION_HMAC):
+                    header = prefix + await asyncio.wait_for(reader.readexactly(header_format.size - FRAME_PREFIX_SIZE),
+                                                             self.read_timeout)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    metrics.count('parse_failures')
+                    log.event('truncated_frame', addr=addr)
+                return
+            except asyncio.TimeoutError:
+                log.event('idle_closed', addr=addr)
+                return
+
+            if magic != FRAME_MAGIC:
+                metrics.count('parse_failures')
+                log.event('lost_frame_sync', addr=addr)
+                return
+            if version not in (PROTOCOL_VERSION, PROTOCOL_VERSION_HMAC):
+                # The stream can't be resynchronised after a bad header, so drop the connection
+                metrics.count('parse_failures')
+                log.event('unsupported_frame', addr=addr, version=version)
+                return
+            if version == PROTOCOL_VERSION:
+                auth_code, message_id, length = FRAME_HEADER.unpack(header)[2:]
+            else:
+                message_id, length = FRAME_HEADER_HMAC.unpack(header)[2:4]
+            if length > MAX_FRAME_PAYLOAD:
+                metrics.count('parse_failures')
+                log.event('unsupported_frame', addr=addr, version=version, length=length)
+                return
+
+            try:
+                payload = await asyncio.wait_for(reader.readexactly(length), self.read_timeout)
+            except asyncio.IncompleteReadError:
+                metrics.count('parse_failures')
+                log.event('truncated_frame', addr=addr, message_id=message_id)
+                return
+            except asyncio.TimeoutError:
+                metrics.count('timeouts')
+                log.event('timed_out', addr=addr, message_id=message_id)
+                return
+
+            metrics.count('frames')
+            if not self.rate_limiter.allow(addr[0]):
+                # Refused before any authentication or decoding work
+                metrics.count('rate_limited')
+                log.event('rate_limited', addr=addr, message_id=message_id)
+                status = ACK_RATE_LIMITED
+            elif version == PROTOCOL_VERSION:
+                status = await self.process_packet(auth_code + payload, addr)
+            else:
+                started = time.perf_counter()
+                status = self.verify_mac(header, payload)
+                metrics.observe('auth', time.perf_counter() - started)
+                if status == ACK_OK:
+                    status = await self.process_alert(payload, addr)
+                else:
+                    metrics.count('replays' if status == ACK_REPLAYED else 'auth_failures')
+                    log.event('replayed' if status == ACK_REPLAYED else 'auth_failed', addr=addr,
+                              message_id=message_id)
+            writer.write(ACK_FRAME.pack(FRAME_MAGIC, version, message_id, status))
+            await writer.drain()  # stop reading if the sender isn't collecting its acks
+
+    async def process_packet(self, data, addr):
+        # Verify a packet (auth code followed by the alert text) and pass it on to the
+        # alert handler. Returns the ack status for the framed protocol.
+        started = time.perf_counter()
+        verified = self.verify_connection(data, addr)
+        metrics.observe('auth', time.perf_counter() - started)
+        if not verified:
+            metrics.count('auth_failures')
+            log.event('auth_failed', addr=addr)
+            return ACK_AUTH_FAILED
+        return await self.process_alert(data[4:], addr)  # Remove auth code before sending
+
+    async def process_alert(self, payload, addr):
+        # Decode verified alert text and hand it to the alert handler. Binary messages are
+        # handed over as bytes.
+        if payload[:1] == bytes((BINARY_MESSAGE_MAGIC,)):
+            alert_data = bytes(payload)
+        else:
+            try:
+                alert_data = payload.decode()
+            except UnicodeDecodeError:
+                metrics.count('parse_failures')
+                log.event('invalid_utf8', addr=addr)
+                return ACK_BAD_DATA
+
+        loop = asyncio.get_running_loop()
+        accepted = await loop.run_in_executor(self.handler_executor, self.send_received_data, alert_data)
+        return ACK_BAD_DATA if accepted is False else ACK_OK
+
+    async def read_packet(self, reader, size=PACKET_SIZE):
+        # Read size bytes, or whatever arrived before the sender closed. Unlike a single
+        # recv this does not cut packets that arrive split over several TCP segments.
+        chunks = []
+        remaining = size
+        while remaining:
+            chunk = await reader.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   AlertForwarder
+#
+# Purpose: The ingest worker's end of the pipe to the display process. It
+#          sends each processed alert, the worker's log records, and every
+#          WORKER_METRICS_INTERVAL a snapshot of the worker's metrics, as
+#          (kind, payload) messages.
+#
+# ------------------------------------------------------------------------------ #
+class AlertForwarder:
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()  # alerts and metrics are sent from different threads
+
+    def send(self, kind, payload):
+        with self.lock:
+            self.connection.send((kind, payload))
+
+    def report(self, receiver, interval=WORKER_METRICS_INTERVAL):
+        receiver.serving.wait()
+        self.send('serving', receiver.port)
+        while True:
+            self.send('metrics', metrics.snapshot())
+            time.sleep(interval)
+
+
+def run_ingest_worker(index, receiver_options, replay_cache, connection):
+    # Entry point of an ingest worker process: a receiver on the shared port doing
+    # authentication, decoding, parsing and classification, with its alerts forwarded
+    forwarder = AlertForwarder(connection)
+    log.forwarder = forwarder
+    alert_system = AlertSystem()
+    alert_system.attach_forwarder(forwarder)
+    receiver = AlertReceiver(reuse_port=True, **receiver_options)
+    receiver.replay_cache = replay_cache
+    receiver.set_alert_handler(alert_system)
+    alert_system.attach_receiver(receiver)
+    if os.path.exists(RULES_FILE):
+        RuleFileWatcher(alert_system).start()
+    log.event('ingest_worker_started', worker=index, pid=os.getpid())
+    threading.Thread(target=forwarder.report, args=(receiver,), daemon=True).start()
+    receiver.run_async()
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   IngestWorkerPool
+#
+# Purpose: Spreads receiving over several processes for gateways that many
+#          senders report to. Each worker runs its own AlertReceiver on the
+#          same port with SO_REUSEPORT, so the kernel shares connections out
+#          between them, and does the authentication, decoding, parsing and
+#          classification on its own core. Processed alerts come back over a
+#          pipe per worker and are dispatched here, in the display process,
+#          which alone journals, schedules and draws them. The alert queue
+#          orders each burst by severity and time received, so alerts from
+#          different workers are shown in the same order as with one
+#          receiver. Nonces are checked in a SharedReplayCache. Rate limits
+#          are kept by each worker, so a source whose connections land on
+#          different workers gets up to that many times the limit.
+#
+# ------------------------------------------------------------------------------ #
+class IngestWorkerPool:
+    def __init__(self, alert_system, workers=INGEST_WORKERS, host='0.0.0.0', port=PORT, **receiver_options):
+        self.alert_system = alert_system
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.receiver_options = receiver_options  # passed on to each worker's AlertReceiver
+        # Spawned rather than forked, as the display process already runs threads
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = []
+        self.connections = {}  # pipe from a worker: worker index
+        self.worker_metrics = {}  # worker index: latest metrics snapshot
+        self.serving = threading.Event()  # set once every worker is accepting connections
+        self.started = 0
+        self.forwarded = 0
+
+    def start(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError("SO_REUSEPORT is not supported on this platform")
+        # Hold the port while the workers start, so with port 0 they all get the same one
+        reservation = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        reservation.bind((self.host, self.port))
+        self.port = reservation.getsockname()[1]
+        self.reservation = reservation
+
+        # Kept here too, the lock's semaphore goes away with the last reference in this process
+        self.replay_cache = SharedReplayCache(context=self.context)
+        options = dict(self.receiver_options, host=self.host, port=self.port)
+        for index in range(self.workers):
+            reader, writer = self.context.Pipe(duplex=False)
+            process = self.context.Process(target=run_ingest_worker, args=(index, options, self.replay_cache, writer),
+                                           name=f'ingest-{index}', daemon=True)
+            process.start()
+            writer.close()  # the worker holds the only write end, so its exit ends the pipe
+            self.processes.append(process)
+            self.connections[reader] = index
+        metrics.gauges['ingest_workers'] = self.stats
+        threading.Thread(target=self.forward_loop, daemon=True).start()
+        log.event('listening', host=self.host, port=self.port, mode='workers', workers=self.workers)
+
+    def forward_loop(self):
+        while self.connections:
+            for connection in multiprocessing.connection.wait(list(self.connections)):
+                index = self.connections[connection]
+                try:
+                    kind, payload = connection.recv()
+                except (EOFError, OSError):
+                    del self.connections[connection]
+                    metrics.count('ingest_workers_exited')
+                    log.event('ingest_worker_exited', worker=index, exitcode=self.processes[index].exitcode)
+                    continue
+                if kind == 'alert':
+                    self.forwarded += 1
+                    try:
+                        self.alert_system.dispatch_alert(payload)
+                    except Exception as e:  # keep forwarding the other workers' alerts
+                        metrics.count('dispatch_failures')
+                        log.event('dispatch_failed', worker=index, error=repr(e))
+                elif kind == 'log':
+                    timestamp, name, fields = payload
+                    log.write((timestamp, name, dict(fields, worker=index)))
+                elif kind == 'metrics':
+                    self.worker_metrics[index] = payload
+                elif kind == 'serving':
+                    self.started += 1
+                    if self.started == self.workers:
+                        self.reservation.close()
+                        self.serving.set()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def stats(self):
+        # Counters summed over the workers, from their latest snapshots
+        counters = {}
+        for snapshot in list(self.worker_metrics.values()):
+            for name, value in snapshot["counters"].items():
+                counters[name] = counters.get(name, 0) + value
+        return {"workers": self.workers, "alive": sum(process.is_alive() for process in self.processes),
+                "forwarded": self.forwarded, "counters": dict(sorted(counters.items()))}
+
+
+def spokes(centre_x, centre_y, ends, options):
+    # One straight create_line from the centre to each end, for the rays of the sun, typhoon and viruses
+    return [('create_line', (centre_x, centre_y, end_x, end_y), options) for end_x, end_y in ends]
+
+
+@functools.lru_cache(maxsize=None)
+def icon_shapes(width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+    # The drawing for each icon, and the triangle framing them, as tuples of (canvas method,
+    # coordinates, options) worked out once for a canvas size. The trigonometry happens here
+    # rather than on every draw, zigzags are single polylines, and the triangle is drawn once,
+    # last, over the icon.
+    side_length = min(width, height) - 40
+    triangle_height = (math.sqrt(3) / 2) * side_length
+    top_x, top_y = width // 2, height // 4 - triangle_height / 2
+    left_x, left_y = width // 2 - side_length / 2, height // 4 + triangle_height / 2
+    right_x, right_y = width // 2 + side_length / 2, height // 4 + triangle_height / 2
+    centre_x, centre_y = (top_x + left_x + right_x) // 3, (top_y + left_y + right_y) // 3
+    triangle = (('create_line', (top_x, top_y, left_x, left_y, right_x, right_y, top_x, top_y),
+                 {'fill': 'red', 'width': 7}),)
+
+    def title(text):
+        return ('create_text', (width // 2, 25 + height // 2), {'text': text, 'fill': 'black',
+                                                                 'font': ("Arial", 16, "bold")})
+
+    # Warning: an exclamation mark
+    exclamation_width, exclamation_height, exclamation_radius = 5, 30, 5
+    warning = (
+        ('create_rectangle', (centre_x - exclamation_width // 2, centre_y - exclamation_height,
+                              centre_x + exclamation_width // 2, centre_y), {'fill': 'black'}),
+        ('create_oval', (centre_x - exclamation_radius, centre_y + 7,
+                         centre_x + exclamation_radius, centre_y + 7 + 2 * exclamation_radius), {'fill': 'black'}),
+        title("WARNING"))
+
+    # Flood: a house with a door and roof, standing in water
+    house_size, door_height, door_width = 20, 8, 4
+    house_left, house_top = centre_x - house_size // 2, centre_y - house_size // 2 - 6
+    house_right, house_bottom = centre_x + house_size // 2, centre_y + house_size // 2 - 6
+    roof_left, roof_right, roof_top = house_left - 5, house_right + 5, house_top - 12
+    flood = (
+        ('create_line', (house_left - 26, house_bottom + 6, house_right + 26, house_bottom + 6),
+         {'fill': 'black', 'width': 3}),
+        ('create_line', (house_left - 26, house_bottom + 13, house_right + 26, house_bottom + 13),
+         {'fill': 'black', 'width': 3}),
+        ('create_rectangle', (house_left, house_top + 2, house_right, house_bottom + 2),
+         {'outline': 'black', 'fill': 'black'}),
+        ('create_rectangle', (centre_x - door_width // 2, centre_y - door_height // 2 + 2,
+                              centre_x + door_width // 2, centre_y + door_height // 2 + 2),
+         {'outline': 'white', 'fill': 'white'}),
+        ('create_line', (roof_left + 2, house_top, centre_x, roof_top, roof_right - 2, house_top,
+                         roof_left + 2, house_top), {'fill': 'black', 'width': 4}),
+        ('create_line', (roof_left + 7, house_top - 3, centre_x, roof_top + 3, roof_right - 7, house_top - 3,
+                         roof_left + 7, house_top - 3), {'fill': 'black', 'width': 6}),
+        title("FLOOD"))
+
+    # Typhoon: two spirals of rays from the centre, each ray longer than the last
+    ends = []
+    for i in range(24):
+        angle, length = math.radians(10 * i), 7 + 0.5 * i
+        ends.append((centre_x + length * math.cos(angle), centre_y + length * math.sin(angle)))
+        ends.append((centre_x - length * math.cos(-angle), centre_y + length * math.sin(-angle)))
+    typhoon = (*spokes(centre_x, centre_y, ends, {'fill': 'black', 'width': 4}), title("TYPHOON"))
+
+    # Heatwave: a sun with rays and three zigzag heat waves
+    sun_radius, wave_amplitude, wave_segments = 13, 3, 8
+    segment_length = 36 / wave_segments
+    rays = [(centre_x + (sun_radius + 5) * math.cos(math.radians(angle)),
+             centre_y + (sun_radius + 5) * math.sin(math.radians(angle))) for angle in range(0, 360, 45)]
+    heatwave = [*spokes(centre_x, centre_y, rays, {'fill': 'black', 'width': 5}),
+                ('create_oval', (centre_x - sun_radius, centre_y - sun_radius,
+                                 centre_x + sun_radius, centre_y + sun_radius), {'fill': 'black'})]
+    for wave_offset in (-6, 4, 14):
+        coords = [centre_x - 18, centre_y + wave_offset]
+        for i in range(wave_segments):
+            coords += (centre_x - 18 + (i + 0.5) * segment_length, centre_y + wave_amplitude * (-1) ** i + wave_offset,
+                       centre_x - 18 + (i + 1) * segment_length, centre_y + wave_offset)
+        heatwave.append(('create_line', tuple(coords), {'fill': 'red', 'width': 2}))
+    heatwave = (*heatwave, title("HEATWAVE"))
+
+    # Disease: three virus particles, a disc with eight spikes
+    disease = []
+    for virus_x, virus_y, radius, spike_length, spike_width in (
+            (top_x - 10, centre_y + 7, 9, 4, 3), (centre_x + 3, top_y + 35, 6, 3, 2), (top_x + 13, centre_y + 5, 4, 3, 2)):
+        spikes = [(virus_x + (radius + spike_length) * math.cos(math.radians(angle)),
+                   virus_y + (radius + spike_length) * math.sin(math.radians(angle))) for angle in range(0, 360, 45)]
+        disease += spokes(virus_x, virus_y, spikes, {'fill': 'black', 'width': spike_width})
+        disease.append(('create_oval', (virus_x - radius, virus_y - radius, virus_x + radius, virus_y + radius),
+                        {'fill': 'black', 'outline': 'black'}))
+    disease = (*disease, title("OUTBREAK"))
+
+    # Drought: a water droplet crossed out
+    cross_length = 14
+    drought = (
+        ('create_arc', (centre_x - 10, centre_y - 5, centre_x + 10, centre_y + 15),
+         {'start': 180, 'extent': 180, 'style': 'pieslice', 'fill': 'black'}),
+        ('create_polygon', (centre_x - 12, centre_y + 5, centre_x + 12, centre_y + 5, centre_x, centre_y - 15),
+         {'fill': 'black'}),
+        ('create_line', (centre_x - cross_length, centre_y - cross_length, centre_x + cross_length,
+                         centre_y + cross_length), {'fill': 'red', 'width': 4}),
+        ('create_line', (centre_x - cross_length, centre_y + cross_length, centre_x + cross_length,
+                         centre_y - cross_length), {'fill': 'red', 'width': 4}),
+        title("DROUGHT"))
+
+    icons = {'warning': warning, 'flood': flood, 'typhoon': typhoon, 'heatwave': heatwave, 'disease': disease,
+             'drought': drought}
+    shapes = {name: icon + triangle for name, icon in icons.items()}
+    shapes['triangle'] = triangle
+    return shapes
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Authors: Jake Dolan, Rory White
+#
+# Class:   EPaperDisplay
+#
+# Purpose: This class holds the drawing code shared by every EPaperDisplay.
+#          It draws onto self.canvas, which subclasses provide: a Tkinter
+#          canvas for EPaperDisplayDummy, or a FrameBufferCanvas for the
+#          headless EPaperFrameBufferDisplay. Both canvases take the same
+#          create_* calls, so the layout only has to be written once.
+#
+#          IMPORTANT: As the screen is representing the ePaper screen, it may
+#          not use images. It can only use the following items: text, lines,
+#          rectangles. It is only able to use the colours white, black and red.
+#          Please DO NOT use anything other than these elements when editing
+#          the UI as it will not translate to the ePaper display.
+#
+# ------------------------------------------------------------------------------ #
+class EPaperDisplay:
+    # Canvas dimensions
+    canvas_width = SCREEN_WIDTH
+    canvas_height = SCREEN_HEIGHT
+    draws_khmer = True  # False for canvases whose font can't draw Khmer, which then leave it out
+
+    def draw_icon(self, name):
+        # Clear the screen and draw the icon and title for an alert, using draw_<name>
+        self.canvas.delete('all')
+        getattr(self, 'draw_' + name)()
+
+    def draw_content(self, content):
+        # Draw the alert's icon with its info text underneath, or the default action text
+        # for its type when the message didn't give any
+        alert_type = content.get('alert_type') if content else None
+        self.draw_icon(ALERT_ICONS.get(alert_type, 'warning'))
+        info = content.get('info') if content else None
+        default = DEFAULT_ACTIONS.get(alert_type, DEFAULT_ACTIONS[None])
+        if not self.draws_khmer:
+            # A message only in Khmer gets the default action in the languages the panel has
+            info, default = without_khmer(info or ''), without_khmer(default)
+        self.draw_info(info or default)
+
+    def draw_info(self, text):
+        # Fit text into the area under the icon, at the large size if it all fits. The lines
+        # are laid out here in framebuffer font cells and each is drawn on its own at its row,
+        # with no width for Tk to wrap them again, so both canvases show the same lines.
+        scale, lines = fit_text(text, INFO_WIDTH, INFO_HEIGHT)
+        line_height = (FONT_HEIGHT + 1) * scale
+        for line_number, line in enumerate(lines):
+            self.canvas.create_text(self.canvas_width // 2, INFO_TOP + line_number * line_height, text=''.join(line),
+                                    fill='black', font=INFO_FONTS[scale], anchor='n', tags='info')
+
+
+    def draw_shapes(self, shapes):
+        # Draw a batch of (canvas method, coordinates, options) from icon_shapes, in one call
+        # where the canvas takes batches
+        create_batch = getattr(self.canvas, 'create_batch', None)
+        if create_batch is not None:
+            create_batch(shapes)
+            return
+        for method, coords, options in shapes:
+            getattr(self.canvas, method)(*coords, **options)
+
+    def draw_triangle(self):
+        self.draw_shapes(icon_shapes(self.canvas_width, self.canvas_height)['triangle'])
+
+    def draw_warning(self):
+        self.draw_shapes(icon_shapes(self.canvas_width, self.canvas_height)['warning'])
+
+    def draw_flood(self):
+        self.draw_shapes(icon_shapes(self.canvas_width, self.canvas_height)['flood'])
+
+    def draw_typhoon(self):
+        self.draw_shapes(icon_shapes(self.canvas_width, self.canvas_height)['typhoon'])
+
+    def draw_heatwave(self):
+        self.draw_shapes(icon_shapes(self.canvas_width, self.canvas_height)['heatwave'])
+
+    def draw_disease(self):
+        self.draw_shapes(icon_shapes(self.canvas_width, self.canvas_height)['disease'])
+
+    def draw_drought(self):
+        self.draw_shapes(icon_shapes(self.canvas_width, self.canvas_height)['drought'])
+
+    def no_alerts(self):
+        self.canvas.delete('all')
+        self.canvas.create_text(self.canvas_width // 2, self.canvas_height // 2, text="No Alerts", fill="black", font=("Arial", 14, "bold"))
+
 
 # ------------------------------------------------------------------------------ #
 #
@@ -196,310 +2138,1470 @@ class AlertReceiver:
 #          with Tkinter. It contains the same functions and variables as the
 #          MicroPython display class that runs on the microcontroller, but it
 #          allows you to simulate what the screen will look like on your PC.
-#
-#          IMPORTANT: As the screen is representing the ePaper screen, it may
-#          not use images. It can only use the following items: text, lines,
-#          rectangles. It is only able to use the colours white, black and red.
-#          Please DO NOT use anything other than these elements when editing
-#          the UI as it will not translate to the ePaper display.
+#          See EPaperFrameBufferDisplay and RecordingDisplay for running
+#          without a screen.
 #
 # ------------------------------------------------------------------------------ #
-class EPaperDisplayDummy():
+class EPaperDisplayDummy(EPaperDisplay):
     def __init__(self):
+        import tkinter as tk  # only needed for the dummy window, so headless machines don't need Tk
         self.root = tk.Tk()
         self.root.title("128x256 E-Ink Dummy Display")
 
-        # Canvas dimensions
-        self.canvas_width = SCREEN_WIDTH
-        self.canvas_height = SCREEN_HEIGHT
-
         # Create canvas
         self.canvas = tk.Canvas(self.root, width=self.canvas_width, height=self.canvas_height, bg='white')
         self.canvas.pack()
+        self.icon_shown = None
 
     def run(self):
         self.root.mainloop()
 
-    def draw_content(self, content):
+    def call_every(self, seconds, function):
+        # Run function on the Tk thread every seconds. Drawing has to happen on this thread, so
+        # AlertSystem runs its render worker this way instead of on a thread of its own.
+        def tick():
+            try:
+                function()
+            finally:
+                self.root.after(int(seconds * 1000), tick)
+        self.root.after(int(seconds * 1000), tick)
+
+    def draw_icon(self, name):
+        # The icon is left alone when it hasn't changed, and only the text under it is replaced
+        if name == self.icon_shown:
+            self.canvas.delete('info')
+            return
+        super().draw_icon(name)
+        self.icon_shown = name
+
+    def no_alerts(self):
+        super().no_alerts()
+        self.icon_shown = None
+
+    def show_frame(self, frame):
+        # Paint a FrameBuffer pixel for pixel, e.g. one replayed by UpdateDecoder, so the
+        # window shows exactly what the panel would
         self.canvas.delete('all')
+        self.icon_shown = None
+        for y in range(frame.height):
+            x = 0
+            while x < frame.width:
+                colour = frame.pixel(x, y)
+                end = x + 1
+                while end < frame.width and frame.pixel(end, y) == colour:
+                    end += 1
+                if colour != 'white':
+                    self.canvas.create_line(x, y, end, y, fill=colour)
+                x = end
+
+
+# Icon drawn for each alert type, anything else gets the general warning
+ALERT_ICONS = {"Flood": "flood", "Typhoon": "typhoon", "Heatwave": "heatwave", "Disease": "disease",
+               "Drought": "drought"}
+# Action text shown when an alert's message has none, in English, Vietnamese and Khmer.
+# The framebuffer font has no Khmer glyphs yet, so the panel leaves the Khmer lines out.
+DEFAULT_ACTIONS = {
+    "Flood": "Move to higher ground\ntìm kiếm vùng đất caot\nស្វែងរកដីខ្ពស់ស្វែងរកជង។",
+    "Typhoon": "Seek shelter\ntìm nơi trú ẩn\nស្វែងរកដីខ្ព។",
+    "Heatwave": "Avoid sun\ntiết kiệm nước\nស្វែងរកដីខ្ព។",
+    "Disease": "Social Distance\nKhoảng cách xã hội\nដស្វែងnរកងដងខ្ព។",
+    "Drought": "Save Water\nKhoảng cách xã hội\nដស្វែងnរកងដងខ្ព។",
+    None: "General Alert\nThông báo chung"}
+# Info text area under the icon and title
+INFO_TOP = 192
+INFO_WIDTH = SCREEN_WIDTH - 8
+INFO_HEIGHT = SCREEN_HEIGHT - INFO_TOP - 4
+# Tk fonts matching the framebuffer font at each scale: monospaced and sized in pixels (negative
+# sizes) so each character advances one 6 or 12 pixel font cell, as the layout assumed
+INFO_FONTS = {1: ("Courier", -10), 2: ("Courier", -20)}
+TEXT_LAYOUT_CACHE_SIZE = 512  # laid out and rasterised strings kept for reuse
+ZERO_WIDTH_SPACE = '\u200b'  # marks where Khmer, which has no spaces between words, may be broken
+JOINERS = ('\u17d2', '\u200d')  # Khmer coeng (stacks the next consonant under this one) and zero width joiner
+KHMER = re.compile('[\u1780-\u17ff\u19e0-\u19ff]')  # Khmer and Khmer symbols
+
+
+# 5x7 bitmap font for the framebuffer. Each glyph is 7 rows of 5 pixels, the most
+# significant of the 5 bits being the leftmost pixel. Glyphs are drawn in 6x8 cells.
+FONT_WIDTH = 5
+FONT_HEIGHT = 7
+FONT_5X7 = {
+    ' ': (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    '…': (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x15),
+    '!': (0x04, 0x04, 0x04, 0x04, 0x04, 0x00, 0x04),
+    '"': (0x0A, 0x0A, 0x0A, 0x00, 0x00, 0x00, 0x00),
+    '#': (0x0A, 0x0A, 0x1F, 0x0A, 0x1F, 0x0A, 0x0A),
+    '$': (0x04, 0x0F, 0x14, 0x0E, 0x05, 0x1E, 0x04),
+    '%': (0x18, 0x19, 0x02, 0x04, 0x08, 0x13, 0x03),
+    '&': (0x0C, 0x12, 0x14, 0x08, 0x15, 0x12, 0x0D),
+    "'": (0x04, 0x04, 0x08, 0x00, 0x00, 0x00, 0x00),
+    '(': (0x02, 0x04, 0x08, 0x08, 0x08, 0x04, 0x02),
+    ')': (0x08, 0x04, 0x02, 0x02, 0x02, 0x04, 0x08),
+    '*': (0x00, 0x04, 0x15, 0x0E, 0x15, 0x04, 0x00),
+    '+': (0x00, 0x04, 0x04, 0x1F, 0x04, 0x04, 0x00),
+    ',': (0x00, 0x00, 0x00, 0x00, 0x0C, 0x04, 0x08),
+    '-': (0x00, 0x00, 0x00, 0x1F, 0x00, 0x00, 0x00),
+    '.': (0x00, 0x00, 0x00, 0x00, 0x00, 0x0C, 0x0C),
+    '/': (0x00, 0x01, 0x02, 0x04, 0x08, 0x10, 0x00),
+    '0': (0x0E, 0x11, 0x13, 0x15, 0x19, 0x11, 0x0E),
+    '1': (0x04, 0x0C, 0x04, 0x04, 0x04, 0x04, 0x0E),
+    '2': (0x0E, 0x11, 0x01, 0x02, 0x04, 0x08, 0x1F),
+    '3': (0x1F, 0x02, 0x04, 0x02, 0x01, 0x11, 0x0E),
+    '4': (0x02, 0x06, 0x0A, 0x12, 0x1F, 0x02, 0x02),
+    '5': (0x1F, 0x10, 0x1E, 0x01, 0x01, 0x11, 0x0E),
+    '6': (0x06, 0x08, 0x10, 0x1E, 0x11, 0x11, 0x0E),
+    '7': (0x1F, 0x01, 0x02, 0x04, 0x08, 0x08, 0x08),
+    '8': (0x0E, 0x11, 0x11, 0x0E, 0x11, 0x11, 0x0E),
+    '9': (0x0E, 0x11, 0x11, 0x0F, 0x01, 0x02, 0x0C),
+    ':': (0x00, 0x0C, 0x0C, 0x00, 0x0C, 0x0C, 0x00),
+    ';': (0x00, 0x0C, 0x0C, 0x00, 0x0C, 0x04, 0x08),
+    '<': (0x02, 0x04, 0x08, 0x10, 0x08, 0x04, 0x02),
+    '=': (0x00, 0x00, 0x1F, 0x00, 0x1F, 0x00, 0x00),
+    '>': (0x08, 0x04, 0x02, 0x01, 0x02, 0x04, 0x08),
+    '?': (0x0E, 0x11, 0x01, 0x02, 0x04, 0x00, 0x04),
+    '@': (0x0E, 0x11, 0x01, 0x0D, 0x15, 0x15, 0x0E),
+    'A': (0x0E, 0x11, 0x11, 0x1F, 0x11, 0x11, 0x11),
+    'B': (0x1E, 0x11, 0x11, 0x1E, 0x11, 0x11, 0x1E),
+    'C': (0x0E, 0x11, 0x10, 0x10, 0x10, 0x11, 0x0E),
+    'D': (0x1C, 0x12, 0x11, 0x11, 0x11, 0x12, 0x1C),
+    'E': (0x1F, 0x10, 0x10, 0x1E, 0x10, 0x10, 0x1F),
+    'F': (0x1F, 0x10, 0x10, 0x1E, 0x10, 0x10, 0x10),
+    'G': (0x0E, 0x11, 0x10, 0x17, 0x11, 0x11, 0x0F),
+    'H': (0x11, 0x11, 0x11, 0x1F, 0x11, 0x11, 0x11),
+    'I': (0x0E, 0x04, 0x04, 0x04, 0x04, 0x04, 0x0E),
+    'J': (0x07, 0x02, 0x02, 0x02, 0x02, 0x12, 0x0C),
+    'K': (0x11, 0x12, 0x14, 0x18, 0x14, 0x12, 0x11),
+    'L': (0x10, 0x10, 0x10, 0x10, 0x10, 0x10, 0x1F),
+    'M': (0x11, 0x1B, 0x15, 0x15, 0x11, 0x11, 0x11),
+    'N': (0x11, 0x11, 0x19, 0x15, 0x13, 0x11, 0x11),
+    'O': (0x0E, 0x11, 0x11, 0x11, 0x11, 0x11, 0x0E),
+    'P': (0x1E, 0x11, 0x11, 0x1E, 0x10, 0x10, 0x10),
+    'Q': (0x0E, 0x11, 0x11, 0x11, 0x15, 0x12, 0x0D),
+    'R': (0x1E, 0x11, 0x11, 0x1E, 0x14, 0x12, 0x11),
+    'S': (0x0F, 0x10, 0x10, 0x0E, 0x01, 0x01, 0x1E),
+    'T': (0x1F, 0x04, 0x04, 0x04, 0x04, 0x04, 0x04),
+    'U': (0x11, 0x11, 0x11, 0x11, 0x11, 0x11, 0x0E),
+    'V': (0x11, 0x11, 0x11, 0x11, 0x11, 0x0A, 0x04),
+    'W': (0x11, 0x11, 0x11, 0x15, 0x15, 0x15, 0x0A),
+    'X': (0x11, 0x11, 0x0A, 0x04, 0x0A, 0x11, 0x11),
+    'Y': (0x11, 0x11, 0x0A, 0x04, 0x04, 0x04, 0x04),
+    'Z': (0x1F, 0x01, 0x02, 0x04, 0x08, 0x10, 0x1F),
+    '[': (0x0E, 0x08, 0x08, 0x08, 0x08, 0x08, 0x0E),
+    '\\': (0x00, 0x10, 0x08, 0x04, 0x02, 0x01, 0x00),
+    ']': (0x0E, 0x02, 0x02, 0x02, 0x02, 0x02, 0x0E),
+    '^': (0x04, 0x0A, 0x11, 0x00, 0x00, 0x00, 0x00),
+    '_': (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x1F),
+    '`': (0x08, 0x04, 0x02, 0x00, 0x00, 0x00, 0x00),
+    'a': (0x00, 0x00, 0x0E, 0x01, 0x0F, 0x11, 0x0F),
+    'b': (0x10, 0x10, 0x16, 0x19, 0x11, 0x11, 0x1E),
+    'c': (0x00, 0x00, 0x0E, 0x10, 0x10, 0x11, 0x0E),
+    'd': (0x01, 0x01, 0x0D, 0x13, 0x11, 0x11, 0x0F),
+    'e': (0x00, 0x00, 0x0E, 0x11, 0x1F, 0x10, 0x0E),
+    'f': (0x06, 0x09, 0x08, 0x1C, 0x08, 0x08, 0x08),
+    'g': (0x00, 0x0F, 0x11, 0x11, 0x0F, 0x01, 0x0E),
+    'h': (0x10, 0x10, 0x16, 0x19, 0x11, 0x11, 0x11),
+    'i': (0x04, 0x00, 0x0C, 0x04, 0x04, 0x04, 0x0E),
+    'j': (0x02, 0x00, 0x06, 0x02, 0x02, 0x12, 0x0C),
+    'k': (0x10, 0x10, 0x12, 0x14, 0x18, 0x14, 0x12),
+    'l': (0x0C, 0x04, 0x04, 0x04, 0x04, 0x04, 0x0E),
+    'm': (0x00, 0x00, 0x1A, 0x15, 0x15, 0x11, 0x11),
+    'n': (0x00, 0x00, 0x16, 0x19, 0x11, 0x11, 0x11),
+    'o': (0x00, 0x00, 0x0E, 0x11, 0x11, 0x11, 0x0E),
+    'p': (0x00, 0x00, 0x1E, 0x11, 0x1E, 0x10, 0x10),
+    'q': (0x00, 0x00, 0x0D, 0x13, 0x0F, 0x01, 0x01),
+    'r': (0x00, 0x00, 0x16, 0x19, 0x10, 0x10, 0x10),
+    's': (0x00, 0x00, 0x0E, 0x10, 0x0E, 0x01, 0x1E),
+    't': (0x08, 0x08, 0x1C, 0x08, 0x08, 0x09, 0x06),
+    'u': (0x00, 0x00, 0x11, 0x11, 0x11, 0x13, 0x0D),
+    'v': (0x00, 0x00, 0x11, 0x11, 0x11, 0x0A, 0x04),
+    'w': (0x00, 0x00, 0x11, 0x11, 0x15, 0x15, 0x0A),
+    'x': (0x00, 0x00, 0x11, 0x0A, 0x04, 0x0A, 0x11),
+    'y': (0x00, 0x00, 0x11, 0x11, 0x0F, 0x01, 0x0E),
+    'z': (0x00, 0x00, 0x1F, 0x02, 0x04, 0x08, 0x1F),
+    '{': (0x02, 0x04, 0x04, 0x08, 0x04, 0x04, 0x02),
+    '|': (0x04, 0x04, 0x04, 0x04, 0x04, 0x04, 0x04),
+    '}': (0x08, 0x04, 0x04, 0x02, 0x04, 0x04, 0x08),
+    '~': (0x00, 0x00, 0x08, 0x15, 0x02, 0x00, 0x00),
+}
+# Drawn for characters the font has no glyph for. The font covers ASCII, with Vietnamese
+# drawn unaccented. Khmer would be all boxes, so displays using this font leave Khmer lines
+# out (see EPaperDisplay.draws_khmer) until there is glyph data for it.
+MISSING_GLYPH = (0x1F, 0x11, 0x11, 0x11, 0x11, 0x11, 0x1F)
+DEFAULT_FONT_SIZE = 9  # Tk's default text size, used when create_text is given no font
+LARGE_FONT_SIZE = 12  # fonts this size or bigger are drawn at double scale
+FULL_REFRESH_THRESHOLD = 0.5  # fraction of the screen changed above which a full refresh is used
+FULL_REFRESH_EVERY = 10  # partial updates allowed before a full refresh clears ghosting
+
+# Compact update stream sent to panels over slow radio links, see UpdateEncoder. An update
+# is a header, sections each holding one PackBits encoded window of a plane, and a CRC-32
+# of the lot. It is sent as chunks that each fit in LINK_MTU bytes.
+LINK_MTU = 244  # bytes in one radio packet
+UPDATE_VERSION = 1
+UPDATE_HEADER = struct.Struct('!BHBB')  # version, update number, flags, number of sections
+UPDATE_SECTION = struct.Struct('!BBBBHHH')  # plane (0 black, 1 red), encoding, x and width in bytes,
+                                            # y, height, length of the encoded data that follows
+UPDATE_KEYFRAME = 0x01  # flag: sections hold whole planes, refresh the full panel
+ENCODING_RAW = 0  # PackBits of the window's bytes
+ENCODING_XOR = 1  # PackBits of the window XOR the previous frame, mostly zeros for small changes
+CHUNK_MAGIC = b'\xeaU'
+CHUNK_HEADER = struct.Struct('!2sHBB')  # magic, update number, chunk index, chunk count
+CHUNK_CHECKSUM = struct.Struct('!I')  # CRC-32 of the chunk header and payload, at the end of each chunk
+
 
-        if content is None or not content:
-            self.draw_warning()
-            self.canvas.create_text(67, 224, text="General Alert \nThông báo chung \nThông báo chung.", font='System, 7', anchor='c')
+# ------------------------------------------------------------------------------ #
+#
+# Class:   FrameBuffer
+#
+# Purpose: A frame for the three colour ePaper panel, held the way the panel
+#          takes it: one packed 1-bit plane for black and one for red, each
+#          row SCREEN_WIDTH / 8 bytes, most significant bit leftmost, with a
+#          set bit meaning ink. White is both bits clear.
+#
+# ------------------------------------------------------------------------------ #
+class FrameBuffer:
+    def __init__(self, width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+        self.width = width
+        self.height = height
+        self.stride = (width + 7) // 8
+        self.black = bytearray(self.stride * height)
+        self.red = bytearray(self.stride * height)
+
+    def clear(self):
+        self.black[:] = bytes(len(self.black))
+        self.red[:] = bytes(len(self.red))
+
+    def copy(self):
+        frame = FrameBuffer(self.width, self.height)
+        frame.load(self)
+        return frame
+
+    def load(self, other):
+        # Overwrite this frame with another of the same size (a straight buffer copy)
+        self.black[:] = other.black
+        self.red[:] = other.red
+
+    def __eq__(self, other):
+        return isinstance(other, FrameBuffer) and self.black == other.black and self.red == other.red
+
+    def pixel(self, x, y):
+        # Returns 'black', 'red' or 'white'
+        index = y * self.stride + (x >> 3)
+        bit = 0x80 >> (x & 7)
+        if self.black[index] & bit:
+            return 'black'
+        if self.red[index] & bit:
+            return 'red'
+        return 'white'
+
+    def hspan(self, x1, x2, y, colour):
+        # Paint pixels x1..x2 inclusive of row y. Clipped to the frame.
+        if y < 0 or y >= self.height:
             return
+        x1 = max(x1, 0)
+        x2 = min(x2, self.width - 1)
+        if x1 > x2:
+            return
+        row = y * self.stride
+        first, last = row + (x1 >> 3), row + (x2 >> 3)
+        first_mask = 0xFF >> (x1 & 7)
+        last_mask = (0xFF << (7 - (x2 & 7))) & 0xFF
+        if colour == 'black':
+            self.set_bits(self.black, first, last, first_mask, last_mask)
+            self.clear_bits(self.red, first, last, first_mask, last_mask)
+        elif colour == 'red':
+            self.set_bits(self.red, first, last, first_mask, last_mask)
+            self.clear_bits(self.black, first, last, first_mask, last_mask)
+        else:
+            self.clear_bits(self.black, first, last, first_mask, last_mask)
+            self.clear_bits(self.red, first, last, first_mask, last_mask)
 
-        if content['alert_type'] == "Flood":
-            self.draw_flood()
-            self.canvas.create_text(67, 224, text="Move to higher ground \ntìm kiếm vùng đất caot \nស្វែងរកដីខ្ពស់ស្វែងរកជង។  ", font='System, 7', anchor='c')
-        elif content['alert_type'] == "Typhoon":
-            self.draw_typhoon()
-            self.canvas.create_text(67, 224, text="Seek shelter \ntìm nơi trú ẩn \nស្វែងរកដីខ្ព។  ", font='System, 7', anchor='c')
-        elif content['alert_type'] == "Heatwave":
-            self.draw_heatwave()
-            self.canvas.create_text(67, 224, text="Avoid sun \ntiết kiệm nước \n ស្វែងរកដីខ្ព។  ", font='System, 7', anchor='c')
-        elif content['alert_type'] == "Disease":
-            self.draw_disease()
-            self.canvas.create_text(67, 224, text="Social Distance \nKhoảng cách xã hội \nដស្វែងnរកងដងខ្ព។  ", font='System, 7', anchor='c')
-        elif content['alert_type'] == "Drought":
-            self.draw_drought()
-            self.canvas.create_text(67, 224, text="  Save Water  \nKhoảng cách xã hội \nដស្វែងnរកងដងខ្ព។  ", font='System, 7', anchor='c')
+    @staticmethod
+    def set_bits(plane, first, last, first_mask, last_mask):
+        if first == last:
+            plane[first] |= first_mask & last_mask
+            return
+        plane[first] |= first_mask
+        plane[first + 1:last] = b'\xff' * (last - first - 1)
+        plane[last] |= last_mask
+
+    @staticmethod
+    def clear_bits(plane, first, last, first_mask, last_mask):
+        if first == last:
+            plane[first] &= ~(first_mask & last_mask) & 0xFF
+            return
+        plane[first] &= ~first_mask & 0xFF
+        plane[first + 1:last] = bytes(last - first - 1)
+        plane[last] &= ~last_mask & 0xFF
+
+    def plot(self, x, y, colour):
+        self.hspan(x, x, y, colour)
+
+    def blit(self, rows, width, left, top, colour):
+        # Paint a bitmap from text_bitmap with its top left corner at (left, top). Clipped to
+        # the frame. The rows it covers are updated as one span of each plane.
+        if top < 0:
+            rows = rows[-top:]
+            top = 0
+        rows = rows[:max(0, self.height - top)]
+        if not rows:
+            return
+        mask = bitmap_mask(rows, width, left, self.width)
+        span = slice(top * self.stride, (top + len(rows)) * self.stride)
+        size = len(rows) * self.stride
+        if colour == 'black':
+            planes = (self.black, self.red)
+        elif colour == 'red':
+            planes = (self.red, self.black)
         else:
-            self.draw_warning()
-            self.canvas.create_text(67, 224, text="General Alert \nThông báo chung \nThông báo chung.")
+            planes = (None, self.black, self.red)
+        ink = planes[0]
+        if ink is not None:
+            ink[span] = (int.from_bytes(ink[span], 'big') | mask).to_bytes(size, 'big')
+        for plane in planes[1:]:
+            plane[span] = (int.from_bytes(plane[span], 'big') & ~mask).to_bytes(size, 'big')
+
+
+def parse_font_size(font):
+    # Tk accepts fonts as ("Arial", 16, "bold") or strings like 'System, 7'
+    if font is None:
+        return DEFAULT_FONT_SIZE
+    if isinstance(font, (tuple, list)):
+        sizes = [part for part in font if isinstance(part, int)]
+    else:
+        sizes = [int(number) for number in re.findall(r'\d+', str(font))]
+    return abs(sizes[0]) if sizes else DEFAULT_FONT_SIZE
+
+
+def font_glyph(char):
+    glyph = FONT_5X7.get(char)
+    if glyph is None:
+        # Fall back to the unaccented letter, so Vietnamese text stays readable
+        base = unicodedata.normalize('NFD', char)[0]
+        glyph = FONT_5X7.get({'đ': 'd', 'Đ': 'D'}.get(char, base), MISSING_GLYPH)
+    return glyph
+
+
+def without_khmer(text):
+    # text without its lines containing Khmer, for displays that can't draw it
+    if not KHMER.search(text):
+        return text
+    return '\n'.join(line for line in text.split('\n') if not KHMER.search(line)).strip()
+
+
+def grapheme_clusters(text):
+    # Split text into the characters a reader sees: a base character with its combining
+    # marks, and in Khmer a consonant with the subscript consonants stacked under it.
+    # Lines are only ever broken between clusters, and each takes one font cell.
+    clusters = []
+    join_next = False
+    for char in text:
+        if clusters and (join_next or unicodedata.category(char) in ('Mn', 'Mc', 'Me')):
+            clusters[-1] += char
+        else:
+            clusters.append(char)
+        join_next = char in JOINERS
+    return clusters
+
+
+@functools.lru_cache(maxsize=TEXT_LAYOUT_CACHE_SIZE)
+def layout_text(text, max_width=0, scale=1, max_lines=0):
+    # Word wrap text to lines no wider than max_width pixels in the framebuffer font at
+    # scale (0 for no wrapping), keeping its own line breaks. Words too long for a line,
+    # and Khmer with no zero width spaces, are broken between clusters. Lines after
+    # max_lines (0 for no limit) are dropped and the last one ends in an ellipsis.
+    # Returns (lines, truncated), each line a tuple of clusters.
+    cell_width = (FONT_WIDTH + 1) * scale
+    columns = max(1, (max_width + scale) // cell_width) if max_width else math.inf
+    lines = []
+    for paragraph in text.split('\n'):
+        line = []
+        break_at = 0  # length line can be cut back to at the last space, 0 for none
+        for cluster in grapheme_clusters(paragraph):
+            if cluster == ' ' or cluster == ZERO_WIDTH_SPACE:
+                if line:
+                    break_at = len(line)
+                    if cluster == ' ':
+                        line.append(cluster)
+                continue
+            if len(line) >= columns:
+                if break_at:
+                    lines.append(line[:break_at])
+                    line = line[break_at + 1:] if line[break_at:break_at + 1] == [' '] else line[break_at:]
+                else:
+                    lines.append(line)
+                    line = []
+                break_at = 0
+            line.append(cluster)
+        while line and line[-1] == ' ':
+            line.pop()
+        lines.append(line)
+
+    truncated = bool(max_lines) and len(lines) > max_lines
+    if truncated:
+        lines = lines[:max_lines]
+        last = lines[-1][:columns - 1]
+        while last and last[-1] == ' ':
+            last.pop()
+        lines[-1] = last + ['…']
+    return tuple(map(tuple, lines)), truncated
+
+
+def fit_text(text, max_width, max_height):
+    # Lay text out at the largest scale it fits at whole, only truncating it at scale 1.
+    # Returns (scale, lines).
+    for scale in (2, 1):
+        max_lines = max(1, max_height // ((FONT_HEIGHT + 1) * scale))
+        lines, truncated = layout_text(text, max_width, scale, max_lines)
+        if not truncated:
+            break
+    return scale, lines
+
+
+@functools.lru_cache(maxsize=TEXT_LAYOUT_CACHE_SIZE)
+def text_bitmap(lines, scale=1, justify='left'):
+    # Rasterise laid out lines to (width, height, rows), each row an int with a set bit for
+    # each pixel of ink, the most significant of width bits leftmost. Cached, so drawing
+    # repeated text is only FrameBuffer.blit.
+    cell_width, cell_height = (FONT_WIDTH + 1) * scale, (FONT_HEIGHT + 1) * scale
+    width = max(map(len, lines), default=0) * cell_width
+    rows = [0] * (len(lines) * cell_height)
+    for line_number, line in enumerate(lines):
+        spare = width - len(line) * cell_width
+        left = spare // 2 if justify == 'center' else spare if justify == 'right' else 0
+        for cluster_number, cluster in enumerate(line):
+            # One cell per cluster, drawn with the glyph for its base character
+            glyph = font_glyph(unicodedata.normalize('NFC', cluster)[0])
+            shift = width - (left + cluster_number * cell_width) - FONT_WIDTH * scale
+            for row_number, bits in enumerate(glyph):
+                if bits:
+                    bits = scaled_glyph_row(bits, scale) << shift
+                    top = line_number * cell_height + row_number * scale
+                    for dy in range(scale):
+                        rows[top + dy] |= bits
+    return width, len(rows), tuple(rows)
+
+
+@functools.lru_cache(maxsize=TEXT_LAYOUT_CACHE_SIZE)
+def bitmap_mask(rows, width, left, frame_width):
+    # The rows of a bitmap placed at x = left across full rows of a frame frame_width
+    # pixels wide, as one int laid out like those rows of a FrameBuffer plane
+    row_bits = (frame_width + 7) // 8 * 8
+    shift = row_bits - left - width
+    visible = ((1 << frame_width) - 1) << (row_bits - frame_width)  # drops pixels off either side
+    mask = 0
+    for bits in rows:
+        mask = (mask << row_bits) | ((bits << shift if shift >= 0 else bits >> -shift) & visible)
+    return mask
+
+
+def text_cache_stats():
+    return {name: cache.cache_info()._asdict()
+            for name, cache in (("layout", layout_text), ("bitmap", text_bitmap), ("mask", bitmap_mask))}
+
+
+@functools.lru_cache(maxsize=None)
+def scaled_glyph_row(bits, scale):
+    # A FONT_WIDTH bit glyph row with every pixel repeated scale times
+    scaled = 0
+    for column in range(FONT_WIDTH):
+        scaled <<= scale
+        if bits & (0x10 >> column):
+            scaled |= (1 << scale) - 1
+    return scaled
 
 
+# ------------------------------------------------------------------------------ #
+#
+# Class:   FrameBufferCanvas
+#
+# Purpose: Stands in for the Tkinter canvas on headless displays. It takes
+#          the same create_* calls as tk.Canvas, with the same defaults, but
+#          rasterises them straight into a FrameBuffer, so the EPaperDisplay
+#          drawing code runs unchanged without Tkinter.
+#
+# ------------------------------------------------------------------------------ #
+class FrameBufferCanvas:
+    def __init__(self, frame):
+        self.frame = frame
+
+    def delete(self, tag):
+        # Items aren't kept once drawn, so only clearing everything has any effect.
+        # Redrawing a tagged item simply paints over the old one.
+        if tag == 'all':
+            self.frame.clear()
+
+    def fill_polygon(self, points, colour):
+        # Scanline fill sampling pixel centres, using the even-odd rule like Tk
+        if not colour or len(points) < 3:
+            return
+        ys = [y for _, y in points]
+        edges = list(zip(points, points[1:] + points[:1]))
+        for y in range(max(math.floor(min(ys)), 0), min(math.ceil(max(ys)), self.frame.height)):
+            centre_y = y + 0.5
+            crossings = []
+            for (xa, ya), (xb, yb) in edges:
+                if (ya <= centre_y) != (yb <= centre_y):
+                    crossings.append(xa + (centre_y - ya) * (xb - xa) / (yb - ya))
+            crossings.sort()
+            for i in range(0, len(crossings) - 1, 2):
+                self.frame.hspan(math.ceil(crossings[i] - 0.5), math.ceil(crossings[i + 1] - 0.5) - 1, y, colour)
+
+    def fill_ellipse(self, centre_x, centre_y, radius_x, radius_y, colour):
+        if not colour or radius_x <= 0 or radius_y <= 0:
+            return
+        for y in range(max(math.floor(centre_y - radius_y), 0),
+                       min(math.ceil(centre_y + radius_y), self.frame.height)):
+            offset = (y + 0.5 - centre_y) / radius_y
+            if abs(offset) >= 1:
+                continue
+            half_width = radius_x * math.sqrt(1 - offset * offset)
+            self.frame.hspan(math.ceil(centre_x - half_width - 0.5), math.ceil(centre_x + half_width - 0.5) - 1,
+                             y, colour)
+
+    def stroke_segment(self, x1, y1, x2, y2, colour, width):
+        length = math.hypot(x2 - x1, y2 - y1)
+        if width <= 1 or length == 0:
+            # Thin lines are stepped pixel by pixel so they never vanish between pixel centres
+            steps = max(int(max(abs(x2 - x1), abs(y2 - y1))), 1)
+            for i in range(steps + 1):
+                self.frame.plot(int(x1 + (x2 - x1) * i / steps), int(y1 + (y2 - y1) * i / steps), colour)
+            return
+        # A thick line is the rectangle around it (Tk's default butt cap)
+        normal_x = -(y2 - y1) / length * width / 2
+        normal_y = (x2 - x1) / length * width / 2
+        self.fill_polygon([(x1 + normal_x, y1 + normal_y), (x2 + normal_x, y2 + normal_y),
+                           (x2 - normal_x, y2 - normal_y), (x1 - normal_x, y1 - normal_y)], colour)
+
+    def create_batch(self, shapes):
+        # Draw a batch of (canvas method, coordinates, options), as made by icon_shapes
+        for method, coords, options in shapes:
+            getattr(self, method)(*coords, **options)
+
+    def create_line(self, *coords, fill='black', width=1, tags=None):
+        if not fill:
+            return
+        points = list(zip(coords[::2], coords[1::2]))
+        for (x1, y1), (x2, y2) in zip(points, points[1:]):
+            self.stroke_segment(x1, y1, x2, y2, fill, width)
+        # Round joins between segments, like Tk's default joinstyle
+        if width > 2:
+            for x, y in points[1:-1]:
+                self.fill_ellipse(x, y, width / 2, width / 2, fill)
+
+    def create_rectangle(self, x1, y1, x2, y2, fill='', outline='black', width=1, tags=None):
+        x1, x2 = sorted((round(x1), round(x2)))
+        y1, y2 = sorted((round(y1), round(y2)))
+        if fill:
+            for y in range(y1, y2):
+                self.frame.hspan(x1, x2 - 1, y, fill)
+        if outline:
+            for inset in range(max(int(width), 1)):
+                self.frame.hspan(x1 + inset, x2 - inset, y1 + inset, outline)
+                self.frame.hspan(x1 + inset, x2 - inset, y2 - inset, outline)
+                for y in range(y1 + inset, y2 - inset + 1):
+                    self.frame.plot(x1 + inset, y, outline)
+                    self.frame.plot(x2 - inset, y, outline)
+
+    def create_oval(self, x1, y1, x2, y2, fill='', outline='black', width=1, tags=None):
+        centre_x, centre_y = (x1 + x2) / 2, (y1 + y2) / 2
+        radius_x, radius_y = abs(x2 - x1) / 2, abs(y2 - y1) / 2
+        if outline and outline != fill:
+            self.fill_ellipse(centre_x, centre_y, radius_x + 0.5, radius_y + 0.5, outline)
+            self.fill_ellipse(centre_x, centre_y, radius_x - width + 0.5, radius_y - width + 0.5, fill or 'white')
+        else:
+            self.fill_ellipse(centre_x, centre_y, radius_x + 0.5, radius_y + 0.5, fill or outline)
+
+    def create_polygon(self, *coords, fill='black', outline='', width=1, tags=None):
+        points = list(zip(coords[::2], coords[1::2]))
+        self.fill_polygon(points, fill)
+        if outline:
+            self.create_line(*coords, *coords[:2], fill=outline, width=width)
+
+    def create_arc(self, x1, y1, x2, y2, start=0, extent=90, style='pieslice', fill='', outline='black',
+                   width=1, tags=None):
+        # Angles are in degrees counter-clockwise from 3 o'clock, as in Tk
+        centre_x, centre_y = (x1 + x2) / 2, (y1 + y2) / 2
+        radius_x, radius_y = abs(x2 - x1) / 2, abs(y2 - y1) / 2
+        steps = max(int(abs(extent) / 5), 2)
+        points = [(centre_x, centre_y)]
+        for i in range(steps + 1):
+            angle = math.radians(start + extent * i / steps)
+            points.append((centre_x + radius_x * math.cos(angle), centre_y - radius_y * math.sin(angle)))
+        if fill:
+            self.fill_polygon(points, fill)
+        if outline:
+            outline_points = points if style == 'pieslice' else points[1:]
+            coords = [value for point in outline_points for value in point]
+            if style == 'pieslice':
+                coords += coords[:2]
+            self.create_line(*coords, fill=outline, width=width)
+
+    def create_text(self, x, y, text='', fill='black', font=None, anchor='center', justify='left', width=0,
+                    tags=None):
+        # Like Tk, width wraps lines longer than that many pixels and justify aligns the lines
+        # within the block. Layout and rasterising are cached, so repeated text is one blit.
+        scale = 2 if parse_font_size(font) >= LARGE_FONT_SIZE else 1
+        lines = layout_text(str(text), width, scale)[0]
+        block_width, block_height, rows = text_bitmap(lines, scale, justify)
+
+        # Position the block by its anchor
+        anchor = '' if anchor in ('c', 'center') else anchor
+        left = x - block_width / 2
+        top = y - block_height / 2
+        if 'w' in anchor:
+            left = x
+        elif 'e' in anchor:
+            left = x - block_width
+        if anchor.startswith('n'):
+            top = y
+        elif anchor.startswith('s'):
+            top = y - block_height
+        self.frame.blit(rows, block_width, round(left), round(top), fill)
 
-    def draw_triangle(self):
-        self.canvas.delete("triangle")
-        side_length = min(self.canvas_width, self.canvas_height) - 40
-        height = (math.sqrt(3) / 2) * side_length
-        triangle_center_x, triangle_center_y = self.canvas_width // 2, self.canvas_height // 4
 
-        triangle_vertices = [
-            (triangle_center_x, triangle_center_y - height / 2),
-            (triangle_center_x - side_length / 2, triangle_center_y + height / 2),
-            (triangle_center_x + side_length / 2, triangle_center_y + height / 2)
-        ]
+# ------------------------------------------------------------------------------ #
+#
+# Class:   RefreshPlanner
+#
+# Purpose: Decides how to update the panel for a new frame. It keeps the last
+#          frame sent and compares it with the new one, producing the
+#          smallest set of dirty rectangles in each colour plane as partial
+#          update commands. It asks for a full refresh when too much of the
+#          screen changed, or after a set number of partial updates to clear
+#          the ghosting they leave behind.
+#
+#          Commands are dicts. {"mode": "full"} redraws the whole panel and
+#          {"mode": "partial", "plane": "black" or "red", "x", "y", "width",
+#          "height"} updates one window. Windows are aligned to whole bytes
+#          (8 pixels) horizontally, as the panel controllers require.
+#
+# ------------------------------------------------------------------------------ #
+class RefreshPlanner:
+    def __init__(self, full_refresh_threshold=FULL_REFRESH_THRESHOLD, full_refresh_every=FULL_REFRESH_EVERY):
+        self.full_refresh_threshold = full_refresh_threshold
+        self.full_refresh_every = full_refresh_every
+        self.last_frame = None
+        self.partials_since_full = 0
+
+        # Counters
+        self.full_refreshes = 0
+        self.partial_refreshes = 0
+        self.unchanged = 0
+
+    def plan(self, frame):
+        if self.last_frame is None:
+            return self.full_refresh(frame)
+
+        rectangles = []
+        for plane in ('black', 'red'):
+            for x, y, width, height in dirty_rectangles(getattr(self.last_frame, plane), getattr(frame, plane),
+                                                        frame.stride, frame.height):
+                rectangles.append({"mode": "partial", "plane": plane, "x": x, "y": y,
+                                   "width": width, "height": height})
+        if not rectangles:
+            self.unchanged += 1
+            return []
+
+        dirty_area = sum(rectangle["width"] * rectangle["height"] for rectangle in rectangles)
+        if (dirty_area > self.full_refresh_threshold * 2 * frame.width * frame.height
+                or self.partials_since_full >= self.full_refresh_every):
+            return self.full_refresh(frame)
+
+        self.last_frame.load(frame)
+        self.partials_since_full += 1
+        self.partial_refreshes += 1
+        return rectangles
+
+    def full_refresh(self, frame):
+        self.last_frame = frame.copy()
+        self.partials_since_full = 0
+        self.full_refreshes += 1
+        return [{"mode": "full"}]
+
+    def stats(self):
+        return {"full_refreshes": self.full_refreshes, "partial_refreshes": self.partial_refreshes,
+                "unchanged": self.unchanged}
+
+
+def dirty_rectangles(old_plane, new_plane, stride, height, gap=1):
+    # Returns (x, y, width, height) pixel rectangles covering every byte that differs
+    # between two planes. Runs of changed bytes on a row are joined when no more than gap
+    # bytes apart, and runs that touch a rectangle on the row above extend it downwards.
+    open_rectangles = []  # [first byte, last byte, first row, last row]
+    finished = []
+    for y in range(height):
+        row = y * stride
+        runs = []
+        if old_plane[row:row + stride] != new_plane[row:row + stride]:
+            for column in range(stride):
+                if old_plane[row + column] != new_plane[row + column]:
+                    if runs and column - runs[-1][1] <= gap + 1:
+                        runs[-1][1] = column
+                    else:
+                        runs.append([column, column])
+
+        still_open = []
+        for first, last in runs:
+            rectangle = [first, last, y, y]
+            # Absorb every open rectangle this run touches
+            for other in open_rectangles[:]:
+                if other[0] <= last + gap and first <= other[1] + gap:
+                    open_rectangles.remove(other)
+                    rectangle = [min(rectangle[0], other[0]), max(rectangle[1], other[1]),
+                                 min(rectangle[2], other[2]), y]
+            for other in still_open[:]:
+                if other[0] <= rectangle[1] + gap and rectangle[0] <= other[1] + gap:
+                    still_open.remove(other)
+                    rectangle = [min(rectangle[0], other[0]), max(rectangle[1], other[1]),
+                                 min(rectangle[2], other[2]), y]
+            still_open.append(rectangle)
+        finished.extend(open_rectangles)  # not continued on this row
+        open_rectangles = still_open
+    finished.extend(open_rectangles)
+
+    return [(first * 8, top, (last - first + 1) * 8, bottom - top + 1)
+            for first, last, top, bottom in sorted(finished, key=lambda rectangle: (rectangle[2], rectangle[0]))]
 
-        self.canvas.create_line(*triangle_vertices[0], *triangle_vertices[1], fill='red', width=7, tags="triangle")
-        self.canvas.create_line(*triangle_vertices[1], *triangle_vertices[2], fill='red', width=7, tags="triangle")
-        self.canvas.create_line(*triangle_vertices[2], *triangle_vertices[0], fill='red', width=7, tags="triangle")
 
-        return tuple(sum(triangle_vertices, ()))
+# ------------------------------------------------------------------------------ #
+#
+# Class:   EPaperFrameBufferDisplay
+#
+# Purpose: Headless EPaperDisplay that renders into a FrameBuffer, the
+#          format the MicroPython target sends to the panel. The icon and
+#          title for every alert type are rasterised once when the display
+#          is created, so drawing an alert is a buffer copy plus the text.
+#
+# ------------------------------------------------------------------------------ #
+class EPaperFrameBufferDisplay(EPaperDisplay):
+    icon_names = ('warning', 'flood', 'typhoon', 'heatwave', 'disease', 'drought')
+    draws_khmer = False  # FONT_5X7 has no Khmer glyphs
+
+    def __init__(self, full_refresh_threshold=FULL_REFRESH_THRESHOLD, full_refresh_every=FULL_REFRESH_EVERY):
+        self.framebuffer = FrameBuffer(self.canvas_width, self.canvas_height)
+        self.canvas = FrameBufferCanvas(self.framebuffer)
+        self.refresh_planner = RefreshPlanner(full_refresh_threshold, full_refresh_every)
+        self.last_refresh = []  # commands for the most recent frame
+        self.on_refresh = None  # called with (commands, framebuffer) whenever the panel needs updating
+        self.frames_drawn = 0
+        self.stop_event = threading.Event()
+        metrics.gauges['text_cache'] = text_cache_stats
+
+        # Build the icon cache
+        self.icon_cache = {}
+        for name in self.icon_names:
+            super().draw_icon(name)
+            self.icon_cache[name] = self.framebuffer.copy()
+        self.framebuffer.clear()
+
+    def draw_icon(self, name):
+        self.framebuffer.load(self.icon_cache[name])
 
-    def draw_warning(self):
-        # Pass triangle coordinates
-        triangle_coords = self.draw_triangle()
+    def draw_content(self, content):
+        super().draw_content(content)
+        self.frames_drawn += 1
+        self.refresh()
+
+    def render(self, content):
+        # Rasterise content and return a copy of the frame without refreshing the panel,
+        # so one render can be shared by many panels through show_frame. None renders no_alerts.
+        if content is None:
+            EPaperDisplay.no_alerts(self)
+        else:
+            EPaperDisplay.draw_content(self, content)
+        return self.framebuffer.copy()
 
-        # Calculate triangle center
-        triangle_center_x = sum(triangle_coords[::2]) // 3
-        triangle_center_y = sum(triangle_coords[1::2]) // 3
+    def show_frame(self, frame):
+        # Display a frame rendered elsewhere
+        self.framebuffer.load(frame)
+        self.frames_drawn += 1
+        self.refresh()
 
-        # Draw the exclamation mark
-        exclamation_width, exclamation_height, exclamation_radius = 5, 30, 5
-        self.canvas.create_rectangle(triangle_center_x - exclamation_width // 2, triangle_center_y - exclamation_height,
-                                     triangle_center_x + exclamation_width // 2, triangle_center_y, fill="black")
-        self.canvas.create_oval(triangle_center_x - exclamation_radius, triangle_center_y + 7,
-                                triangle_center_x + exclamation_radius, triangle_center_y + 7 + 2 * exclamation_radius,
-                                fill="black")
+    def no_alerts(self):
+        super().no_alerts()
+        self.refresh()
 
-        # Draw the text below the triangle
-        self.canvas.create_text(self.canvas_width // 2, 25 + self.canvas_height // 2,
-                                text="WARNING", fill="black", font=("Arial", 16, "bold"))
+    def refresh(self):
+        # Work out how to bring the panel up to date with the framebuffer and send it on
+        self.last_refresh = self.refresh_planner.plan(self.framebuffer)
+        if self.last_refresh and self.on_refresh is not None:
+            self.on_refresh(self.last_refresh, self.framebuffer)
+        return self.last_refresh
 
-        # Redraw the triangle
-        self.draw_triangle()
+    def run(self):
+        # Nothing to show on screen, so just keep the program alive like mainloop
+        self.stop_event.wait()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+PACKBITS_RUN = re.compile(rb'(.)\1{2,}', re.DOTALL)  # three or more of the same byte
+
+
+def packbits(data):
+    # PackBits run length encoding, as used by TIFF and simple enough for the microcontroller.
+    # A header byte n of 0-127 is followed by n + 1 literal bytes, and 129-255 by one byte
+    # repeated 257 - n times. Runs are found by the regular expression engine, not byte by byte.
+    encoded = bytearray()
+    literal_start = 0
+
+    def add_literal(start, end):
+        for chunk_start in range(start, end, 128):
+            chunk = data[chunk_start:min(end, chunk_start + 128)]
+            encoded.append(len(chunk) - 1)
+            encoded.extend(chunk)
+
+    for match in PACKBITS_RUN.finditer(data):
+        start, end = match.span()
+        add_literal(literal_start, start)
+        value = data[start]
+        while end - start > 1:
+            count = min(128, end - start)
+            encoded.append(257 - count)
+            encoded.append(value)
+            start += count
+        literal_start = start  # a single byte left over joins the next literal
+    add_literal(literal_start, len(data))
+    return bytes(encoded)
+
+
+def unpackbits(encoded, size):
+    # Decode PackBits data that should expand to size bytes. Raises ValueError if it doesn't.
+    decoded = bytearray()
+    position = 0
+    end = len(encoded)
+    while position < end:
+        header = encoded[position]
+        if header < 128:
+            decoded += encoded[position + 1:position + 2 + header]
+            position += 2 + header
+        elif header > 128:
+            if position + 1 >= end:
+                raise ValueError("run is missing its byte")
+            decoded += encoded[position + 1:position + 2] * (257 - header)
+            position += 2
+        else:
+            position += 1  # 128 is a no-op
+    if len(decoded) != size or position != end:
+        raise ValueError(f"expected {size} bytes, decoded {len(decoded)}")
+    return decoded
 
-    def draw_flood(self):
-        # House and triangle coordinates
-        (triangle_x1, triangle_y1, triangle_x2, triangle_y2, triangle_x3, triangle_y3) = self.draw_triangle()
-        triangle_center_x, triangle_center_y = (triangle_x1 + triangle_x2 + triangle_x3) // 3, (
-                triangle_y1 + triangle_y2 + triangle_y3) // 3
-        house_size, door_height, door_width = 20, 8, 4
-        house_top_left_x, house_top_left_y, house_bottom_right_x, house_bottom_right_y = triangle_center_x - house_size // 2, triangle_center_y - house_size // 2 - 6, triangle_center_x + house_size // 2, triangle_center_y + house_size // 2 - 6
-        door_top_left_x, door_top_left_y, door_bottom_right_x, door_bottom_right_y = triangle_center_x - door_width // 2, triangle_center_y - door_height // 2, triangle_center_x + door_width // 2, triangle_center_y + door_height // 2
-        roof_x1, roof_y1, roof_x2, roof_y2, roof_x3, roof_y3 = house_top_left_x - 5, house_top_left_y, house_bottom_right_x + 5, house_top_left_y, triangle_center_x, house_top_left_y - 12
-
-        # Straight line coordinates
-        num_segments = 10
-        wave_start_x, wave_end_x = house_top_left_x - 26, house_bottom_right_x + 26
-        segment_length = (wave_end_x - wave_start_x) / num_segments
-
-        # Draw the straight lines
-        for i in range(num_segments):
-            x1 = wave_start_x + i * segment_length
-            x2 = x1 + segment_length
-            for y in [6, 13]:
-                self.canvas.create_line(x1, house_bottom_right_y + y, x2, house_bottom_right_y + y, fill='black',
-                                        width=3)
-
-        # Draw the house
-        for coords in [
-            (house_top_left_x, house_top_left_y + 2, house_bottom_right_x, house_bottom_right_y + 2, 'black', 'black'),
-            (door_top_left_x, door_top_left_y + 2, door_bottom_right_x, door_bottom_right_y + 2, 'white', 'white')]:
-            self.canvas.create_rectangle(*coords[:4], outline=coords[4], fill=coords[5])
-
-        # Draw the roof as individual lines
-        self.canvas.create_line(roof_x1 + 2, roof_y1, roof_x3, roof_y3, fill='black', width=4)
-        self.canvas.create_line(roof_x3, roof_y3, roof_x2 - 2, roof_y2, fill='black', width=4)
-        self.canvas.create_line(roof_x1 + 2, roof_y1, roof_x2 - 2, roof_y2, fill='black', width=4)
-        self.canvas.create_line(roof_x1 + 7, roof_y1 - 3, roof_x3, roof_y3 + 3, fill='black', width=6)
-        self.canvas.create_line(roof_x3, roof_y3 + 3, roof_x2 - 7, roof_y2 - 3, fill='black', width=6)
-        self.canvas.create_line(roof_x1 + 7, roof_y1 - 3, roof_x2 - 7, roof_y2 - 3, fill='black', width=6)
-
-        # Draw the text below the triangle
-        self.canvas.create_text(self.canvas_width // 2, 25 + self.canvas_height // 2, text="FLOOD", fill="black",
-                                font=("Arial", 16, "bold"))
-
-        # Redraw the triangle
-        self.draw_triangle()
 
-    def draw_typhoon(self):
-        # Pass triangle coordinates
-        (triangle_x1, triangle_y1, triangle_x2, triangle_y2, triangle_x3, triangle_y3) = self.draw_triangle()
+# ------------------------------------------------------------------------------ #
+#
+# Class:   UpdateEncoder
+#
+# Purpose: Turns the refresh commands from RefreshPlanner into the compact
+#          update stream for panels on slow radio links. Partial updates
+#          send each dirty window XORed with the frame the panel already
+#          has, which is mostly zero bytes and packs down to a few runs.
+#          Full refreshes, the first frame and any frame after the panel
+#          asks for one are keyframes, holding both planes PackBits encoded,
+#          so a panel that lost its place can always recover. Each update is
+#          checksummed and split into chunks of at most mtu bytes, each with
+#          its own checksum. Attach it with display.on_refresh = encoder.on_refresh.
+#
+# ------------------------------------------------------------------------------ #
+class UpdateEncoder:
+    def __init__(self, mtu=LINK_MTU, send=None):
+        if mtu <= CHUNK_HEADER.size + CHUNK_CHECKSUM.size:
+            raise ValueError(f"mtu must be more than {CHUNK_HEADER.size + CHUNK_CHECKSUM.size} bytes")
+        self.mtu = mtu
+        self.send = send  # called with each chunk by on_refresh
+        self.previous = None  # FrameBuffer the panel has, as of the last update
+        self.update_number = 0
+        self.keyframe_requested = True
+
+        # Counters
+        self.updates = 0
+        self.keyframes = 0
+        self.chunks = 0
+        self.frame_bytes = 0  # bytes of the windows sent, before encoding
+        self.bytes_sent = 0  # bytes of every chunk, headers and checksums included
+
+    def request_keyframe(self):
+        # Called when a panel reports it missed an update
+        self.keyframe_requested = True
+
+    def on_refresh(self, commands, frame):
+        for chunk in self.encode(commands, frame):
+            self.send(chunk)
+
+    def encode(self, commands, frame):
+        # Returns the chunks for one refresh
+        if not commands:
+            return []
+        keyframe = (self.keyframe_requested or self.previous is None
+                    or any(command["mode"] == "full" for command in commands))
+        sections = []
+        frame_bytes = 0
+        if keyframe:
+            for plane_number, plane in enumerate((frame.black, frame.red)):
+                data = packbits(plane)
+                sections.append(UPDATE_SECTION.pack(plane_number, ENCODING_RAW, 0, frame.stride, 0, frame.height,
+                                                    len(data)) + data)
+                frame_bytes += len(plane)
+        else:
+            for command in commands:
+                plane_number = 0 if command["plane"] == 'black' else 1
+                new_plane = frame.black if plane_number == 0 else frame.red
+                old_plane = self.previous.black if plane_number == 0 else self.previous.red
+                first, width = command["x"] // 8, command["width"] // 8
+                window = bytearray()
+                for y in range(command["y"], command["y"] + command["height"]):
+                    start = y * frame.stride + first
+                    window += (int.from_bytes(new_plane[start:start + width], 'big')
+                               ^ int.from_bytes(old_plane[start:start + width], 'big')).to_bytes(width, 'big')
+                    # Windows can overlap, so later ones are XORed with the frame as the panel
+                    # will have it after this one
+                    old_plane[start:start + width] = new_plane[start:start + width]
+                data = packbits(window)
+                sections.append(UPDATE_SECTION.pack(plane_number, ENCODING_XOR, first, width, command["y"],
+                                                    command["height"], len(data)) + data)
+                frame_bytes += len(window)
+
+        self.update_number = (self.update_number + 1) & 0xFFFF
+        update = b''.join((UPDATE_HEADER.pack(UPDATE_VERSION, self.update_number,
+                                              UPDATE_KEYFRAME if keyframe else 0, len(sections)), *sections))
+        update += CHUNK_CHECKSUM.pack(zlib.crc32(update))
+        chunks = self.split(update)
+
+        if self.previous is None:
+            self.previous = frame.copy()
+        else:
+            self.previous.load(frame)
+        self.keyframe_requested = False
+        self.updates += 1
+        self.keyframes += keyframe
+        self.chunks += len(chunks)
+        self.frame_bytes += frame_bytes
+        self.bytes_sent += sum(map(len, chunks))
+        return chunks
+
+    def split(self, update):
+        payload_size = self.mtu - CHUNK_HEADER.size - CHUNK_CHECKSUM.size
+        count = -(-len(update) // payload_size)
+        if count > 255:
+            raise ValueError(f"update of {len(update)} bytes needs more than 255 chunks at mtu {self.mtu}")
+        chunks = []
+        for index in range(count):
+            chunk = CHUNK_HEADER.pack(CHUNK_MAGIC, self.update_number, index, count) + \
+                update[index * payload_size:(index + 1) * payload_size]
+            chunks.append(chunk + CHUNK_CHECKSUM.pack(zlib.crc32(chunk)))
+        return chunks
+
+    def stats(self):
+        return {"updates": self.updates, "keyframes": self.keyframes, "chunks": self.chunks,
+                "frame_bytes": self.frame_bytes, "bytes_sent": self.bytes_sent,
+                "bytes_per_update": round(self.bytes_sent / self.updates, 1) if self.updates else None}
 
-        # Center of the triangle
-        triangle_center_x = (triangle_x1 + triangle_x2 + triangle_x3) // 3
-        triangle_center_y = (triangle_y1 + triangle_y2 + triangle_y3) // 3
 
-        # Adjusted start point
-        start_x = triangle_center_x
-        start_y = triangle_center_y
+# ------------------------------------------------------------------------------ #
+#
+# Class:   UpdateDecoder
+#
+# Purpose: The panel's end of the update stream, written the way the
+#          microcontroller will do it so the stream can be checked without
+#          hardware. Chunks are checked and reassembled, the update's
+#          checksum verified and its sections applied to a FrameBuffer. A
+#          corrupt or missing chunk, or a gap in the update numbers, drops
+#          updates until the next keyframe, as XOR windows only make sense
+#          on top of the frame they were made from. feed() returns True when
+#          an update has been applied, and display (if given) is then shown
+#          the new frame through show_frame.
+#
+# ------------------------------------------------------------------------------ #
+class UpdateDecoder:
+    def __init__(self, width=SCREEN_WIDTH, height=SCREEN_HEIGHT, display=None):
+        self.frame = FrameBuffer(width, height)
+        self.display = display
+        self.last_update = None  # number of the last update applied
+        self.needs_keyframe = True
+        self.assembling = None  # (update number, chunk payloads so far)
+
+        # Counters
+        self.applied = 0
+        self.keyframes = 0
+        self.corrupt = 0  # chunks or updates that failed their checksum or didn't parse
+        self.skipped = 0  # updates dropped while waiting for a keyframe
+
+    def feed(self, chunk):
+        if (len(chunk) < CHUNK_HEADER.size + CHUNK_CHECKSUM.size
+                or CHUNK_CHECKSUM.unpack_from(chunk, len(chunk) - CHUNK_CHECKSUM.size)[0]
+                != zlib.crc32(chunk[:-CHUNK_CHECKSUM.size])):
+            self.corrupt += 1
+            return False
+        magic, update_number, index, count = CHUNK_HEADER.unpack_from(chunk)
+        if magic != CHUNK_MAGIC or index >= count:
+            self.corrupt += 1
+            return False
+        if self.assembling is None or self.assembling[0] != update_number or len(self.assembling[1]) != count:
+            if self.assembling is not None:
+                self.skipped += 1  # the update before this one never completed
+                self.needs_keyframe = True
+            self.assembling = (update_number, [None] * count)
+        parts = self.assembling[1]
+        parts[index] = chunk[CHUNK_HEADER.size:-CHUNK_CHECKSUM.size]
+        if None in parts:
+            return False
+        self.assembling = None
+        return self.apply(b''.join(parts))
+
+    def apply(self, update):
+        if len(update) < UPDATE_HEADER.size + CHUNK_CHECKSUM.size or \
+                CHUNK_CHECKSUM.unpack_from(update, len(update) - CHUNK_CHECKSUM.size)[0] != zlib.crc32(update[:-4]):
+            self.corrupt += 1
+            self.needs_keyframe = True
+            return False
+        version, update_number, flags, section_count = UPDATE_HEADER.unpack_from(update)
+        keyframe = bool(flags & UPDATE_KEYFRAME)
+        in_sequence = self.last_update is not None and update_number == (self.last_update + 1) & 0xFFFF
+        if version != UPDATE_VERSION or not (keyframe or (in_sequence and not self.needs_keyframe)):
+            self.skipped += 1
+            self.needs_keyframe = True
+            return False
 
-        # NUmber of lines for each half of the symbol
-        num_lines = 24
+        # Decode every section before touching the frame, so a bad one leaves it as it was
+        windows = []
+        offset = UPDATE_HEADER.size
+        try:
+            for _ in range(section_count):
+                plane_number, encoding, first, width, top, height, length = UPDATE_SECTION.unpack_from(update, offset)
+                offset += UPDATE_SECTION.size
+                if plane_number > 1 or first + width > self.frame.stride or top + height > self.frame.height:
+                    raise ValueError("window outside the frame")
+                data = unpackbits(update[offset:offset + length], width * height)
+                offset += length
+                windows.append((self.frame.black if plane_number == 0 else self.frame.red,
+                                encoding, first, width, top, height, data))
+        except (struct.error, ValueError):
+            self.corrupt += 1
+            self.needs_keyframe = True
+            return False
 
-        # Length of each line
-        line_length = 7
+        stride = self.frame.stride
+        for plane, encoding, first, width, top, height, data in windows:
+            for row in range(height):
+                start = (top + row) * stride + first
+                bits = data[row * width:(row + 1) * width]
+                if encoding == ENCODING_XOR:
+                    bits = (int.from_bytes(plane[start:start + width], 'big')
+                            ^ int.from_bytes(bits, 'big')).to_bytes(width, 'big')
+                plane[start:start + width] = bits
+        self.last_update = update_number
+        self.needs_keyframe = False
+        self.applied += 1
+        self.keyframes += keyframe
+        if self.display is not None:
+            self.display.show_frame(self.frame.copy())
+        return True
 
-        # Draw half of the symbol, getting longer each time it iterates
-        for i in range(num_lines):
-            angle = math.radians(10 * i)
-            line_end_x = start_x + line_length * math.cos(angle)
-            line_end_y = start_y + line_length * math.sin(angle)
-            self.canvas.create_line(start_x, start_y, line_end_x, line_end_y, width=4)
-            line_length = line_length + 0.5
+    def stats(self):
+        return {"applied": self.applied, "keyframes": self.keyframes, "corrupt": self.corrupt,
+                "skipped": self.skipped, "needs_keyframe": self.needs_keyframe}
 
-        # Reset the length of each line
-        line_length = 7
 
-        # Draw the other half of the symbol, getting longer each time it iterates
-        for i in range(num_lines):
-            angle = math.radians(-10 * i)
-            line_end_x = start_x - line_length * math.cos(angle)
-            line_end_y = start_y + line_length * math.sin(angle)
-            self.canvas.create_line(start_x, start_y, line_end_x, line_end_y, width=4)
-            line_length = line_length + 0.5
+def write_stream_chunk(stream_file, chunk):
+    # Recorded streams are chunks each preceded by its length as two bytes
+    stream_file.write(len(chunk).to_bytes(2, 'big') + chunk)
 
-        # Draw the text below the triangle
-        self.canvas.create_text(self.canvas_width // 2, 25 + self.canvas_height // 2, text="TYPHOON", fill="black",
-                                font=("Arial", 16, "bold"))
 
-        # Redraw the triangle
-        self.draw_triangle()
+def read_stream(path):
+    with open(path, 'rb') as stream_file:
+        while len(prefix := stream_file.read(2)) == 2:
+            yield stream_file.read(int.from_bytes(prefix, 'big'))
 
-    def draw_heatwave(self):
-        # Get triangle coordinates
-        triangle_coords = self.draw_triangle()
-        triangle_center_x = sum(triangle_coords[::2]) // 3
-        triangle_center_y = sum(triangle_coords[1::2]) // 3
-
-        # Draw sun
-        sun_radius = 13
-        for i in range(0, 360, 45):
-            angle_rad = math.radians(i)
-            sun_x1 = triangle_center_x + sun_radius * math.cos(angle_rad)
-            sun_y1 = triangle_center_y + sun_radius * math.sin(angle_rad)
-            sun_x2 = triangle_center_x + (sun_radius + 5) * math.cos(angle_rad)
-            sun_y2 = triangle_center_y + (sun_radius + 5) * math.sin(angle_rad)
-            self.canvas.create_line(sun_x1, sun_y1, sun_x2, sun_y2, fill="black", width=5)
-        self.canvas.create_oval(triangle_center_x - sun_radius, triangle_center_y - sun_radius,
-                                triangle_center_x + sun_radius, triangle_center_y + sun_radius, fill="black")
-
-        # Draw waves
-        wave_amplitude, num_segments = 3, 8
-        segment_length = 36 / num_segments
-        for i in range(num_segments):
-            wave_x1 = triangle_center_x - 18 + i * segment_length
-            wave_x2, wave_y2 = wave_x1 + segment_length / 2, triangle_center_y + (wave_amplitude * (-1) ** i)
-            wave_x3 = wave_x2 + segment_length / 2
-            for wave_offset in (-6, 4, 14):
-                self.canvas.create_line(wave_x1, triangle_center_y + wave_offset, wave_x2, wave_y2 + wave_offset,
-                                        fill='red', width=2)
-                self.canvas.create_line(wave_x2, wave_y2 + wave_offset, wave_x3, triangle_center_y + wave_offset,
-                                        fill='red', width=2)
-
-        # Draw text
-        self.canvas.create_text(self.canvas_width // 2, 25 + self.canvas_height // 2, text="HEATWAVE",
-                                fill="black", font=("Arial", 16, "bold"))
-
-        # Redraw triangle
-        self.draw_triangle()
 
-    def draw_disease(self):
-        # Pass triangle coordinates
-        (triangle_x1, triangle_y1, triangle_x2, triangle_y2, triangle_x3, triangle_y3) = self.draw_triangle()
-
-        # Function to draw disease and lines
-        def draw_disease_at(center_x, center_y, radius, line_length, line_width):
-            for i in range(8):
-                angle = math.radians(i * 45)
-                start_x = center_x + radius * math.cos(angle)
-                start_y = center_y + radius * math.sin(angle)
-                end_x = center_x + (radius + line_length) * math.cos(angle)
-                end_y = center_y + (radius + line_length) * math.sin(angle)
-                self.canvas.create_line(start_x, start_y, end_x, end_y, fill="black", width=line_width)
-            self.canvas.create_oval(center_x - radius, center_y - radius, center_x + radius, center_y + radius,
-                                    fill="black", outline="black")
-
-        # Draw diseases at different positions
-        draw_disease_at(triangle_x1 - 10, (triangle_y1 + triangle_y2 + triangle_y3) // 3 + 7, 9, 4, 3)
-        draw_disease_at((triangle_x1 + triangle_x2 + triangle_x3) // 3 + 3, triangle_y1 + 35, 6, 3, 2)
-        draw_disease_at(triangle_x1 + 13, (triangle_y1 + triangle_y2 + triangle_y3) // 3 + 5, 4, 3, 2)
-
-        # Draw the text below the triangle
-        self.canvas.create_text(self.canvas_width // 2, 25 + self.canvas_height // 2, text="OUTBREAK", fill="black",
-                                font=("Arial", 16, "bold"))
-
-        # Redraw the triangle
-        self.draw_triangle()
+# ------------------------------------------------------------------------------ #
+#
+# Class:   RecordingDisplay
+#
+# Purpose: Display that draws nothing. It takes the same calls as an
+#          EPaperDisplay and keeps the most recent alerts it was given, so
+#          the receiver and classifier can run at full speed in load tests
+#          and containers. With history=0 it simply counts alerts.
+#
+# ------------------------------------------------------------------------------ #
+class RecordingDisplay:
+    def __init__(self, history=100):
+        self.history = deque(maxlen=history)  # (time received, alert or None for no alerts)
+        self.frames_drawn = 0
+        self.stop_event = threading.Event()
 
-    def draw_drought(self):
-        # Get triangle coordinates
-        triangle_coords = self.draw_triangle()
-        triangle_center_x = sum(triangle_coords[::2]) // 3
-        triangle_center_y = sum(triangle_coords[1::2]) // 3
-
-        # Droplet coordinates
-        droplet_x1 = triangle_center_x - 12
-        droplet_y1 = triangle_center_y + 5
-        droplet_x2 = triangle_center_x + 12
-        droplet_y2 = triangle_center_y + 5
-        droplet_x3 = triangle_center_x
-        droplet_y3 = triangle_center_y - 15
-
-        # Draw the droplet
-        self.canvas.create_arc(triangle_center_x - 10, triangle_center_y - 5, triangle_center_x + 10,
-                               triangle_center_y + 15,
-                               start=180, extent=180, style='pieslice', fill="black")
-        self.canvas.create_polygon(droplet_x1, droplet_y1, droplet_x2, droplet_y2, droplet_x3, droplet_y3, fill='black')
-
-        # Draw the cross
-        cross_length = 14
-        self.canvas.create_line(triangle_center_x - cross_length, triangle_center_y - cross_length,
-                                triangle_center_x + cross_length, triangle_center_y + cross_length, fill="red", width=4)
-        self.canvas.create_line(triangle_center_x - cross_length, triangle_center_y + cross_length,
-                                triangle_center_x + cross_length, triangle_center_y - cross_length, fill="red", width=4)
-
-        # Draw the text below the triangle
-        self.canvas.create_text(self.canvas_width // 2, 25 + self.canvas_height // 2, text="DROUGHT", fill="black",
-                                font=("Arial", 16, "bold"))
-
-        # Redraw the triangle
-        self.draw_triangle()
+    def draw_content(self, content):
+        self.history.append((time.time(), content))
+        self.frames_drawn += 1
 
     def no_alerts(self):
-        self.canvas.create_text(self.canvas_width // 2, self.canvas_height // 2, text="No Alerts", fill="black", font=("Arial", 14, "bold"))
+        self.history.append((time.time(), None))
+
+    def run(self):
+        self.stop_event.wait()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   DisplayGroup
+#
+# Purpose: A named set of panels, optionally limited to alerts for some
+#          regions. A group with no regions receives every alert.
+#
+# ------------------------------------------------------------------------------ #
+class DisplayGroup:
+    def __init__(self, name, displays, regions=()):
+        self.name = name
+        self.displays = list(displays)
+        self.regions = {region.lower() for region in regions}
+
+
+class Audience:
+    # The panels that want the same alerts, and the scheduler deciding what they show
+    def __init__(self, regions):
+        self.regions = regions  # empty for every alert
+        self.panels = []  # PanelState
+        self.scheduler = AlertScheduler()
+        self.current = None  # (alert, frame) last sent to the panels, None before the first
+
+    def wants(self, alert):
+        if not self.regions or not alert.get("regions"):
+            return True
+        return not self.regions.isdisjoint(alert["regions"])
+
+
+class PanelState:
+    # Delivery state of one panel in a DisplayFanout
+    def __init__(self, display):
+        self.display = display
+        self.audience = None
+        self.busy = False
+        self.started = 0  # time.monotonic() when the current update began
+        self.timed_out = False  # the current update overran PANEL_TIMEOUT
+        self.pending = None  # latest (alert, frame) that arrived while busy
+        self.failures = 0
+        self.retry_at = 0
+        self.shown_key = None  # message key of what the panel shows, NO_ALERTS_KEY for no alerts
+
+
+# ------------------------------------------------------------------------------ #
+#
+# Class:   DisplayFanout
+#
+# Purpose: Sends each alert to every panel in the matching display groups.
+#          Panels wanting the same regions form an audience with its own
+#          AlertScheduler, so rotation and expiry for one region never
+#          leave another's panels showing an alert that has gone. Each
+#          alert is rasterised once, and panels that take frames
+#          (show_frame) get that frame while others draw the alert
+#          themselves. Each panel is updated on its own delivery thread, and
+#          a panel still busy with an earlier alert only keeps the latest
+#          one waiting, so a slow or hung panel never holds up the others.
+#          Panels that keep failing, or take longer than PANEL_TIMEOUT over
+#          an update, are skipped for PANEL_RETRY_DELAY seconds.
+#
+# ------------------------------------------------------------------------------ #
+class DisplayFanout:
+    def __init__(self, frame_cache=None, timeout=PANEL_TIMEOUT):
+        self.frame_cache = frame_cache  # AlertCache keeping rendered frames by message key
+        self.timeout = timeout
+        self.groups = []
+        self.panels = {}  # id(display): PanelState
+        self.audiences = {}  # frozenset of regions, empty for every alert: Audience
+        self.lock = threading.Lock()
+        self.renderer = None  # EPaperFrameBufferDisplay, created when a panel takes frames
+
+    def add_group(self, group):
+        with self.lock:
+            self.groups.append(group)
+            for display in group.displays:
+                self.panels.setdefault(id(display), PanelState(display))
+            if self.renderer is None and any(hasattr(display, 'show_frame') for display in group.displays):
+                self.renderer = EPaperFrameBufferDisplay()
+            self.audiences = self.find_audiences()
+
+    def find_audiences(self):
+        # Called holding self.lock. A panel in several groups wants the alerts for all their
+        # regions, or every alert if one of them has no regions. Audiences that were already
+        # there keep their scheduler and so the alerts active for them.
+        wanted = {}  # id(display): set of regions, None for every alert
+        for group in self.groups:
+            for display in group.displays:
+                regions = wanted.get(id(display), set())
+                wanted[id(display)] = None if regions is None or not group.regions else regions | group.regions
+        audiences = {}
+        for key, regions in wanted.items():
+            regions = frozenset(regions or ())
+            if regions not in audiences:
+                audience = self.audiences.get(regions) or Audience(regions)
+                audience.panels = []
+                audiences[regions] = audience
+            audiences[regions].panels.append(self.panels[key])
+            self.panels[key].audience = audiences[regions]
+        return audiences
+
+    def schedule(self, alerts, now):
+        # Add alerts to the schedulers of the audiences that want them, run every audience's
+        # timers and update the panels of those whose alert on show has changed
+        matched = set()
+        for audience in list(self.audiences.values()):
+            wanted = [alert for alert in alerts if audience.wants(alert)]
+            matched.update(map(id, wanted))
+            redraw, alert = audience.scheduler.update(wanted, now)
+            if redraw:
+                self.show(audience, alert)
+        if len(matched) < len(alerts):
+            metrics.count('fanout_unmatched', len(alerts) - len(matched))
+
+    def next_deadline(self):
+        # The earliest expiry or rotation over all audiences, None if there is nothing to wait for
+        deadlines = [deadline for audience in list(self.audiences.values())
+                     if (deadline := audience.scheduler.next_deadline()) is not None]
+        return min(deadlines, default=None)
+
+    def scheduler_stats(self):
+        # The audiences' scheduler counters added up
+        totals = {}
+        for audience in list(self.audiences.values()):
+            for name, value in audience.scheduler.stats().items():
+                totals[name] = totals.get(name, 0) + value
+        totals["audiences"] = len(self.audiences)
+        return totals
+
+    def show(self, audience, alert):
+        # Send an alert (or None for no alerts) to every panel of an audience
+        started = time.perf_counter()
+        frame = None
+        if self.renderer is not None and any(hasattr(panel.display, 'show_frame') for panel in audience.panels):
+            key = alert.get("message_key") if alert is not None else None
+            if key is not None and self.frame_cache is not None:
+                frame = self.frame_cache.get_frame(key)
+            if frame is None:
+                frame = self.renderer.render(alert)
+                if key is not None and self.frame_cache is not None:
+                    self.frame_cache.put_frame(key, frame)
+        with self.lock:
+            audience.current = (alert, frame)
+        for panel in audience.panels:
+            self.deliver(panel, alert, frame)
+        metrics.observe('draw', time.perf_counter() - started)
+        if alert is not None and "received_at" in alert:
+            metrics.observe('received_to_drawn', time.time() - alert["received_at"])
+
+    def deliver(self, panel, alert, frame):
+        with self.lock:
+            now = time.monotonic()
+            if panel.busy:
+                if not panel.timed_out and now - panel.started > self.timeout:
+                    self.time_out(panel, now)
+                if panel.pending is not None:
+                    metrics.count('fanout_superseded')
+                panel.pending = (alert, frame)
+                return
+            if panel.retry_at > now:
+                metrics.count('fanout_skipped')
+                return
+            panel.busy = True
+            panel.started = now
+        self.start_update(panel, alert, frame)
+
+    def start_update(self, panel, alert, frame):
+        threading.Thread(target=self.update_panel, args=(panel, alert, frame), name='panel', daemon=True).start()
+
+    @staticmethod
+    def missed(panel, now):
+        # Called holding self.lock. The (alert, frame) on show for the panel's audience if the
+        # panel doesn't show it and may be tried, else None. A panel that failed a draw, or was
+        # skipped while failing, is brought up to date this way rather than waiting for its
+        # audience's next change, which with one alert active may be ALERT_TTL away.
+        current = panel.audience.current if panel.audience is not None else None
+        if current is None or panel.retry_at > now:
+            return None
+        key = NO_ALERTS_KEY if current[0] is None else current[0].get("message_key")
+        if key is None or key == panel.shown_key:
+            return None  # without a message key there is no telling what the panel shows
+        return current
+
+    def time_out(self, panel, now):
+        # Called holding self.lock. A thread stuck in a panel's driver can't be stopped, so
+        # the panel is marked failed and its delivery thread just left waiting for it. The
+        # latest alert stays pending for when the update returns.
+        panel.timed_out = True
+        panel.shown_key = None
+        panel.failures += 1
+        panel.retry_at = now + PANEL_RETRY_DELAY
+        metrics.count('panel_timeouts')
+        log.event('panel_timed_out', panel=repr(panel.display), seconds=round(now - panel.started, 1))
+
+    def check_panels(self):
+        # Mark panels whose update has overrun as failed without waiting for the next alert,
+        # and send panels whose retry delay has passed the alert they missed
+        updates = []
+        with self.lock:
+            now = time.monotonic()
+            for panel in self.panels.values():
+                if panel.busy:
+                    if not panel.timed_out and now - panel.started > self.timeout:
+                        self.time_out(panel, now)
+                elif (current := self.missed(panel, now)) is not None:
+                    panel.busy = True
+                    panel.started = now
+                    updates.append((panel, current))
+        for panel, (alert, frame) in updates:
+            metrics.count('panel_redeliveries')
+            self.start_update(panel, alert, frame)
+
+    def update_panel(self, panel, alert, frame):
+        while True:
+            key = NO_ALERTS_KEY if alert is None else alert.get("message_key")
+            error = None
+            try:
+                if key is not None and key == panel.shown_key:
+                    metrics.count('redraws_skipped')  # the panel already shows exactly this
+                elif frame is not None and hasattr(panel.display, 'show_frame'):
+                    panel.display.show_frame(frame)
+                elif alert is None:
+                    panel.display.no_alerts()
+                else:
+                    panel.display.draw_content(alert)
+            except Exception as e:
+                error = e
+
+            with self.lock:
+                if error is None:
+                    panel.shown_key = key
+                    panel.failures = 0
+                    panel.retry_at = 0  # a panel that timed out has come back
+                else:
+                    panel.shown_key = None  # the panel may have been left half drawn
+                    panel.failures += 1
+                    metrics.count('panel_failures')
+                    log.event('panel_failed', panel=repr(panel.display), failures=panel.failures, error=repr(error))
+                    if panel.failures >= PANEL_FAILURE_LIMIT:
+                        panel.retry_at = time.monotonic() + PANEL_RETRY_DELAY
+                panel.timed_out = False
+                now = time.monotonic()
+                if panel.pending is not None and panel.retry_at <= now:
+                    alert, frame = panel.pending
+                elif (current := self.missed(panel, now)) is not None:
+                    metrics.count('panel_redeliveries')  # a failed draw, tried again until PANEL_FAILURE_LIMIT
+                    alert, frame = current
+                else:
+                    panel.pending = None
+                    panel.busy = False
+                    return
+                panel.pending = None
+                panel.started = now
+
+
+# Displays that can be picked with --display
+DISPLAYS = {
+    'tk': EPaperDisplayDummy,
+    'framebuffer': EPaperFrameBufferDisplay,
+    'null': RecordingDisplay}
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ePaper alert display prototype")
+    parser.add_argument('--display', choices=DISPLAYS, default='tk',
+                        help="tk opens the dummy window, framebuffer and null run headless (default: tk)")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help=f"local port serving /metrics, 0 to turn off (default: {METRICS_PORT})")
+    parser.add_argument('--metrics-file', help="also write a metrics snapshot to this file periodically")
+    parser.add_argument('--journal', default=JOURNAL_FILE,
+                        help="journal of accepted alerts restored at start up, empty to turn off "
+                             "(default: alert_journal.bin next to this file)")
+    parser.add_argument('--dump-journal', action='store_true', help="print the journal's records as JSON and exit")
+    parser.add_argument('--stream-file', help="record the compact panel update stream here (framebuffer display)")
+    parser.add_argument('--link-mtu', type=int, default=LINK_MTU,
+                        help=f"largest chunk in the update stream, in bytes (default: {LINK_MTU})")
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS,
+                        help="receiver processes sharing the port for decoding and classification "
+                             f"(default: {INGEST_WORKERS}, receiving in this process)")
+    parser.add_argument('--replay-stream', metavar='STREAM_FILE',
+                        help="decode a recorded update stream onto the display instead of receiving alerts")
+    args = parser.parse_args()
+    if args.stream_file and args.display != 'framebuffer':
+        parser.error("--stream-file needs --display framebuffer")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error("--workers needs SO_REUSEPORT, which this platform does not support")
+
+    if args.dump_journal:
+        for record in read_journal(args.journal):
+            print(json.dumps(record, ensure_ascii=False))
+        sys.exit(0)
+
+    # Expose the pipeline metrics
+    if args.metrics_port:
+        MetricsServer(metrics, port=args.metrics_port).start()
+    if args.metrics_file:
+        MetricsSnapshotWriter(metrics, args.metrics_file).start()
+
+    # Create the display, a simulated screen for the dummy paper display unless running headless
+    display = DISPLAYS[args.display]()
+
+    # Play a recorded update stream back through the panel's decoder, to check it and see the result
+    if args.replay_stream:
+        decoder = UpdateDecoder(display=display if hasattr(display, 'show_frame') else None)
+        for chunk in read_stream(args.replay_stream):
+            decoder.feed(chunk)
+        print(json.dumps(decoder.stats()))
+        if args.display == 'tk':
+            display.run()
+        sys.exit(0)
+
+    # Send the panel the compact update stream, recorded to a file for now
+    if args.stream_file:
+        stream_file = open(args.stream_file, 'ab', buffering=0)
+        encoder = UpdateEncoder(args.link_mtu, send=lambda chunk: write_stream_chunk(stream_file, chunk))
+        display.on_refresh = encoder.on_refresh
+        metrics.gauges['update_stream'] = encoder.stats
+
     # Initialises the alert systems
     alert_system = AlertSystem()
 
-    # Create a simulated screen for the dummy paper display
-    display = EPaperDisplayDummy()
-
-    # Creates the receiving sockets class and assign the alert handler
-    receiver = AlertReceiver()
-    receiver.set_alert_handler(alert_system)
-
-    # Attaches the receiver to the alert system
-    alert_system.attach_receiver(receiver)
+    # Creates the receiving sockets class and assign the alert handler. Setting
+    # EPAPER_HMAC_KEY makes it accept only HMAC authenticated frames signed with that key.
+    # With several workers each runs its own receiver and classifier, see IngestWorkerPool.
+    hmac_key = os.environ.get('EPAPER_HMAC_KEY')
+    hmac_key = hmac_key.encode() if hmac_key else None
+    if args.workers > 1:
+        receiver = None
+        ingest_workers = IngestWorkerPool(alert_system, args.workers, hmac_key=hmac_key)
+    else:
+        receiver = AlertReceiver(hmac_key=hmac_key)
+        receiver.set_alert_handler(alert_system)
+
+        # Attaches the receiver to the alert system
+        alert_system.attach_receiver(receiver)
+
+        # Use the rule file for classification if there is one, and pick up any edits to it
+        if os.path.exists(RULES_FILE):
+            RuleFileWatcher(alert_system).start()
 
     # Attaches the display to the alert system
     alert_system.attach_display(display)
 
-    # start the receiver thread and show the screen
-    threading.Thread(target=receiver.listen, daemon=True).start()
-    display.no_alerts()
+    # Put back any alert that was active when we last stopped, and record new ones
+    restored = 0
+    if args.journal:
+        journal = AlertJournal(args.journal)
+        restored = alert_system.restore(journal)
+        alert_system.attach_journal(journal)
+        metrics.gauges['journal'] = journal.stats
+        journal.start()
+    if not restored:
+        display.no_alerts()
+
+    # Draw alerts on their own thread so network intake never waits on the display
+    alert_system.start_render_worker()
+
+    # start the receiver thread (or worker processes) and show the screen
+    if receiver is None:
+        ingest_workers.start()
+    else:
+        threading.Thread(target=receiver.run_async, daemon=True).start()
     display.run()
@@ -0,0 +1,233 @@
+# ------------------------------------------------------------------------------ #
+#
+# File:    epaperbench.py
+#
+# Purpose: Benchmarks for the alert display prototype. It measures ingestion
+#          through AlertReceiver with a local load generator, classification
+#          and processing in AlertSystem, every draw_* path on the
+#          headless framebuffer display, and the size of the compact panel
+#          update stream. Results are printed (or written) as
+#          JSON with throughput and p50/p99 latency for each benchmark, so
+#          runs can be compared between versions.
+#
+#          Usage: python epaperbench.py [--concurrency 8] [--workers 4] [--messages 2000]
+#                                       [--mix flood=3,typhoon=1] [--output results.json]
+#
+# ------------------------------------------------------------------------------ #
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import epapertest
+
+epaper = epapertest.epaper  # the prototype, loaded by path by epapertest
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        hazard, _, weight = part.partition('=')
+        if hazard not in epapertest.HAZARD_PHRASES:
+            raise argparse.ArgumentTypeError(f"unknown hazard {hazard!r}, "
+                                             f"choose from {', '.join(epapertest.HAZARD_PHRASES)}")
+        mix[hazard] = float(weight or 1)
+    return mix
+
+
+def summarise(latencies, elapsed):
+    # Throughput and latency percentiles (in microseconds) for one benchmark
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(fraction):
+        return round(latencies[min(int(fraction * count), count - 1)] * 1e6, 2) if count else None
+
+    return {"count": count, "seconds": round(elapsed, 4),
+            "throughput_per_s": round(count / elapsed, 1) if elapsed else None,
+            "p50_us": percentile(0.50), "p99_us": percentile(0.99),
+            "max_us": round(latencies[-1] * 1e6, 2) if count else None}
+
+
+def time_calls(function, arguments):
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for argument in arguments:
+        call_start = clock()
+        function(argument)
+        latencies.append(clock() - call_start)
+    return summarise(latencies, clock() - start)
+
+
+def bench_processing(corpus):
+    alert_system = epaper.AlertSystem()
+    alert_system.attach_display(epaper.RecordingDisplay(history=0))
+    return {
+        "get_alert_type": time_calls(alert_system.get_alert_type, corpus),
+        "get_severity_level": time_calls(alert_system.get_severity_level, corpus),
+        "process_data": time_calls(alert_system.process_data, corpus),
+    }
+
+
+def bench_rendering(repeats):
+    display = epaper.EPaperFrameBufferDisplay()
+    results = {}
+    # The raw geometry of each icon, as the cache is built at start up
+    for name in display.icon_names:
+        draw = getattr(epaper.EPaperDisplay, 'draw_' + name)
+        results['draw_' + name] = time_calls(lambda _: draw(display), range(repeats))
+    # Whole alerts through the cached path
+    for alert_type in ('Flood', 'Typhoon', 'Heatwave', 'Disease', 'Drought', 'unknown'):
+        alert = {"alert_type": alert_type, "severity": 3, "info": "Move to higher ground"}
+        results['draw_content_' + alert_type.lower()] = time_calls(display.draw_content, [alert] * repeats)
+    return results
+
+
+def bench_wire(corpus, mtu):
+    # Bytes per panel update on the compact update stream, checked by decoding it again
+    display = epaper.EPaperFrameBufferDisplay()
+    encoder = epaper.UpdateEncoder(mtu)
+    decoder = epaper.UpdateDecoder()
+    latencies = []
+    update_sizes = []
+    in_sync = True
+    alert_system = epaper.AlertSystem()
+    for message in corpus:
+        alert_type, severity = alert_system.classify_alert(message)
+        display.draw_content({"alert_type": alert_type, "severity": severity,
+                              "info": alert_system.parser.parse(message)["info"]})
+        if not display.last_refresh:
+            continue
+        start = time.perf_counter()
+        chunks = encoder.encode(display.last_refresh, display.framebuffer)
+        latencies.append(time.perf_counter() - start)
+        update_sizes.append(sum(map(len, chunks)))
+        for chunk in chunks:
+            decoder.feed(chunk)
+        in_sync = in_sync and decoder.frame == display.framebuffer
+    result = summarise(latencies, sum(latencies))
+    update_sizes.sort()
+    result.update(encoder.stats(), mtu=mtu, in_sync=in_sync,
+                  update_bytes_p50=update_sizes[len(update_sizes) // 2] if update_sizes else None,
+                  update_bytes_max=update_sizes[-1] if update_sizes else None,
+                  frame_bytes_per_update=2 * len(display.framebuffer.black))
+    return result
+
+
+def drained_queue_stats(alert_queue, accepted, timeout=10):
+    # Queue stats once every accepted alert has been queued and the render worker has taken
+    # it, rather than while the last burst is still coalescing. Alerts from ingest workers
+    # can reach the queue after their ack has been sent.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with alert_queue.condition:
+            if alert_queue.arrivals >= accepted and not alert_queue.heap:
+                break
+        time.sleep(0.01)
+    return alert_queue.stats()
+
+
+def bench_ingestion(corpus, concurrency, workers=1):
+    alert_system = epaper.AlertSystem()
+    display = epaper.RecordingDisplay(history=0)
+    alert_system.attach_display(display)
+    alert_system.start_render_worker()
+    # Every sender is local, so lift the per-source rate limit to measure the pipeline itself
+    if workers > 1:
+        receiver = epaper.IngestWorkerPool(alert_system, workers, host='127.0.0.1', port=0,
+                                           rate=10 ** 9, burst=10 ** 9)
+        receiver.start()
+    else:
+        receiver = epaper.AlertReceiver(host='127.0.0.1', port=0, rate=10 ** 9, burst=10 ** 9)
+        receiver.set_alert_handler(alert_system)
+        alert_system.attach_receiver(receiver)
+        threading.Thread(target=receiver.run_async, daemon=True).start()
+    if not receiver.serving.wait(30):
+        raise RuntimeError("Receiver did not start")
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def on_ack(message_id, status, latency):
+        with lock:
+            latencies.append(latency)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def sender(messages):
+        with epapertest.AlertConnection('127.0.0.1', receiver.port, on_ack=on_ack) as connection:
+            for message in messages:
+                connection.send(message)
+            connection.wait_for_acks()
+
+    senders = [threading.Thread(target=sender, args=(corpus[i::concurrency],)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    result = summarise(latencies, time.perf_counter() - start)
+    result["concurrency"] = concurrency
+    result["workers"] = workers
+    result["ack_statuses"] = {str(status): count for status, count in sorted(statuses.items())}
+    result["queue"] = drained_queue_stats(alert_system.alert_queue, statuses.get(epaper.ACK_OK, 0))
+    if workers > 1:
+        receiver.stop()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ePaper alert pipeline")
+    parser.add_argument('--concurrency', type=int, default=8, help="sending connections for ingestion (default: 8)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="ingest worker processes sharing the port for ingestion (default: 1, in process)")
+    parser.add_argument('--messages', type=int, default=2000, help="alerts sent for ingestion (default: 2000)")
+    parser.add_argument('--corpus', type=int, default=20000, help="messages in the processing corpus (default: 20000)")
+    parser.add_argument('--render-repeats', type=int, default=50, help="draws timed per render path (default: 50)")
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help="hazard weights, e.g. flood=3,typhoon=1,unknown=1 (default: even)")
+    parser.add_argument('--mtu', type=int, default=epaper.LINK_MTU,
+                        help=f"chunk size for the update stream benchmark (default: {epaper.LINK_MTU})")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip', action='append', default=[],
+                        choices=['ingestion', 'processing', 'rendering', 'wire'],
+                        help="leave out a group of benchmarks, can be repeated")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"concurrency": args.concurrency, "workers": args.workers, "messages": args.messages, "corpus": args.corpus,
+                       "render_repeats": args.render_repeats, "mix": args.mix, "seed": args.seed,
+                       "mtu": args.mtu},
+    }
+    # The pipeline logs as it goes, keep that out of the results
+    with open(os.devnull, 'w') as devnull:
+        epaper.log.stream = devnull
+        if 'processing' not in args.skip:
+            results["processing"] = bench_processing(epapertest.build_corpus(args.corpus, args.mix, args.seed))
+        if 'rendering' not in args.skip:
+            results["rendering"] = bench_rendering(args.render_repeats)
+        if 'wire' not in args.skip:
+            results["wire"] = bench_wire(epapertest.build_corpus(args.render_repeats, args.mix, args.seed + 2), args.mtu)
+        if 'ingestion' not in args.skip:
+            results["ingestion"] = bench_ingestion(epapertest.build_corpus(args.messages, args.mix, args.seed + 1),
+                                                   args.concurrency, args.workers)
+    results["pipeline_metrics"] = epaper.metrics.snapshot()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
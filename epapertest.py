@@ -1,7 +1,77 @@
+# ------------------------------------------------------------------------------ #
+#
+# File:    epapertest.py
+#
+# Purpose: Test client and traffic generator for the alert receiver. Sends
+#          single alerts, or with --duration/--messages runs many concurrent
+#          connections at a set rate with randomised alerts of every hazard
+#          and severity, in all three message formats, mixed with malformed
+#          and unauthenticated ones. Every ack is checked against the status
+#          that kind of message should get, and a JSON report line with
+#          throughput and ack latency is printed every --report-interval
+#          seconds, so a receiver can be soak tested for hours while leaks,
+#          stalls and wrong answers show up in the reports.
+#
+#          Usage: python epapertest.py [--connections 8] [--rate 100] [--duration 3600]
+#                                      [--mix text=5,malformed=1] [--metrics-url URL]
+#
+# ------------------------------------------------------------------------------ #
+import argparse
+import hmac
+import importlib.util
+import json
+import os
+import random
+import select
 import socket
+import struct
+import sys
+import threading
+import time
+import urllib.request
+
+# The receiver's own wire protocol, binary message format and latency histogram are used,
+# so client and receiver can't drift apart. Its file name isn't a valid module name, so load it by path.
+if 'epaper' in sys.modules:
+    epaper = sys.modules['epaper']
+else:
+    _spec = importlib.util.spec_from_file_location(
+        'epaper', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'epaper-groupdevelopmentfile.py'))
+    epaper = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(epaper)
+    sys.modules['epaper'] = epaper  # so ingest worker processes can find what they run
 
 PORT = 9000
 
+STATUS_NAMES = {epaper.ACK_OK: 'ok', epaper.ACK_AUTH_FAILED: 'auth_failed', epaper.ACK_BAD_DATA: 'bad_data',
+                epaper.ACK_REPLAYED: 'replayed', epaper.ACK_RATE_LIMITED: 'rate_limited'}
+
+# Building blocks for generated alerts, modelled on real bulletins
+HAZARD_PHRASES = {
+    'flood': ["Flooding is expected along the river", "Torrential rain will cause flash floods",
+              "Flood waters are rising in low lying districts"],
+    'typhoon': ["A typhoon will make landfall overnight", "Typhoon winds of 150 km/h are forecast",
+                "The typhoon is tracking towards the coast"],
+    'heatwave': ["A heatwave will bring temperatures above 40C", "Extreme heat is forecast for three days"],
+    'disease': ["A disease outbreak has been confirmed", "Cases of the virus are increasing quickly"],
+    'drought': ["Drought conditions will continue this month", "Reservoirs are low due to drought"],
+    'unknown': ["Power cuts are planned for maintenance", "Roads are closed for a public event"]}
+HAZARD_TYPES = {'flood': "Flood", 'typhoon': "Typhoon", 'heatwave': "Heatwave", 'disease': "Disease",
+                'drought': "Drought", 'unknown': None}
+# Severity goes inside the headline sentence, which is all the classifier reads
+SEVERITY_PHRASES = ["", "Low risk:", "Moderate risk:", "High risk:", "Severe warning:", "Critical danger:"]
+AREAS = ["Hanoi", "Ho Chi Minh City", "Da Nang", "Phnom Penh", "Siem Reap", "Can Tho", "Hue"]
+ACTIONS = ["Move to higher ground", "Seek shelter", "Avoid the sun", "Wash your hands", "Save water",
+           "Stay indoors", "Follow local guidance"]
+LANGUAGES = ["", "en", "vi", "km"]
+
+# Kinds of traffic the generator sends and the ack each should get. legacy packets get no
+# ack, and garbage connections should simply be closed by the receiver.
+MESSAGE_KINDS = ('text', 'structured', 'binary', 'malformed', 'unauthenticated', 'legacy', 'garbage')
+DEFAULT_MIX = {'text': 5, 'structured': 2, 'binary': 2, 'malformed': 1, 'unauthenticated': 1}
+EXPECTED_STATUS = {'text': epaper.ACK_OK, 'structured': epaper.ACK_OK, 'binary': epaper.ACK_OK,
+                   'malformed': epaper.ACK_BAD_DATA, 'unauthenticated': epaper.ACK_AUTH_FAILED}
+
 def create_test_packet(auth_code, custom_string, size=1024):
     # Ensure the authentication code is exactly 4 bytes
     if len(auth_code) != 4:
@@ -16,23 +86,461 @@ def create_test_packet(auth_code, custom_string, size=1024):
 
     # Create the packet with the auth code, custom string, and pad with spaces
     packet = auth_code + custom_string_encoded + b' ' * (size - len(auth_code) - len(custom_string_encoded))
-    print(packet)
     return packet
 
+def create_frame(auth_code, custom_string, message_id):
+    # Ensure the authentication code is exactly 4 bytes
+    if len(auth_code) != 4:
+        raise ValueError("Authentication code must be exactly 4 bytes")
+
+    # Text is sent as UTF-8, bytes (such as a binary message) as they are
+    payload = custom_string if isinstance(custom_string, bytes) else custom_string.encode('utf-8')
+    return epaper.FRAME_HEADER.pack(epaper.FRAME_MAGIC, epaper.PROTOCOL_VERSION, auth_code, message_id,
+                                    len(payload)) + payload
+
+def create_hmac_frame(hmac_key, custom_string, message_id, timestamp=None, nonce=None):
+    # Version 2 frame, authenticated with HMAC-SHA256 instead of an auth code
+    payload = custom_string if isinstance(custom_string, bytes) else custom_string.encode('utf-8')
+    timestamp = int((time.time() if timestamp is None else timestamp) * 1000)
+    nonce = os.urandom(8) if nonce is None else nonce
+    header = epaper.FRAME_HEADER_HMAC.pack(epaper.FRAME_MAGIC, epaper.PROTOCOL_VERSION_HMAC, message_id, len(payload),
+                                           timestamp, nonce, b'\x00' * epaper.MAC_SIZE)[:-epaper.MAC_SIZE]
+    mac = hmac.digest(hmac_key, header + payload, 'sha256')[:epaper.MAC_SIZE]
+    return header + mac + payload
+
 def send_test_packet(host='127.0.0.1', port=PORT, auth_code=b'ABCD', custom_string="Test Packet"):
+    # One legacy packet per connection. The receiver doesn't answer these, it reads the
+    # packet and closes the connection.
     packet = create_test_packet(auth_code, custom_string)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-        client_socket.connect((host, port))
+    with socket.create_connection((host, port)) as client_socket:
         client_socket.sendall(packet)
-        print("Packet sent to server")
 
-        # Receive echoed packet from the server
-        received_packet = client_socket.recv(1024)
-        print(f"Received packet from server: {received_packet[:50].decode('utf-8')}...")  # Print the first 50 bytes for brevity
 
-if __name__ == "__main__":
-    auth_code = b'1111'  # 4-byte authentication code
-    custom_string = "WARNING Flooding is expected in the next 24 hours."
+class AlertConnection:
+    # Persistent framed connection to the receiver. Frames are pipelined: send() only
+    # queues a frame on the socket, and acks are collected afterwards by message id. At
+    # most window frames are left unacknowledged before send() waits for acks. on_ack, if
+    # given, is called with (message id, status, seconds from send to ack) for every ack.
+    # Frames are signed with HMAC when hmac_key is given, otherwise they carry auth_code.
+    # send() can be given other credentials for a single frame, to test refusals.
+    def __init__(self, host='127.0.0.1', port=PORT, auth_code=b'1111', window=64, timeout=10, on_ack=None,
+                 hmac_key=None):
+        self.auth_code = auth_code
+        self.hmac_key = hmac_key
+        self.window = window
+        self.on_ack = on_ack
+        self.next_id = 0
+        self.pending = {}  # message id: time sent
+        self.acks = {}
+        self._buffer = b''
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+
+    def send(self, custom_string, auth_code=None, hmac_key=None):
+        while len(self.pending) >= self.window:
+            self._read_ack()
+        message_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.pending[message_id] = time.perf_counter()
+        if self.hmac_key is not None:
+            frame = create_hmac_frame(hmac_key or self.hmac_key, custom_string, message_id)
+        else:
+            frame = create_frame(auth_code or self.auth_code, custom_string, message_id)
+        self.sock.sendall(frame)
+        return message_id
+
+    def wait_for_acks(self):
+        # Block until every frame sent so far is acknowledged, returning {message id: status}
+        while self.pending:
+            self._read_ack()
+        acks, self.acks = self.acks, {}
+        return acks
+
+    def read_acks(self, timeout):
+        # Collect the acks that arrive within timeout seconds. A sender pacing itself calls this
+        # between frames, so acks are timed as they come rather than when the window fills.
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not select.select([self.sock], [], [], remaining)[0]:
+                break
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError(f"Receiver closed the connection with {len(self.pending)} frames unacknowledged")
+            self._buffer += chunk
+            while len(self._buffer) >= epaper.ACK_FRAME.size:
+                self._read_ack()
+
+    def _read_ack(self):
+        while len(self._buffer) < epaper.ACK_FRAME.size:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError(f"Receiver closed the connection with {len(self.pending)} frames unacknowledged")
+            self._buffer += chunk
+        magic, version, message_id, status = epaper.ACK_FRAME.unpack_from(self._buffer)
+        self._buffer = self._buffer[epaper.ACK_FRAME.size:]
+        if magic != epaper.FRAME_MAGIC or version not in (epaper.PROTOCOL_VERSION, epaper.PROTOCOL_VERSION_HMAC):
+            raise ConnectionError("Receiver sent an invalid ack frame")
+        sent_at = self.pending.pop(message_id, None)
+        self.acks[message_id] = status
+        if self.on_ack is not None and sent_at is not None:
+            self.on_ack(message_id, status, time.perf_counter() - sent_at)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def send_alerts(custom_strings, host='127.0.0.1', port=PORT, auth_code=b'1111', hmac_key=None):
+    # Send a burst of alerts over one persistent connection and return their ack statuses in order
+    with AlertConnection(host, port, auth_code, hmac_key=hmac_key) as connection:
+        message_ids = [connection.send(custom_string) for custom_string in custom_strings]
+        acks = connection.wait_for_acks()
+    return [acks[message_id] for message_id in message_ids]
+
+
+def text_alert(rng, hazard):
+    return (f"{rng.choice(SEVERITY_PHRASES)} {rng.choice(HAZARD_PHRASES[hazard])} in "
+            f"{rng.choice(AREAS)}. {rng.choice(ACTIONS)}. Issued {rng.randint(0, 23):02d}:00".strip())
+
+
+def build_corpus(size, mix=None, seed=1):
+    # Returns size free text alert messages. mix maps hazard names to relative weights
+    rng = random.Random(seed)
+    mix = mix or {hazard: 1 for hazard in HAZARD_PHRASES}
+    hazards = list(mix)
+    weights = [mix[hazard] for hazard in hazards]
+    return [text_alert(rng, rng.choices(hazards, weights)[0]) for _ in range(size)]
+
+
+def region_tag(area):
+    return area.lower().replace(' ', '-')
+
+
+def random_message(rng, kind, hazard):
+    # A message of the given kind about hazard, text or bytes as it goes in a frame
+    alert_type = HAZARD_TYPES[hazard]
+    severity = rng.randint(1, 5)
+    areas = rng.sample(AREAS, rng.randint(0, 2))
+    ttl = rng.choice((0, 600, 3600))
+    if kind in ('text', 'unauthenticated', 'legacy'):
+        return text_alert(rng, hazard) + ''.join(' #' + region_tag(area) for area in areas)
+    if kind == 'structured':
+        fields = [f"type={alert_type}" if alert_type else f"headline={rng.choice(HAZARD_PHRASES[hazard])}",
+                  f"severity={severity}"]
+        if areas:
+            fields.append("area=" + ','.join(region_tag(area) for area in areas))
+        if ttl:
+            fields.append(f"expires={ttl}")
+        return '@' + ';'.join(fields) + '|' + rng.choice(ACTIONS)
+    if kind == 'binary':
+        return epaper.encode_binary_message(rng.choice(ACTIONS), alert_type, severity,
+                                            [region_tag(area) for area in areas], ttl, rng.choice(LANGUAGES))
+    if kind == 'malformed':
+        # Each of these should be refused with ACK_BAD_DATA
+        return rng.choice((
+            b'\xff\xfe' + os.urandom(8),  # not UTF-8
+            ' ' * rng.randint(0, 8),  # nothing but padding
+            f"@type={alert_type or 'Flood'};severity={severity}",  # structured with no text
+            f"@severity=high|{rng.choice(ACTIONS)}",  # severity must be a number
+            f"@type=Meteor;severity={severity}|{rng.choice(ACTIONS)}",  # not a known alert type
+            epaper.encode_binary_message(rng.choice(ACTIONS), alert_type, severity,
+                                         ['hue'])[:epaper.BINARY_MESSAGE.size + 2],
+        ))
+    if kind == 'garbage':
+        # Starts like a frame but with a version the receiver doesn't speak, so it must drop the connection
+        return epaper.FRAME_MAGIC + bytes((0xFF,)) + os.urandom(rng.randint(0, 64))
+    raise ValueError(f"unknown message kind {kind!r}")
+
+
+class TrafficStats:
+    # Counters shared by the generator's connections. Everything is kept for the whole run,
+    # and take_interval() returns and resets what happened since the last report.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}  # kind: messages sent
+        self.statuses = {}  # status name: acks
+        self.unexpected = {}  # kind: acks with a status that kind shouldn't get
+        self.errors = {}  # error type: count
+        self.acked = 0
+        self.in_flight = 0
+        self.reconnects = 0
+        self.lost = 0  # frames still unacknowledged when their connection failed
+        self.garbage_closed = 0
+        self.garbage_stalled = 0  # garbage connections the receiver left open
+        self.latency = epaper.Histogram()
+        self.interval_latency = epaper.Histogram()
+        self.interval_sent = 0
+        self.interval_acked = 0
+        self.interval_errors = 0
 
-    send_test_packet(auth_code=auth_code, custom_string=custom_string)
+    def count_sent(self, kind, framed=True):
+        with self.lock:
+            self.sent[kind] = self.sent.get(kind, 0) + 1
+            self.interval_sent += 1
+            if framed:
+                self.in_flight += 1
+
+    def count_ack(self, kind, status, latency):
+        with self.lock:
+            self.acked += 1
+            self.interval_acked += 1
+            self.in_flight -= 1
+            name = STATUS_NAMES.get(status, str(status))
+            self.statuses[name] = self.statuses.get(name, 0) + 1
+            if kind is not None and status not in (EXPECTED_STATUS[kind], epaper.ACK_RATE_LIMITED):
+                self.unexpected[kind] = self.unexpected.get(kind, 0) + 1
+            self.latency.observe(latency)
+            self.interval_latency.observe(latency)
+
+    def count_error(self, error, lost=0):
+        with self.lock:
+            name = type(error).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+            self.interval_errors += 1
+            self.lost += lost
+            self.in_flight -= lost
+
+    def count_garbage(self, closed):
+        with self.lock:
+            if closed:
+                self.garbage_closed += 1
+            else:
+                self.garbage_stalled += 1
+
+    def take_interval(self):
+        with self.lock:
+            interval = {"sent": self.interval_sent, "acked": self.interval_acked, "errors": self.interval_errors,
+                        "latency": self.interval_latency.snapshot()}
+            self.interval_sent = self.interval_acked = self.interval_errors = 0
+            self.interval_latency = epaper.Histogram()
+            return interval
+
+    def totals(self):
+        with self.lock:
+            return {"sent": dict(sorted(self.sent.items())), "acked": self.acked, "in_flight": self.in_flight,
+                    "statuses": dict(sorted(self.statuses.items())), "unexpected": dict(sorted(self.unexpected.items())),
+                    "errors": dict(sorted(self.errors.items())), "reconnects": self.reconnects, "lost": self.lost,
+                    "garbage_closed": self.garbage_closed, "garbage_stalled": self.garbage_stalled,
+                    "latency": self.latency.snapshot()}
+
+
+class TrafficGenerator:
+    # Load and soak test client. Each of connections threads keeps a persistent framed
+    # connection, reconnecting if it fails, and sends randomised messages picked by the kind
+    # weights in mix and the hazard weights in hazards. rate is the total messages per second
+    # across all connections (0 sends as fast as acks allow). legacy and garbage messages are
+    # each sent on a connection of their own.
+    def __init__(self, host='127.0.0.1', port=PORT, connections=8, rate=100, mix=None, hazards=None,
+                 auth_code=b'1111', hmac_key=None, window=64, timeout=10, seed=1):
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.rate = rate
+        self.mix = mix or DEFAULT_MIX
+        self.hazards = hazards or {hazard: 1 for hazard in HAZARD_PHRASES}
+        self.auth_code = auth_code
+        self.hmac_key = hmac_key
+        self.window = window
+        self.timeout = timeout
+        self.seed = seed
+        self.stats = TrafficStats()
+        self.stop_event = threading.Event()
+        self.done = threading.Event()  # set once every connection has sent its share
+        self.running = 0
+        self.threads = []
+        # Credentials for unauthenticated messages, close to the real ones but wrong
+        self.bad_credentials = ({'hmac_key': b'not-' + hmac_key} if hmac_key is not None else
+                                {'auth_code': b'0000' if auth_code != b'0000' else b'9999'})
+
+    def start(self, messages=None):
+        # Start the connections, sending messages in total if given, otherwise until stop()
+        self.running = self.connections
+        for index in range(self.connections):
+            quota = None if messages is None else messages // self.connections + (index < messages % self.connections)
+            thread = threading.Thread(target=self.run_connection, args=(index, quota), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def run_connection(self, index, quota):
+        try:
+            self.send_messages(index, quota)
+        finally:
+            with self.stats.lock:
+                self.running -= 1
+                if not self.running:
+                    self.done.set()
+
+    def send_messages(self, index, quota):
+        rng = random.Random(self.seed * 1000 + index)
+        kinds, kind_weights = list(self.mix), list(self.mix.values())
+        hazards, hazard_weights = list(self.hazards), list(self.hazards.values())
+        interval = self.connections / self.rate if self.rate else 0
+        next_send = time.monotonic() + interval * index / self.connections  # spread the connections out
+        sent = 0
+        while not self.stop_event.is_set() and (quota is None or sent < quota):
+            expected = {}  # message id: kind, for the frames awaiting acks
+
+            def on_ack(message_id, status, latency):
+                self.stats.count_ack(expected.pop(message_id, None), status, latency)
+
+            try:
+                with AlertConnection(self.host, self.port, self.auth_code, self.window, self.timeout, on_ack,
+                                     self.hmac_key) as connection:
+                    while not self.stop_event.is_set() and (quota is None or sent < quota):
+                        if interval:
+                            while not self.stop_event.is_set() and (delay := next_send - time.monotonic()) > 0:
+                                connection.read_acks(min(delay, 0.5))
+                            if self.stop_event.is_set():
+                                break
+                            # Fall behind by at most a second, rather than bursting to catch up
+                            next_send = max(next_send + interval, time.monotonic() - 1)
+                        kind = rng.choices(kinds, kind_weights)[0]
+                        message = random_message(rng, kind, rng.choices(hazards, hazard_weights)[0])
+                        sent += 1
+                        if kind in ('legacy', 'garbage'):
+                            self.send_unframed(kind, message)
+                            continue
+                        self.stats.count_sent(kind)
+                        credentials = self.bad_credentials if kind == 'unauthenticated' else {}
+                        expected[connection.send(message, **credentials)] = kind
+                    connection.wait_for_acks()
+            except OSError as e:  # ConnectionError and socket timeouts included
+                self.stats.count_error(e, lost=len(expected))
+                with self.stats.lock:
+                    self.stats.reconnects += 1
+                self.stop_event.wait(1)
+
+    def send_unframed(self, kind, message):
+        # A legacy packet, or garbage the receiver should close the connection on
+        try:
+            with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+                self.stats.count_sent(kind, framed=False)
+                sock.sendall(create_test_packet(self.auth_code, message) if kind == 'legacy' else message)
+                if kind == 'garbage':
+                    try:
+                        closed = sock.recv(4096) == b''
+                    except ConnectionResetError:
+                        closed = True  # closing with the garbage unread makes the receiver's end reset
+                    except socket.timeout:
+                        closed = False
+                    self.stats.count_garbage(closed)
+        except OSError as e:
+            self.stats.count_error(e)
+
+
+def fetch_server_metrics(url):
+    # The receiver's gauges (queue depth, caches, scheduler and so on) from its /metrics page,
+    # so growth over a soak test shows up next to the client's view
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            snapshot = json.load(response)
+    except (OSError, ValueError) as e:
+        return {"error": str(e)}
+    return {"uptime_s": snapshot.get("uptime_s"), "gauges": snapshot.get("gauges")}
+
+
+def run_traffic(generator, duration=None, messages=None, report_interval=10, metrics_url=None, output=sys.stdout):
+    # Run the generator until duration seconds pass or messages are sent, printing a JSON report
+    # line every report_interval seconds and a summary at the end. An interval in which frames
+    # were waiting but none were acked is reported as stalled. Returns the summary.
+    started = last_report = time.monotonic()
+    deadline = started + duration if duration else float('inf')
+    stalled_intervals = 0
+    generator.start(messages)
+    try:
+        while not generator.done.wait(max(0.0, min(report_interval, deadline - time.monotonic()))):
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            interval = generator.stats.take_interval()
+            in_flight = generator.stats.in_flight
+            stalled = interval["acked"] == 0 and in_flight > 0
+            stalled_intervals += stalled
+            report = {"report": "interval", "elapsed_s": round(now - started, 1), **interval,
+                      "throughput_per_s": round(interval["acked"] / (now - last_report), 1),
+                      "in_flight": in_flight, "stalled": stalled}
+            last_report = now
+            if metrics_url:
+                report["server"] = fetch_server_metrics(metrics_url)
+            output.write(json.dumps(report) + '\n')
+            output.flush()
+    except KeyboardInterrupt:
+        pass
+    generator.stop()
+    generator.join(generator.timeout + 1)
+    elapsed = time.monotonic() - started
+    totals = generator.stats.totals()
+    summary = {"report": "summary", "elapsed_s": round(elapsed, 1), "connections": generator.connections,
+               "rate": generator.rate, "throughput_per_s": round(totals["acked"] / elapsed, 1) if elapsed else None,
+               "stalled_intervals": stalled_intervals, **totals}
+    if metrics_url:
+        summary["server"] = fetch_server_metrics(metrics_url)
+    output.write(json.dumps(summary) + '\n')
+    output.flush()
+    return summary
+
+
+def parse_weights(text, choices):
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in choices:
+            raise argparse.ArgumentTypeError(f"unknown choice {name!r}, choose from {', '.join(choices)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send test alerts to the ePaper alert receiver")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--auth-code', default='1111', help="auth code for unsigned frames (default: 1111)")
+    parser.add_argument('--send', metavar='TEXT', help="send this one alert and print its ack status")
+    parser.add_argument('--duration', type=float, help="generate traffic for this many seconds")
+    parser.add_argument('--messages', type=int, help="generate this many messages in total")
+    parser.add_argument('--connections', type=int, default=8, help="concurrent connections (default: 8)")
+    parser.add_argument('--rate', type=float, default=100,
+                        help="messages per second over all connections, 0 for as fast as possible (default: 100)")
+    parser.add_argument('--mix', type=lambda text: parse_weights(text, MESSAGE_KINDS), default=None,
+                        help="message kind weights, from " + ', '.join(MESSAGE_KINDS) +
+                             " (default: " + ','.join(f"{kind}={weight}" for kind, weight in DEFAULT_MIX.items()) + ")")
+    parser.add_argument('--hazards', type=lambda text: parse_weights(text, HAZARD_PHRASES), default=None,
+                        help="hazard weights, e.g. flood=3,typhoon=1,unknown=1 (default: even)")
+    parser.add_argument('--window', type=int, default=64, help="unacknowledged frames per connection (default: 64)")
+    parser.add_argument('--report-interval', type=float, default=10, help="seconds between reports (default: 10)")
+    parser.add_argument('--metrics-url', help="receiver /metrics to include in reports, e.g. http://127.0.0.1:9100/metrics")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    auth_code = args.auth_code.encode()
+    hmac_key = os.environ.get('EPAPER_HMAC_KEY')  # sign frames if the receiver requires it
+    hmac_key = hmac_key.encode() if hmac_key else None
+
+    if args.duration is None and args.messages is None:
+        custom_string = args.send or "WARNING Flooding is expected in the next 24 hours."
+        statuses = send_alerts([custom_string], args.host, args.port, auth_code, hmac_key)
+        print(f"Alert sent to server, ack status {statuses[0]}")
+        return 0 if statuses[0] == epaper.ACK_OK else 1
+
+    generator = TrafficGenerator(args.host, args.port, args.connections, args.rate, args.mix, args.hazards,
+                                 auth_code, hmac_key, args.window, seed=args.seed)
+    summary = run_traffic(generator, args.duration, args.messages, args.report_interval, args.metrics_url)
+    # Fail a soak run that got wrong answers or stalled, so it can be scripted
+    return 1 if summary["unexpected"] or summary["stalled_intervals"] or summary["garbage_stalled"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
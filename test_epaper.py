@@ -0,0 +1,284 @@
+# ------------------------------------------------------------------------------ #
+#
+# File:    test_epaper.py
+#
+# Purpose: Round trip checks for the formats in the alert display prototype:
+#          the message grammar and binary messages, PackBits, the chunked
+#          panel update stream, dirty rectangles and the alert journal. Runs
+#          under pytest, or on its own with python test_epaper.py.
+#
+# ------------------------------------------------------------------------------ #
+import os
+import random
+import tempfile
+import time
+import unicodedata
+
+from epapertest import epaper
+
+PARSER = epaper.MessageParser()
+
+
+def parse_error(data):
+    # The reason a message is refused with, or None if it parses
+    try:
+        PARSER.parse(data)
+    except epaper.MalformedMessage as e:
+        return e.reason
+    return None
+
+
+# Message grammar
+
+def test_free_text_sentences():
+    message = PARSER.parse("River levels will rise 2.5 m in Hue. Move to higher ground. Issued 06:00")
+    assert message["headline"] == "River levels will rise 2.5 m in Hue"
+    assert message["info"] == "Move to higher ground"
+    message = PARSER.parse("Winds approx. 150 km/h near Da Nang. Seek shelter.")
+    assert message["headline"] == "Winds approx. 150 km/h near Da Nang"
+    assert message["info"] == "Seek shelter"
+
+
+def test_one_sentence_is_headline_and_action():
+    for data in ("WARNING Flooding is expected in the next 24 hours.",
+                 "WARNING Flooding is expected in the next 24 hours"):
+        message = PARSER.parse(data)
+        assert message["headline"] == message["info"] == "WARNING Flooding is expected in the next 24 hours"
+
+
+def test_region_tags():
+    message = PARSER.parse("Flooding in the city #Hue #hanoi. Move up #hue   ")
+    assert message["regions"] == ["hanoi", "hue"]
+    assert message["headline"] == "Flooding in the city"
+
+
+def test_structured_fields():
+    message = PARSER.parse("@type=Flood;severity=4;area=Hanoi, hue;expires=3600;lang=vi;|Move up #da-nang")
+    assert message["alert_type"] == "Flood"
+    assert message["severity"] == 4
+    assert message["regions"] == ["da-nang", "hanoi", "hue"]
+    assert message["ttl"] == 3600
+    assert message["lang"] == "vi"
+    assert message["headline"] == message["info"] == "Move up"
+    assert PARSER.parse("@expires=2030-01-01T00:00:00|Go")["expires_at"] == 1893456000
+    assert "ttl" not in PARSER.parse("@type=Flood;expires=0|Go")  # 0 leaves the default, as in binary
+
+
+def test_binary_round_trip():
+    data = epaper.encode_binary_message("Tránh xa bờ sông", "Typhoon", 5, ["hue", "Hanoi"], 600, "vi")
+    message = PARSER.parse(data)
+    assert message == {"headline": "Tránh xa bờ sông", "info": "Tránh xa bờ sông", "regions": ["hanoi", "hue"],
+                       "severity": 5, "alert_type": "Typhoon", "ttl": 600, "lang": "vi"}
+    assert "alert_type" not in PARSER.parse(epaper.encode_binary_message("Flooding", None, 2))
+
+
+def test_rejected_messages():
+    binary = epaper.encode_binary_message("Move up", "Flood", 3, ["hue"], 0, "en")
+    cases = {
+        "   ": 'empty',
+        ". Move up": 'no_headline',
+        "@type=Flood;severity=3": 'no_text',
+        "@colour=red|Go": 'bad_field',
+        "@severity=|Go": 'bad_field',
+        "@severity=high|Go": 'bad_severity',
+        "@severity=0|Go": 'bad_severity',
+        "@type=Flood;severity=9|Go": 'bad_severity',
+        "@expires=soon|Go": 'bad_expiry',
+        epaper.encode_binary_message("Go", "Flood", 0): 'bad_severity',
+        epaper.encode_binary_message("Go", "Flood", 6): 'bad_severity',
+        epaper.encode_binary_message("Go", "Flood", 255): 'bad_severity',
+        binary[:epaper.BINARY_MESSAGE.size - 1]: 'truncated',
+        binary[:epaper.BINARY_MESSAGE.size + 2]: 'truncated',  # inside the first area
+        binary[:epaper.BINARY_MESSAGE.size + 4]: 'truncated',  # before the language tag
+        b'\xa6' + binary[1:]: 'bad_version',
+        binary[:2] + bytes((len(epaper.ALERT_TYPES) + 1,)) + binary[3:]: 'unknown_type',
+        binary + b'\xff\xfe': 'invalid_utf8',
+    }
+    for data, reason in cases.items():
+        assert parse_error(data) == reason, (data, parse_error(data))
+
+
+# PackBits
+
+def test_packbits_round_trip():
+    rng = random.Random(1)
+    samples = [b'', b'a', b'ab', b'aa', b'aaa', bytes(128), bytes(129), bytes(300), b'ab' * 200,
+               bytes(rng.randrange(256) for _ in range(1000)),
+               b''.join(bytes((rng.randrange(4),)) * rng.randint(1, 140) for _ in range(200))]
+    for data in samples:
+        encoded = epaper.packbits(data)
+        assert epaper.unpackbits(encoded, len(data)) == data
+    assert len(epaper.packbits(bytes(4096))) == 64  # long runs pack to two bytes per 128
+
+
+def test_unpackbits_rejects_bad_data():
+    encoded = epaper.packbits(bytes(10))
+    for data, size in ((encoded, 11), (encoded[:-1], 10), (encoded + b'\x00', 10)):
+        try:
+            epaper.unpackbits(data, size)
+        except ValueError:
+            continue
+        raise AssertionError(f"{data!r} decoded to {size} bytes")
+
+
+# Panel update stream
+
+def alerts(count, seed=1):
+    rng = random.Random(seed)
+    types = list(epaper.ALERT_TYPES) + [None]
+    for number in range(count):
+        yield {"alert_type": rng.choice(types), "severity": rng.randint(1, 5),
+               "info": f"Alert {number}: " + " ".join(rng.choice(("move", "to", "higher", "ground", "now"))
+                                                     for _ in range(rng.randint(1, 30)))}
+
+
+def test_update_stream_keeps_panel_in_sync():
+    display = epaper.EPaperFrameBufferDisplay()
+    decoder = epaper.UpdateDecoder()
+    encoder = epaper.UpdateEncoder(mtu=64, send=decoder.feed)
+    display.on_refresh = encoder.on_refresh
+    for alert in alerts(30):
+        display.draw_content(alert)
+        assert decoder.frame == display.framebuffer
+    display.no_alerts()
+    assert decoder.frame == display.framebuffer
+    assert decoder.stats()["corrupt"] == decoder.stats()["skipped"] == 0
+    assert encoder.stats()["keyframes"] < encoder.stats()["updates"]
+
+
+def test_update_stream_recovers_from_a_dropped_chunk():
+    display = epaper.EPaperFrameBufferDisplay()
+    decoder = epaper.UpdateDecoder()
+    sent = []
+    encoder = epaper.UpdateEncoder(mtu=64, send=sent.append)
+    display.on_refresh = encoder.on_refresh
+    feed = iter(alerts(4, seed=2))
+    display.draw_content(next(feed))
+    for chunk in sent:
+        decoder.feed(chunk)
+    assert decoder.frame == display.framebuffer
+
+    # Lose one chunk of a partial update. The panel finds out when the next update starts,
+    # and must then drop updates until a keyframe
+    sent.clear()
+    display.draw_content(next(feed))
+    assert len(sent) > 1
+    for chunk in sent[:1] + sent[2:]:
+        assert not decoder.feed(chunk)
+    assert decoder.frame != display.framebuffer
+    sent.clear()
+    display.draw_content(next(feed))
+    for chunk in sent:
+        assert not decoder.feed(chunk)
+    assert decoder.needs_keyframe and decoder.skipped == 2
+
+    # The panel asks for a keyframe, and the next update brings it back in step
+    encoder.request_keyframe()
+    sent.clear()
+    display.draw_content(next(feed))
+    for chunk in sent:
+        decoder.feed(chunk)
+    assert decoder.frame == display.framebuffer and not decoder.needs_keyframe
+
+
+def test_update_stream_refuses_corrupt_chunks():
+    display = epaper.EPaperFrameBufferDisplay()
+    decoder = epaper.UpdateDecoder()
+    sent = []
+    display.on_refresh = epaper.UpdateEncoder(send=sent.append).on_refresh
+    display.draw_content(next(alerts(1)))
+    corrupt = bytearray(sent[0])
+    corrupt[len(corrupt) // 2] ^= 0x01
+    assert not decoder.feed(bytes(corrupt))
+    assert decoder.corrupt == 1 and decoder.applied == 0
+
+
+# Dirty rectangles
+
+def test_dirty_rectangles_cover_every_change():
+    rng = random.Random(3)
+    stride, height = 16, 64
+    for gap in (0, 1, 3):
+        for _ in range(200):
+            old = bytearray(rng.randrange(256) for _ in range(stride * height))
+            new = bytearray(old)
+            for _ in range(rng.randint(0, 40)):
+                # Blobs of changed bytes, so neighbouring rows touch and have to be merged
+                x, y = rng.randrange(stride), rng.randrange(height)
+                for dy in range(rng.randint(1, 6)):
+                    for dx in range(rng.randint(1, 4)):
+                        if x + dx < stride and y + dy < height:
+                            new[(y + dy) * stride + x + dx] ^= rng.randrange(1, 256)
+            rectangles = epaper.dirty_rectangles(old, new, stride, height, gap)
+            covered = bytearray(old)
+            for x, y, width, rectangle_height in rectangles:
+                assert x % 8 == 0 and width % 8 == 0 and width and rectangle_height
+                assert x + width <= stride * 8 and y + rectangle_height <= height
+                for row in range(y, y + rectangle_height):
+                    start = row * stride + x // 8
+                    covered[start:start + width // 8] = new[start:start + width // 8]
+            assert covered == new
+            assert (old == new) == (not rectangles)
+
+
+def test_dirty_rectangles_keep_the_top_row_when_merging():
+    # Two columns joined by a bar at the bottom make one rectangle from the top of the
+    # taller one, whichever of them is absorbed last
+    stride, height = 4, 4
+    old = bytearray(stride * height)
+    new = bytearray(old)
+    for y in range(3):
+        new[y * stride] = 0xFF
+    new[2 * stride + 3] = 0xFF
+    new[3 * stride:4 * stride] = b'\xff' * stride
+    assert epaper.dirty_rectangles(old, new, stride, height, gap=0) == [(0, 0, 32, 4)]
+
+
+def test_panel_draws_no_missing_glyphs_for_default_actions():
+    # The framebuffer font has no Khmer, so the panel leaves those lines out rather than
+    # drawing rows of boxes
+    display = epaper.EPaperFrameBufferDisplay()
+    drawn = []
+    display.draw_info = drawn.append
+    for alert_type in epaper.DEFAULT_ACTIONS:
+        display.draw_content({"alert_type": alert_type, "severity": 1, "info": None})
+    display.draw_content({"alert_type": "Flood", "severity": 1, "info": "ស្វែងរកដីខ្ពស់"})
+    assert drawn[-1] == drawn[0]  # a message only in Khmer gets the default action
+    for text in drawn:
+        for line in epaper.layout_text(text)[0]:
+            for cluster in line:
+                glyph = epaper.font_glyph(unicodedata.normalize('NFC', cluster)[0])
+                assert glyph is not epaper.MISSING_GLYPH, (text, cluster)
+
+
+# Alert journal
+
+def test_journal_round_trip_and_torn_tail():
+    now = time.time()
+    records = [{"alert_type": "Flood", "severity": 3, "info": "Move up", "regions": ["hue"], "lang": "vi",
+                "received_at": now, "expires_at": now + 600, "message_key": "a"},
+               {"alert_type": "Typhoon", "severity": 5, "info": "Seek shelter", "regions": [], "lang": None,
+                "received_at": now + 1, "expires_at": now + 60, "message_key": "b"}]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'journal.bin')
+        journal = epaper.AlertJournal(path)
+        for record in records:
+            journal.append(record)
+        journal.stop()
+        assert list(epaper.read_journal(path)) == records
+
+        # A record torn by a crash is dropped, and the ones before it survive a restart
+        with open(path, 'ab') as journal_file:
+            journal_file.write(epaper.JOURNAL_RECORD.pack(100, 0) + b'{"alert_')
+        assert list(epaper.read_journal(path)) == records
+        restored = epaper.AlertJournal(path)
+        assert restored.active_alerts(now) == [records[1], records[0]]
+        restored.stop()
+        assert sorted(epaper.read_journal(path), key=lambda record: record["message_key"]) == records
+
+
+if __name__ == "__main__":
+    for name, check in list(globals().items()):
+        if name.startswith('test_'):
+            check()
+            print("ok", name)